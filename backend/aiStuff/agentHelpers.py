@@ -5,8 +5,14 @@ import re
 import ast
 import io
 import json
+import base64
+import asyncio
 import logging
-from typing import List, Dict, Any, Tuple, Optional, TypedDict
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+from typing import List, Dict, Any, Tuple, Optional, TypedDict, Iterable, Iterator, Sequence
 from decimal import Decimal
 from datetime import datetime, timezone, date
 import sqlparse
@@ -14,22 +20,34 @@ from sqlparse.sql import IdentifierList, Identifier
 from sqlparse.tokens import Keyword, DML
 from dotenv import load_dotenv
 from contextlib import contextmanager
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 from contextlib import asynccontextmanager
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
 from sqlalchemy.sql import text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 
+import numpy as np
 import pandas as pd
 import tiktoken
 from PyPDF2 import PdfReader
 import pymongo
-from pymongo import MongoClient, TEXT
+from pymongo import MongoClient, TEXT, ASCENDING, DESCENDING, IndexModel, ReturnDocument, monitoring
 from pymongo.errors import OperationFailure
 from bson import ObjectId
 import gridfs
 
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+from .caches import ResultCache
+from .chatSearch import getChatSearchEngine
+from .telemetry import span, traced, traceMethods
+
 from langchain_community.tools.sql_database.tool import QuerySQLDataBaseTool
 from langchain_community.utilities import SQLDatabase
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
@@ -53,7 +71,8 @@ Message = TypedDict('Message', {
     'user': str,
     'content': str,
     'date': str,
-    'time': str
+    'time': str,
+    'tokens': int
 })
 
 UserDocument = TypedDict('UserDocument', {
@@ -74,6 +93,16 @@ ChatDocument = TypedDict('ChatDocument', {
     'documents': List[UserDocument]
 })
 
+ChatPage = TypedDict('ChatPage', {
+    'chats': List[ChatDocument],
+    'nextCursor': Optional[str]
+})
+
+MessagePage = TypedDict('MessagePage', {
+    'messages': List[Message],
+    'nextCursor': Optional[str]
+})
+
 ## Defining Custom exceptions
 class NoDataFoundException(Exception):
     """Raised when no data is fetched from the database"""
@@ -87,6 +116,14 @@ class InvalidUserQueryException(Exception):
         self.message = message
         super().__init__(self.message)
 
+class QueryTooExpensiveException(Exception):
+    """Raised when a query's estimated cost exceeds the configured limit or it runs past the statement timeout"""
+    def __init__(self, message="This question needs a query that is too expensive to run. Try narrowing it down, e.g. to an election year, state or division.", hint=""):
+        self.message = message
+        ## Feedback for SqlExpert when the query is regenerated
+        self.hint = hint
+        super().__init__(self.message)
+
 class NoResultsFoundException(Exception):
     """Exception raised when no search results are found."""
     def __init__(self, message="No search results found"):
@@ -99,6 +136,214 @@ class ChatHistoryError(Exception):
         self.message = message
         super().__init__(self.message)
 
+class InvalidCursorError(ValueError):
+    """Raised when a pagination cursor or requested field list cannot be used"""
+    def __init__(self, message="Invalid pagination cursor."):
+        self.message = message
+        super().__init__(self.message)
+
+def _getIntEnv(name: str, default: Optional[int]) -> Optional[int]:
+    """Reads an optional integer environment variable, falling back to `default` when unset or empty."""
+    value = os.environ.get(name)
+    if value is None or not value.strip():
+        return default
+    return int(value)
+
+## Shared MongoDB client
+class MongoPoolStats(monitoring.ConnectionPoolListener):
+    """
+    Connection pool listener that keeps running counters for the shared MongoDB client.
+
+    A checkout counts as a wait when it starts while every pooled connection is already in use,
+    i.e. the caller has to queue until another request checks a connection back in.
+
+    Attributes:
+        maxPoolSize (int): Configured maximum pool size, used to detect waits.
+        checkouts (int): Number of successful connection checkouts.
+        checkoutFailures (int): Number of failed checkouts (e.g. wait queue timeouts).
+        waits (int): Number of checkouts that had to queue for a connection.
+        inUse (int): Connections currently checked out.
+        open (int): Connections currently open across all pools.
+        totalCheckoutMs (float): Accumulated time spent obtaining connections.
+        maxCheckoutMs (float): Slowest checkout observed.
+    """
+    def __init__(self, maxPoolSize: int = 100):
+        self.maxPoolSize = maxPoolSize
+        self._lock = threading.Lock()
+        self._pending: Dict[int, float] = {}
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.checkouts = 0
+            self.checkoutFailures = 0
+            self.waits = 0
+            self.inUse = 0
+            self.open = 0
+            self.totalCheckoutMs = 0.0
+            self.maxCheckoutMs = 0.0
+            self._pending.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Returns a point-in-time copy of the counters."""
+        with self._lock:
+            return {
+                "maxPoolSize": self.maxPoolSize,
+                "checkouts": self.checkouts,
+                "checkoutFailures": self.checkoutFailures,
+                "waits": self.waits,
+                "inUse": self.inUse,
+                "open": self.open,
+                "avgCheckoutMs": self.totalCheckoutMs / self.checkouts if self.checkouts else 0.0,
+                "maxCheckoutMs": self.maxCheckoutMs,
+            }
+
+    def connection_check_out_started(self, event) -> None:
+        with self._lock:
+            self._pending[threading.get_ident()] = time.perf_counter()
+            if self.inUse >= self.maxPoolSize:
+                self.waits += 1
+
+    def connection_checked_out(self, event) -> None:
+        with self._lock:
+            startedAt = self._pending.pop(threading.get_ident(), None)
+            self.checkouts += 1
+            self.inUse += 1
+            if startedAt is not None:
+                elapsedMs = (time.perf_counter() - startedAt) * 1000
+                self.totalCheckoutMs += elapsedMs
+                self.maxCheckoutMs = max(self.maxCheckoutMs, elapsedMs)
+
+    def connection_check_out_failed(self, event) -> None:
+        with self._lock:
+            self._pending.pop(threading.get_ident(), None)
+            self.checkoutFailures += 1
+
+    def connection_checked_in(self, event) -> None:
+        with self._lock:
+            self.inUse = max(0, self.inUse - 1)
+
+    def connection_created(self, event) -> None:
+        with self._lock:
+            self.open += 1
+
+    def connection_closed(self, event) -> None:
+        with self._lock:
+            self.open = max(0, self.open - 1)
+
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_ready(self, event) -> None:
+        pass
+
+    def pool_cleared(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        pass
+
+    def connection_ready(self, event) -> None:
+        pass
+
+def _mongoPoolOptions() -> Dict[str, Any]:
+    """Builds the pool keyword arguments for MongoClient from environment variables."""
+    options = {
+        "maxPoolSize": _getIntEnv("MONGO_MAX_POOL_SIZE", 100),
+        "minPoolSize": _getIntEnv("MONGO_MIN_POOL_SIZE", 0),
+        "maxIdleTimeMS": _getIntEnv("MONGO_MAX_IDLE_TIME_MS", None),
+        "waitQueueTimeoutMS": _getIntEnv("MONGO_WAIT_QUEUE_TIMEOUT_MS", None),
+        "maxConnecting": _getIntEnv("MONGO_MAX_CONNECTING", 2),
+    }
+    return {key: value for key, value in options.items() if value is not None}
+
+mongoPoolStats = MongoPoolStats()
+_mongoClient: Optional[MongoClient] = None
+_mongoClientLock = threading.Lock()
+
+def getMongoClient() -> MongoClient:
+    """
+    Returns the process-wide MongoClient, creating it on first use.
+
+    The client owns a connection pool sized from MONGO_MAX_POOL_SIZE / MONGO_MIN_POOL_SIZE
+    (plus MONGO_MAX_IDLE_TIME_MS, MONGO_WAIT_QUEUE_TIMEOUT_MS and MONGO_MAX_CONNECTING).
+    Callers borrow connections from it and must not close it; use `closeMongoClient` on shutdown.
+
+    Returns:
+        MongoClient: The shared client.
+
+    Raises:
+        ChatHistoryError: If MONGO_URI is not set.
+    """
+    global _mongoClient
+    if _mongoClient is not None:
+        return _mongoClient
+
+    with _mongoClientLock:
+        if _mongoClient is None:
+            mongoUri = os.environ.get("MONGO_URI")
+            if not mongoUri:
+                raise ChatHistoryError("MongoDB connection details are not set in environment variables")
+            options = _mongoPoolOptions()
+            mongoPoolStats.maxPoolSize = options["maxPoolSize"]
+            _mongoClient = MongoClient(mongoUri, event_listeners=[mongoPoolStats], **options)
+            logger.info(f"Created shared MongoDB client with pool options: {options}")
+    return _mongoClient
+
+def closeMongoClient() -> None:
+    """Closes the process-wide MongoClient, if it was created."""
+    global _mongoClient
+    with _mongoClientLock:
+        if _mongoClient is not None:
+            _mongoClient.close()
+            _mongoClient = None
+            mongoPoolStats.reset()
+            logger.info("Shared MongoDB client closed")
+
+def getMongoPoolStats() -> Dict[str, Any]:
+    """Returns checkout, wait and in-use counters for the shared MongoDB pool."""
+    return mongoPoolStats.snapshot()
+
+asyncMongoPoolStats = MongoPoolStats()
+_asyncMongoClient: Optional[AsyncIOMotorClient] = None
+
+def getAsyncMongoClient() -> AsyncIOMotorClient:
+    """
+    Returns the process-wide motor client used by `AsyncChatHistory`, creating it on first use.
+
+    Uses the same pool settings as `getMongoClient`. Should be created from within the running
+    event loop (the FastAPI lifespan hook does this) and closed with `closeAsyncMongoClient`.
+
+    Returns:
+        AsyncIOMotorClient: The shared async client.
+
+    Raises:
+        ChatHistoryError: If MONGO_URI is not set.
+    """
+    global _asyncMongoClient
+    if _asyncMongoClient is None:
+        mongoUri = os.environ.get("MONGO_URI")
+        if not mongoUri:
+            raise ChatHistoryError("MongoDB connection details are not set in environment variables")
+        options = _mongoPoolOptions()
+        asyncMongoPoolStats.maxPoolSize = options["maxPoolSize"]
+        _asyncMongoClient = AsyncIOMotorClient(mongoUri, event_listeners=[asyncMongoPoolStats], **options)
+        logger.info(f"Created shared async MongoDB client with pool options: {options}")
+    return _asyncMongoClient
+
+def closeAsyncMongoClient() -> None:
+    """Closes the process-wide motor client, if it was created."""
+    global _asyncMongoClient
+    if _asyncMongoClient is not None:
+        _asyncMongoClient.close()
+        _asyncMongoClient = None
+        asyncMongoPoolStats.reset()
+        logger.info("Shared async MongoDB client closed")
+
+def getAsyncMongoPoolStats() -> Dict[str, Any]:
+    """Returns checkout, wait and in-use counters for the shared async MongoDB pool."""
+    return asyncMongoPoolStats.snapshot()
+
 def loadFromMongo(collectionName: str, fileName: str) -> str:
     """
     Load metadata from MongoDB.
@@ -119,10 +364,8 @@ def loadFromMongo(collectionName: str, fileName: str) -> str:
         logger.error("MONGODB_URI environment variable is not set")
         raise ValueError("MONGODB_URI environment variable is not set")
 
-    client = None
     try:
-        client = MongoClient(mongodb_uri)
-        db = client['Resources']
+        db = getMongoClient()['Resources']
         collection = db[collectionName]
         
         metadata = collection.find_one({'name': fileName})
@@ -136,15 +379,174 @@ def loadFromMongo(collectionName: str, fileName: str) -> str:
     except pymongo.errors.PyMongoError as e:
         logger.error(f"Error loading metadata for {fileName}: {str(e)}")
         raise
-    finally:
-        if client:
-            client.close()
-            logger.debug("MongoDB connection closed")
+
+## Shared PostgreSQL engines
+class PostgresPoolStats:
+    """
+    Checkout counters and latency samples for one cached SQLAlchemy engine.
+
+    Checkout latency covers waiting for a free pooled connection, opening a new one when the pool
+    can grow, and the pre-ping round trip.
+    """
+    def __init__(self, dbName: str, sampleSize: int = 1024):
+        self.dbName = dbName
+        self._lock = threading.Lock()
+        self._samples: deque = deque(maxlen=sampleSize)
+        self.checkouts = 0
+        self.checkoutFailures = 0
+        self.connectionsOpened = 0
+        self.invalidations = 0
+        self.totalCheckoutMs = 0.0
+        self.maxCheckoutMs = 0.0
+        self.engine: Optional[Engine] = None
+
+    def recordCheckout(self, elapsedMs: float) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.totalCheckoutMs += elapsedMs
+            self.maxCheckoutMs = max(self.maxCheckoutMs, elapsedMs)
+            self._samples.append(elapsedMs)
+
+    def recordFailure(self) -> None:
+        with self._lock:
+            self.checkoutFailures += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Returns a point-in-time copy of the counters, including current pool occupancy."""
+        with self._lock:
+            samples = sorted(self._samples)
+            stats = {
+                "checkouts": self.checkouts,
+                "checkoutFailures": self.checkoutFailures,
+                "connectionsOpened": self.connectionsOpened,
+                "invalidations": self.invalidations,
+                "avgCheckoutMs": self.totalCheckoutMs / self.checkouts if self.checkouts else 0.0,
+                "p95CheckoutMs": samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else 0.0,
+                "maxCheckoutMs": self.maxCheckoutMs,
+            }
+        if self.engine is not None:
+            pool = self.engine.pool
+            stats.update({
+                "poolSize": pool.size(),
+                "inUse": pool.checkedout(),
+                "idle": pool.checkedin(),
+                "overflow": pool.overflow(),
+            })
+        return stats
+
+class _TimedQueuePool(QueuePool):
+    """QueuePool that reports checkout latency to the `stats` object of its (per-database) subclass."""
+    stats: Optional[PostgresPoolStats] = None
+
+    def connect(self):
+        startedAt = time.perf_counter()
+        try:
+            connection = super().connect()
+        except Exception:
+            if self.stats is not None:
+                self.stats.recordFailure()
+            raise
+        if self.stats is not None:
+            self.stats.recordCheckout((time.perf_counter() - startedAt) * 1000)
+        return connection
+
+_postgresEngines: Dict[str, Engine] = {}
+_sqlDatabases: Dict[str, SQLDatabase] = {}
+_postgresPoolStats: Dict[str, PostgresPoolStats] = {}
+_postgresLock = threading.Lock()
+
+def _postgresUri(dbName: str) -> str:
+    requiredEnvVars = ['POSTGRES_USER', 'POSTGRES_PASSWORD', 'POSTGRES_HOST', 'POSTGRES_PORT']
+    for var in requiredEnvVars:
+        if not os.environ.get(var):
+            raise ValueError(f"Environment variable {var} is not set")
+
+    return f"postgresql+psycopg2://{os.environ['POSTGRES_USER']}:{os.environ['POSTGRES_PASSWORD']}@{os.environ['POSTGRES_HOST']}:{os.environ['POSTGRES_PORT']}/{dbName}"
+
+def getPostgresEngine(dbName: str) -> Engine:
+    """
+    Returns the process-wide SQLAlchemy engine for `dbName`, creating it on first use.
+
+    Pool behaviour is configured with POSTGRES_POOL_SIZE (default 5), POSTGRES_MAX_OVERFLOW (10),
+    POSTGRES_POOL_TIMEOUT (30s), POSTGRES_POOL_RECYCLE (1800s) and POSTGRES_POOL_PRE_PING (true).
+
+    Args:
+        dbName (str): Name of the database to connect to.
+
+    Returns:
+        Engine: The shared engine.
+
+    Raises:
+        ValueError: If required environment variables are not set.
+    """
+    engine = _postgresEngines.get(dbName)
+    if engine is not None:
+        return engine
+
+    with _postgresLock:
+        if dbName not in _postgresEngines:
+            stats = PostgresPoolStats(dbName)
+            poolClass = type("TimedQueuePool", (_TimedQueuePool,), {"stats": stats})
+            engine = create_engine(
+                _postgresUri(dbName),
+                poolclass=poolClass,
+                pool_size=_getIntEnv("POSTGRES_POOL_SIZE", 5),
+                max_overflow=_getIntEnv("POSTGRES_MAX_OVERFLOW", 10),
+                pool_timeout=_getIntEnv("POSTGRES_POOL_TIMEOUT", 30),
+                pool_recycle=_getIntEnv("POSTGRES_POOL_RECYCLE", 1800),
+                pool_pre_ping=os.environ.get("POSTGRES_POOL_PRE_PING", "true").lower() == "true",
+            )
+
+            @event.listens_for(engine, "connect")
+            def _onConnect(dbapiConnection, connectionRecord):
+                stats.connectionsOpened += 1
+
+            @event.listens_for(engine, "invalidate")
+            def _onInvalidate(dbapiConnection, connectionRecord, exception):
+                stats.invalidations += 1
+
+            stats.engine = engine
+            _postgresPoolStats[dbName] = stats
+            _postgresEngines[dbName] = engine
+            logger.info(f"Created shared PostgreSQL engine for {dbName}")
+        return _postgresEngines[dbName]
+
+def getSqlDatabase(dbName: str) -> SQLDatabase:
+    """
+    Returns a cached SQLDatabase over the shared engine for `dbName`, so table metadata is
+    reflected once per process instead of on every query.
+    """
+    db = _sqlDatabases.get(dbName)
+    if db is not None:
+        return db
+
+    engine = getPostgresEngine(dbName)
+    with _postgresLock:
+        if dbName not in _sqlDatabases:
+            _sqlDatabases[dbName] = SQLDatabase(engine)
+        return _sqlDatabases[dbName]
+
+def disposePostgresEngines() -> None:
+    """Closes every pooled PostgreSQL connection and forgets the cached engines."""
+    with _postgresLock:
+        for dbName, engine in _postgresEngines.items():
+            engine.dispose()
+            logger.info(f"Disposed PostgreSQL engine for {dbName}")
+        _postgresEngines.clear()
+        _sqlDatabases.clear()
+        _postgresPoolStats.clear()
+
+def getPostgresPoolStats() -> Dict[str, Dict[str, Any]]:
+    """Returns checkout latency and occupancy stats for every cached PostgreSQL engine."""
+    return {dbName: stats.snapshot() for dbName, stats in list(_postgresPoolStats.items())}
 
 @contextmanager
 def loadPostgresDatabase(dbName: str):
     """
     Context manager for loading a PostgreSQL database using environment variables.
+
+    The yielded SQLDatabase and its engine are cached per database and shared across calls;
+    connections go back to the pool instead of being closed.
     
     Args:
         dbName (str): Name of the database to connect to.
@@ -155,18 +557,7 @@ def loadPostgresDatabase(dbName: str):
     Raises:
         ValueError: If required environment variables are not set.
     """
-    requiredEnvVars = ['POSTGRES_USER', 'POSTGRES_PASSWORD', 'POSTGRES_HOST', 'POSTGRES_PORT']
-    for var in requiredEnvVars:
-        if not os.environ.get(var):
-            raise ValueError(f"Environment variable {var} is not set")
-    
-    uri = f"postgresql+psycopg2://{os.environ['POSTGRES_USER']}:{os.environ['POSTGRES_PASSWORD']}@{os.environ['POSTGRES_HOST']}:{os.environ['POSTGRES_PORT']}/{dbName}"
-    engine = create_engine(uri)
-    db = SQLDatabase(engine)
-    try:
-        yield db
-    finally:
-        engine.dispose()
+    yield getSqlDatabase(dbName)
 
 def loadLLM(llmName: str = 'gpt', model: str = 'gpt-4o', temperature: float = 0, maxTokens: Optional[int] = None, timeout: Optional[int] = None, maxRetries: int = 2):
     """
@@ -248,29 +639,6 @@ def cleanSqlQuery(sqlQuery: str) -> str:
 
     return sqlQuery
 
-def cleanWhereConditions(whereConditions: str) -> List[Dict[str, str]]:
-    """
-    Cleans and extracts the WHERE conditions from the LLM response.
-    
-    Args:
-        whereConditions (str): The original WHERE conditions string from the LLM response.
-    
-    Returns:
-        List[Dict[str, str]]: A list of dictionaries containing table and column information.
-    """
-    if "Extracted WHERE columns:" in whereConditions:
-        whereConditions = whereConditions.split("Extracted WHERE columns:")[1].strip()
-    whereConditions = whereConditions.replace("```json", "").replace("```", "").strip()
-    
-    try:
-        parsed_conditions = json.loads(whereConditions)
-        if isinstance(parsed_conditions, list) and all(isinstance(item, dict) for item in parsed_conditions):
-            return parsed_conditions
-        else:
-            raise ValueError("Parsed conditions are not in the expected format")
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Failed to parse JSON: {str(e)}")
-
 def cleanSummaryResponse(summary: str) -> str:
         """
         Cleans and extracts the updated summary from the LLM response.
@@ -333,41 +701,120 @@ def get_relevant_documents(query, k=10):
     similar = db.similarity_search_with_score(query, k=k)
     return similar
 
+def _normaliseColumn(values: List[Any]) -> Any:
+    """Converts a fetched column to a pandas-friendly form; NUMERIC (Decimal) columns become float64."""
+    sample = next((value for value in values if value is not None), None)
+    if isinstance(sample, Decimal):
+        return np.array(values, dtype=object).astype(np.float64)
+    return values
+
+def rowsToDataFrame(columns: List[str], batches: Iterable[Sequence[Tuple[Any, ...]]], useArrow: bool = False) -> pd.DataFrame:
+    """
+    Builds a DataFrame from batches of DB-API rows by appending each batch column-wise.
+
+    Args:
+        columns (List[str]): Column names, typically from `cursor.description`.
+        batches (Iterable[Sequence[Tuple]]): Row batches, e.g. successive `cursor.fetchmany()` results.
+        useArrow (bool): Build the frame through a pyarrow Table (requires pyarrow).
+
+    Returns:
+        pd.DataFrame: The result set with typed columns (NUMERIC as float, NULL as None/NaN).
+    """
+    columnData: List[List[Any]] = [[] for _ in columns]
+    for rows in batches:
+        for target, values in zip(columnData, zip(*rows)):
+            target.extend(values)
+
+    normalised = [_normaliseColumn(values) for values in columnData]
+    if useArrow:
+        if pa is None:
+            raise ImportError("pyarrow is required for Arrow result conversion")
+        table = pa.Table.from_arrays([pa.array(values) for values in normalised], names=[str(i) for i in range(len(columns))])
+        df = table.to_pandas()
+    else:
+        df = pd.DataFrame({i: values for i, values in enumerate(normalised)})
+    df.columns = columns
+    return df
+
+class QueryCancellation:
+    """
+    Lets another thread cancel a query running in `QuerySQLTool.executeQuery` on the server, e.g.
+    when the request that started it is cancelled. Cancelling before the query starts makes it fail
+    as soon as it gets a connection.
+    """
+    def __init__(self):
+        self.cancelled = False
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def attach(self, dbapiConnection) -> None:
+        with self._lock:
+            if self.cancelled:
+                raise InvalidUserQueryException("Query cancelled.")
+            self._connection = dbapiConnection
+
+    def detach(self) -> None:
+        with self._lock:
+            self._connection = None
+
+    def cancel(self) -> None:
+        """Sends a cancel request for the running statement, if any (psycopg2 `connection.cancel`)."""
+        with self._lock:
+            self.cancelled = True
+            connection = self._connection
+        if connection is not None and hasattr(connection, "cancel"):
+            try:
+                connection.cancel()
+            except Exception as e:
+                logger.warning(f"Could not cancel the running query: {str(e)}")
+
 class QuerySQLTool:
     """
     A tool for executing SQL queries on a database and processing the results.
 
-    This class provides methods to execute SQL queries, parse the results,
-    and convert them into pandas DataFrames. It includes custom parsing for
-    special data types like Decimal, datetime, and date.
+    Queries run on a pooled DB-API connection from the shared engine; rows are fetched in batches
+    (SQL_FETCH_BATCH_SIZE, default 10000) and assembled column-wise into a DataFrame, with column
+    names taken from `cursor.description`. Set SQL_RESULT_ARROW=true to build frames via pyarrow.
+
+    With a `resultCache`, validated queries are looked up there first and non-empty results are
+    stored, so a query that was already run under the current data version skips the database.
+
+    Every query runs under a per-statement `statement_timeout`. Before it runs, the cost guard reads
+    its plan with `EXPLAIN (FORMAT JSON)`: a total cost above the limit rejects it, and an estimated
+    row count above the limit downgrades it to fetch only the first `maxPlanRows` rows (recorded in
+    the frame's `attrs` as `rowLimit` and `estimatedRows`).
+
+    With TELEMETRY_ENABLED=true each call is a `postgres.executeQuery` span, with the result cache
+    lookup, the EXPLAIN and the fetch as child spans.
+
+    Configuration (read from the environment):
+        SQL_STATEMENT_TIMEOUT_MS: Per-statement timeout; 0 disables it (default 30000).
+        SQL_COST_GUARD_ENABLED: Check the plan before running a query (default true).
+        SQL_MAX_PLAN_COST: Highest planner cost that is run (default 5000000).
+        SQL_MAX_PLAN_ROWS: Estimated rows above which only this many are fetched (default 100000).
 
     Attributes:
-        db (SQLDatabase): The database connection object.
-        queryRunner (QuerySQLDataBaseTool): The tool used to run SQL queries.
+        dbName (str): The database the queries run against.
+        resultCache (Optional[ResultCache]): Shared cache of query results, if any.
 
     Methods:
         executeQuery(query: str) -> pd.DataFrame:
             Execute an SQL query and return the results as a DataFrame.
-        getCols(sqlQuery: str) -> List[str]:
-            Extract column names from an SQL query.
-
-    Private Methods:
-        _parseDecimal(match): Parse Decimal values from query results.
-        _parseDatetime(match): Parse datetime values from query results.
-        _parseDate(match): Parse date values from query results.
-        _customParser(resStr: str): Custom parser for query result strings.
 
     Raises:
         InvalidUserQueryException: If the query is invalid or unrelated to the database.
+        QueryTooExpensiveException: If the plan is over the cost limit or the statement timed out.
         NoDataFoundException: If no data is returned from the query.
     """
-    def __init__(self, dbName: str):
+    def __init__(self, dbName: str, resultCache: Optional[ResultCache] = None):
         self.dbName = dbName
-    
-    @contextmanager
-    def _getDbConnection(self):
-        with loadPostgresDatabase(self.dbName) as db:
-            yield db
+        self.resultCache = resultCache
+        self.fetchBatchSize = _getIntEnv("SQL_FETCH_BATCH_SIZE", 10000)
+        self.useArrow = os.environ.get("SQL_RESULT_ARROW", "false").lower() == "true" and pa is not None
+        self.statementTimeoutMs = _getIntEnv("SQL_STATEMENT_TIMEOUT_MS", 30000)
+        self.costGuardEnabled = os.environ.get("SQL_COST_GUARD_ENABLED", "true").lower() == "true"
+        self.maxPlanCost = float(os.environ.get("SQL_MAX_PLAN_COST") or 5000000)
+        self.maxPlanRows = _getIntEnv("SQL_MAX_PLAN_ROWS", 100000)
     
     def _validateSqlQuery(self, query: str) -> bool:
         """
@@ -404,146 +851,168 @@ class QuerySQLTool:
             return False
 
         return True
-    
-    def _getCols(self, sqlQuery: str) -> List[str]:
-        """
-        Extracts column names from an SQL query.
-        
-        Args:
-            sqlQuery (str): The SQL query.
+
+    def _fetchBatches(self, cursor) -> Iterator[List[Tuple[Any, ...]]]:
+        while True:
+            rows = cursor.fetchmany(self.fetchBatchSize)
+            if not rows:
+                return
+            yield rows
         
-        Returns:
-            List[str]: A list of column names.
+    @traced("postgres.explain")
+    def _guardCost(self, cursor, query: str) -> Tuple[str, Optional[Dict[str, float]]]:
         """
-        selectRegex = re.compile(r'select\s+(.+?)\s+from', re.IGNORECASE | re.DOTALL)
-        allMatches = selectRegex.findall(sqlQuery)
-        if not allMatches:
-            return []
-        finalSelect = allMatches[-1]
-        return [col.lower().strip().split(' as ')[-1].split('.')[-1] for col in finalSelect.split(',')]
+        Checks the plan of `query` against the cost and row limits.
 
-    def _parseDecimal(self, match):
-        value = match.group(1)
-        return f"'{Decimal(value)}'"
-
-    def _parseDatetime(self, match):
-        dateArgs = list(map(int, match.group(1).split(',')))
-        if 'tzinfo' in match.group(2):
-            dt = datetime(*dateArgs, tzinfo=timezone.utc)
-        else:
-            dt = datetime(*dateArgs)
-        return f"'{dt.isoformat()}'"
+        Returns:
+            Tuple[str, Optional[Dict[str, float]]]: The query to run (limited to `maxPlanRows` rows
+            when more were estimated) and, if it was limited, its `rowLimit` and `estimatedRows`.
 
-    def _parseDate(self, match):
-        dateArgs = list(map(int, match.group(1).split(',')))
-        dt = date(*dateArgs)
-        return f"'{dt.isoformat()}'"
-    
-    def _customParser(self, resStr: str):
-        resStr = re.sub(
-            r"Decimal\('([^']+)'\)"
-            , self._parseDecimal
-            , resStr
-        )
-        resStr = re.sub(
-            r"datetime\.datetime\(([\d, ]+)(, tzinfo=datetime\.timezone\.utc)?\)"
-            , self._parseDatetime
-            , resStr
-        )
-        resStr = re.sub(
-            r"datetime\.date\(([\d, ]+)\)"
-            , self._parseDate
-            , resStr
-        )
-        return ast.literal_eval(resStr)
-        
-    def executeQuery(self, query: str) -> pd.DataFrame:
+        Raises:
+            QueryTooExpensiveException: If the estimated total cost is over `maxPlanCost`.
+        """
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {query}")
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        root = plan[0]["Plan"]
+        cost, rows = float(root["Total Cost"]), float(root["Plan Rows"])
+        if cost > self.maxPlanCost:
+            logger.warning(f"Rejected query with estimated cost {cost:.0f} and {rows:.0f} rows: {query}")
+            raise QueryTooExpensiveException(hint=(
+                f"The previous query was rejected as too expensive (estimated cost {cost:.3g}, limit {self.maxPlanCost:.3g}; "
+                f"about {rows:.3g} rows). Add filters (e.g. on election year, state or division), aggregate at a coarser "
+                "level, and avoid joins without a join condition."
+            ))
+        if self.maxPlanRows and rows > self.maxPlanRows:
+            logger.warning(f"Limiting query estimated at {rows:.0f} rows to {self.maxPlanRows}")
+            limited = f"SELECT * FROM ({query.strip().rstrip(';')}) AS limited_result LIMIT {self.maxPlanRows}"
+            return limited, {'rowLimit': self.maxPlanRows, 'estimatedRows': rows}
+        return query, None
+
+    @traced("postgres.executeQuery")
+    def executeQuery(self, query: str, useCache: bool = True, cancellation: Optional[QueryCancellation] = None) -> pd.DataFrame:
         """
         Executes an SQL query and return the results as a DataFrame.
         
         Args:
             query (str): The SQL query to execute.
+            useCache (bool, optional): Set to False to skip the result cache lookup; the fresh result is still stored.
+            cancellation (Optional[QueryCancellation]): Lets another thread cancel the query on the server.
         
         Returns:
             pd.DataFrame: The query results as a DataFrame.
         
         Raises:
             InvalidUserQueryException: If the query is invalid or unrelated to the database.
+            QueryTooExpensiveException: If the plan is over the cost limit or the statement timed out.
             NoDataFoundException: If no data is returned from the query.
         """
-        with self._getDbConnection() as db:
-            queryRunner = QuerySQLDataBaseTool(db=db)
-            # query = query.lower().strip()
+        if query == "invalid user query - not related to the database.":
+            raise InvalidUserQueryException("Query is not related to the database schema.")
+        if not self._validateSqlQuery(query):
+            raise InvalidUserQueryException("Invalid SQL query. Possible SQL injection attempt.")
+        ## Taken before the query runs, so a result that straddles a data change or bump is stored under the old key
+        entryKey = self.resultCache.entryKey(query) if self.resultCache is not None else None
+        if useCache and entryKey is not None:
+            with span("sqlResultCache.lookup") as lookupSpan:
+                cached = self.resultCache.get(query, entryKey)
+                lookupSpan.setOutcome("hit" if cached is not None else "miss")
+            if cached is not None:
+                return cached
+
+        engine = getPostgresEngine(self.dbName)
+        connection = engine.raw_connection()
+        limit = None
+        try:
+            if cancellation is not None:
+                cancellation.attach(connection.dbapi_connection)
+            cursor = connection.cursor()
+            try:
+                ## SET LOCAL lasts until the rollback below, so pooled connections keep their default
+                if self.statementTimeoutMs:
+                    cursor.execute(f"SET LOCAL statement_timeout = {int(self.statementTimeoutMs)}")
+                statement = query
+                if self.costGuardEnabled:
+                    statement, limit = self._guardCost(cursor, query)
+                with span("postgres.fetch"):
+                    cursor.execute(statement)
+                    if cursor.description is None:
+                        raise NoDataFoundException("No data fetched from the database")
+                    columns = [column[0] for column in cursor.description]
+                    data = rowsToDataFrame(columns, self._fetchBatches(cursor), useArrow=self.useArrow)
+            finally:
+                cursor.close()
+            connection.rollback()
+        except engine.dialect.dbapi.Error as e:
+            ## 57014 (query_canceled) is raised for both the statement timeout and a cancel request
+            if cancellation is not None and cancellation.cancelled:
+                logger.info(f"Query cancelled: {query}")
+                raise InvalidUserQueryException("Query cancelled.")
+            if getattr(e, "pgcode", None) == "57014":
+                logger.warning(f"Query exceeded the {self.statementTimeoutMs} ms statement timeout: {query}")
+                raise QueryTooExpensiveException(hint=(
+                    f"The previous query ran longer than the {self.statementTimeoutMs / 1000:g}s time limit and was cancelled. "
+                    "Add filters (e.g. on election year, state or division) and aggregate at a coarser level."
+                ))
+            logger.error(f"Error executing query: {e}\nSQL Query: {query}")
+            raise InvalidUserQueryException("Invalid SQL query.")
+        finally:
+            if cancellation is not None:
+                cancellation.detach()
+            connection.close()
 
-            if query == "invalid user query - not related to the database.":
-                raise InvalidUserQueryException("Query is not related to the database schema.")
-            if not self._validateSqlQuery(query):
-                raise InvalidUserQueryException("Invalid SQL query. Possible SQL injection attempt.")
+        if limit is not None:
+            data.attrs.update(limit)
+
+        if data.empty:
+            raise NoDataFoundException("No data fetched from the database")
+        if self.resultCache is not None:
             try:
-                res = queryRunner.invoke(query)
-                if not res:
-                    raise NoDataFoundException("No data fetched from the database")
-                res = self._customParser(res)
-                columns = self._getCols(query)
-                if not columns:
-                    columns = range(len(res[0]))
-                return pd.DataFrame.from_records(data=res, columns=columns)
-            except SyntaxError as e:
-                logger.error(f"Error executing query: {e}\nSQL Query: {query}")
-                raise InvalidUserQueryException("Invalid SQL query.")
+                self.resultCache.set(query, data, entryKey)
             except Exception as e:
-                Data = res if res else 'Can Not Fetch Data'
-                logger.error(f"Error executing query: {e}\nSQL Query: {query}\nData: {Data}")
-                raise
+                logger.warning(f"Could not cache the query result: {str(e)}")
+        return data
+
+## Token counting
+@lru_cache(maxsize=None)
+def _getEncoding(encodingName: str = 'cl100k_base') -> tiktoken.Encoding:
+    """Loads a tiktoken encoding once per process."""
+    return tiktoken.get_encoding(encodingName)
 
-class ChatHistory:
+def countTokens(text: str) -> int:
+    """Counts the cl100k_base tokens in a string."""
+    return len(_getEncoding().encode(text or ""))
+
+def recentMessagesPipeline(chatId: str, tokenLimit: int, chatFilter: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
     """
-    This class manages chat history for users, storing and retrieving data from a MongoDB database.
-    
-    MongoDB Database Structure:
-    - Database: ChatHistoryDB
-    - Collection: <user_id> (Each user has a dedicated collection named after their user_id)
-    - Chat Structure:
-      {
-        "chatId": <str>,             # Unique identifier for the chat session
-        "date": <str>,                # Date the chat was created (YYYY-MM-DD format)
-        "title": <str>,               # Short title for the chat (first 30 characters of the first message)
-        "pinned": <bool>,             # Indicates if the chat is pinned
-        "archived": <bool>,           # Indicates if the chat is archived
-        "lastUpdated": <datetime>,   # Timestamp of the last update to the chat
-        "groupDetails": {
-          "groupName": <str>,        # Name of the group also unique identifier
-          "groupColor": <str>,       # Color of the group (e.g., "red" or "blue")
-        },
-        "messages": [                 # Array of message objects
-          {
-            "messageID": <str>,       # Unique identifier for the message
-            "user": <str>,            # "user" or "bot" to indicate the sender
-            "content": <str>,         # The message content
-            "date": <str>,            # Date the message was sent (YYYY-MM-DD format)
-            "time": <str>             # Time the message was sent (HH:MM:SS format)
-          },
-          ...
-        ],
-        "documents": [                # Array of document objects
-          {
-            "doc_id": <str>,          # Unique identifier for the document
-            "filename": <str>,        # Original filename of the uploaded document
-            "file_type": <str>,       # File type (e.g., "csv" or "pdf")
-            "upload_date": <datetime> # Date and time the document was uploaded
-          },
-          ...
-        ]
-      }
-    
-    Key Features:
-    - Each user's chat history is stored in a separate collection, identified by `user_id`.
-    - Each chat session is represented by a document, identified by `chatId`.
-    - The `messages` field in the document contains an array of chat messages.
-    - The `documents` field contains metadata about uploaded documents.
-    - Actual document files are stored in GridFS.
-    - Supports operations like adding messages, retrieving chat history, pinning/unpinning chats,
-      archiving chats, searching through chat history, uploading documents, and retrieving documents.
+    Aggregation returning the newest messages of a chat whose combined token count fits within `tokenLimit`.
+
+    Uses the `tokens` stored on each message; messages written before token counts were stored
+    fall back to an estimate of one token per four characters until they are backfilled.
+    `chatFilter` replaces the default {"chatId": chatId} match (e.g. to add the userId).
+    """
+    return [
+        {"$match": chatFilter or {"chatId": chatId}},
+        {"$project": {"_id": 0, "messages": 1}},
+        {"$unwind": {"path": "$messages", "includeArrayIndex": "position"}},
+        {"$replaceWith": {"$mergeObjects": ["$messages", {"position": "$position"}]}},
+        {"$setWindowFields": {
+            "sortBy": {"position": -1},
+            "output": {"runningTokens": {
+                "$sum": {"$ifNull": ["$tokens", {"$ceil": {"$divide": [{"$strLenCP": "$content"}, 4]}}]},
+                "window": {"documents": ["unbounded", "current"]}
+            }}
+        }},
+        {"$match": {"runningTokens": {"$lte": tokenLimit}}},
+        {"$sort": {"position": 1}},
+        {"$project": {"position": 0, "runningTokens": 0}}
+    ]
+
+class ChatHistoryBase:
+    """
+    Shared state and storage-independent helpers for `ChatHistory` and `AsyncChatHistory`:
+    message construction, context trimming, document validation and text extraction.
     """
     def __init__(self, userId: str = "defaultUser", chatId: Optional[str] = None):
         self.userId = userId
@@ -553,57 +1022,13 @@ class ChatHistory:
         self.collection = None
         self.fs = None
 
-    @contextmanager
-    def _getDbConnection(self):
-        try:
-            self._connectToDb()
-            yield
-        finally:
-            if self.client:
-                self.client.close()
-
-    def _connectToDb(self) -> None:
-        """Establish connection to MongoDB."""
-        try:
-            mongoUri = os.environ.get("MONGO_URI")
-            dbName = os.environ.get("MONGO_DB_NAME")
-            if not mongoUri or not dbName:
-                raise ChatHistoryError("MongoDB connection details are not set in environment variables")
-
-            self.client = MongoClient(mongoUri)
-            self.db = self.client[dbName]
-            self.collection = self.db[str(self.userId)]
-            self.fs = gridfs.GridFS(self.db)
-        except Exception as e:
-            logger.error(f"Failed to connect to database: {e}")
-            raise ChatHistoryError(f"Database connection error: {str(e)}")
-        
-    def _ensureTextIndex(self) -> None:
-        """Ensures text index exists for message content."""
-        try:
-            indexes = list(self.collection.list_indexes())
-            textIndexExists = any(
-                index['key'] == [('messages.content', 'text')]
-                for index in indexes
-            )
-
-            if not textIndexExists:
-                indexName = "messagesContentTextIndex"
-                fieldsToIndex = [("messages.content", TEXT)]
-                self.collection.create_index(fieldsToIndex, name=indexName)
-            else:
-                logger.info("Text index for messages.content already exists.")
-        except OperationFailure as e:
-            logger.error(f"Failed to create or verify text index: {e}")
-            raise ChatHistoryError(f"Failed to create or verify text index: {str(e)}")
-
     @staticmethod
     def _convertObjectId(data: Any) -> Any:
         """Converts ObjectId to string in nested structures."""
         if isinstance(data, dict):
-            return {key: ChatHistory._convertObjectId(value) for key, value in data.items()}
+            return {key: ChatHistoryBase._convertObjectId(value) for key, value in data.items()}
         elif isinstance(data, list):
-            return [ChatHistory._convertObjectId(item) for item in data]
+            return [ChatHistoryBase._convertObjectId(item) for item in data]
         elif isinstance(data, ObjectId):
             return str(data)
         return data
@@ -657,38 +1082,6 @@ class ChatHistory:
         except Exception as e:
             return False, f"Error reading TXT: {str(e)}"
 
-    def _getDocs(self, chatId: str) -> List[Dict[str, Any]]:
-        """Gets documents associated with a chat."""
-        with self._getDbConnection():
-            chat = self.collection.find_one({"chatId": chatId}, {"documents": 1})
-            return chat.get("documents", []) if chat else []
-
-    def _getDocContent(self, docId: str) -> Tuple[Optional[str], Optional[bytes]]:
-        """Gets content of a document from GridFS."""
-        with self._getDbConnection():
-            try:
-                file = self.fs.get(ObjectId(docId))
-                content = file.read()
-                filename = file.filename
-                return filename, content
-            except gridfs.errors.NoFile:
-                logger.error(f"No file found with id: {docId}")
-                return None, None
-
-    def _prepareDocsForLlm(self, chatId: str) -> str:
-        """Prepares document content for LLM processing."""
-        docs = self._getDocs(chatId)
-        formattedDocs = []
-
-        for doc in docs:
-            filename, content = self._getDocContent(doc['docId'])
-            if filename and content:
-                textContent = self._extractTextContent(doc['fileType'], content, filename)
-                if textContent:
-                    formattedDocs.append(f"Document: {filename}\nContent: {textContent}\n")
-
-        return "\n".join(formattedDocs)
-
     def _extractTextContent(self, fileType: str, content: bytes, filename: str) -> Optional[str]:
         """Extracts text content from different file types."""
         try:
@@ -722,8 +1115,168 @@ class ChatHistory:
     @staticmethod
     def _countTokens(text: str) -> int:
         """Counts the number of tokens in a string."""
-        return len(tiktoken.get_encoding('cl100k_base').encode(text))
+        return countTokens(text)
+
+    @staticmethod
+    def _buildMessage(content: str, isUser: bool = True) -> Message:
+        """Builds a new message document."""
+        now = datetime.now()
+        return {
+            "messageId": str(ObjectId()),
+            "user": "user" if isUser else "bot",
+            "content": content,
+            "date": now.strftime("%Y-%m-%d"),
+            "time": now.strftime("%H:%M:%S"),
+            "tokens": countTokens(content)
+        }
+
+    @staticmethod
+    def _newChatFields(content: str) -> Dict[str, Any]:
+        """Fields set when the first message of a chat creates the chat document."""
+        return {
+            "date": datetime.now().strftime("%Y-%m-%d"),
+            "title": content[:30],
+            "pinned": False,
+            "archived": False,
+            "groupDetails": {
+                "groupName": "Default",
+                "groupColor": "gray"
+            }
+        }
+
+    @staticmethod
+    def _contextTokenLimit() -> int:
+        return int(os.environ.get("CONTEXT_TOKEN_LIMIT", 4096))
+
+@traceMethods("chatHistory")
+class ChatHistory(ChatHistoryBase):
+    """
+    This class manages chat history for users, storing and retrieving data from a MongoDB database.
+    
+    MongoDB Database Structure:
+    - Database: ChatHistoryDB
+    - Collection: <user_id> (Each user has a dedicated collection named after their user_id)
+    - Chat Structure:
+      {
+        "chatId": <str>,             # Unique identifier for the chat session
+        "date": <str>,                # Date the chat was created (YYYY-MM-DD format)
+        "title": <str>,               # Short title for the chat (first 30 characters of the first message)
+        "pinned": <bool>,             # Indicates if the chat is pinned
+        "archived": <bool>,           # Indicates if the chat is archived
+        "lastUpdated": <datetime>,   # Timestamp of the last update to the chat
+        "groupDetails": {
+          "groupName": <str>,        # Name of the group also unique identifier
+          "groupColor": <str>,       # Color of the group (e.g., "red" or "blue")
+        },
+        "messages": [                 # Array of message objects
+          {
+            "messageID": <str>,       # Unique identifier for the message
+            "user": <str>,            # "user" or "bot" to indicate the sender
+            "content": <str>,         # The message content
+            "date": <str>,            # Date the message was sent (YYYY-MM-DD format)
+            "time": <str>             # Time the message was sent (HH:MM:SS format)
+          },
+          ...
+        ],
+        "documents": [                # Array of document objects
+          {
+            "doc_id": <str>,          # Unique identifier for the document
+            "filename": <str>,        # Original filename of the uploaded document
+            "file_type": <str>,       # File type (e.g., "csv" or "pdf")
+            "upload_date": <datetime> # Date and time the document was uploaded
+          },
+          ...
+        ]
+      }
+    
+    Key Features:
+    - Each user's chat history is stored in a separate collection, identified by `user_id`.
+    - Each chat session is represented by a document, identified by `chatId`.
+    - The `messages` field in the document contains an array of chat messages.
+    - The `documents` field contains metadata about uploaded documents.
+    - Actual document files are stored in GridFS.
+    - Instances borrow connections from the process-wide pooled client (`getMongoClient`),
+      so creating a ChatHistory per request is cheap.
+    - Supports operations like adding messages, retrieving chat history, pinning/unpinning chats,
+      archiving chats, searching through chat history, uploading documents, and retrieving documents.
+    - Blocking (pymongo); the API uses `AsyncChatHistory`, which has the same method surface.
+    - Always uses the embedded `messages` layout above; see `BucketedMessageStore` for the bucketed one.
+    - With TELEMETRY_ENABLED=true every public method is timed as a `chatHistory.<method>` span.
+    """
+    @contextmanager
+    def _getDbConnection(self):
+        ## Connections are borrowed from the shared pool; the client itself is closed on app shutdown.
+        if self.client is None:
+            self._connectToDb()
+        yield
+
+    def _connectToDb(self) -> None:
+        """Binds this instance to the shared MongoDB client."""
+        try:
+            mongoUri = os.environ.get("MONGO_URI")
+            dbName = os.environ.get("MONGO_DB_NAME")
+            if not mongoUri or not dbName:
+                raise ChatHistoryError("MongoDB connection details are not set in environment variables")
+
+            self.client = getMongoClient()
+            self.db = self.client[dbName]
+            self.collection = self.db[str(self.userId)]
+            self.fs = gridfs.GridFS(self.db)
+        except Exception as e:
+            logger.error(f"Failed to connect to database: {e}")
+            raise ChatHistoryError(f"Database connection error: {str(e)}")
         
+    def _ensureTextIndex(self) -> None:
+        """Ensures text index exists for message content."""
+        try:
+            indexes = list(self.collection.list_indexes())
+            textIndexExists = any(
+                index['key'] == [('messages.content', 'text')]
+                for index in indexes
+            )
+
+            if not textIndexExists:
+                indexName = "messagesContentTextIndex"
+                fieldsToIndex = [("messages.content", TEXT)]
+                self.collection.create_index(fieldsToIndex, name=indexName)
+            else:
+                logger.info("Text index for messages.content already exists.")
+        except OperationFailure as e:
+            logger.error(f"Failed to create or verify text index: {e}")
+            raise ChatHistoryError(f"Failed to create or verify text index: {str(e)}")
+
+    def _getDocs(self, chatId: str) -> List[Dict[str, Any]]:
+        """Gets documents associated with a chat."""
+        with self._getDbConnection():
+            chat = self.collection.find_one({"chatId": chatId}, {"documents": 1})
+            return chat.get("documents", []) if chat else []
+
+    def _getDocContent(self, docId: str) -> Tuple[Optional[str], Optional[bytes]]:
+        """Gets content of a document from GridFS."""
+        with self._getDbConnection():
+            try:
+                file = self.fs.get(ObjectId(docId))
+                content = file.read()
+                filename = file.filename
+                return filename, content
+            except gridfs.errors.NoFile:
+                logger.error(f"No file found with id: {docId}")
+                return None, None
+
+    def _prepareDocsForLlm(self, chatId: str) -> str:
+        """Prepares document content for LLM processing."""
+        docs = self._getDocs(chatId)
+        formattedDocs = []
+
+        for doc in docs:
+            filename, content = self._getDocContent(doc['docId'])
+            if filename and content:
+                textContent = self._extractTextContent(doc['fileType'], content, filename)
+                if textContent:
+                    formattedDocs.append(f"Document: {filename}\nContent: {textContent}\n")
+
+        return "\n".join(formattedDocs)
+
     def getAllChats(self) -> List[ChatDocument]:
         """Gets all chats for the user."""
         with self._getDbConnection():
@@ -750,28 +1303,14 @@ class ChatHistory:
 
     def getRecentMessages(self, chatId: str) -> List[Message]:
         """Gets recent messages for a specific chat, limited by token count."""
-        tokenLimit = int(os.environ.get("CONTEXT_TOKEN_LIMIT", 4096))
         with self._getDbConnection():
-            chat = self.collection.find_one({"chatId": chatId})
-            
-            if chat and "messages" in chat:
-                messages = chat["messages"]
-                recentMessages = []
-                totalTokens = 0
+            return list(self.collection.aggregate(recentMessagesPipeline(chatId, self._contextTokenLimit())))
 
-                for message in reversed(messages):
-                    messageText = message["content"]
-                    messageTokens = self._countTokens(messageText)
-
-                    if totalTokens + messageTokens > tokenLimit:
-                        break
-                    
-                    recentMessages.append(message)
-                    totalTokens += messageTokens
-
-                return list(reversed(recentMessages))
-            
-            return []
+    def getLatestMessages(self, chatId: str, limit: int) -> List[Message]:
+        """Gets the last `limit` messages of a chat."""
+        with self._getDbConnection():
+            chat = self.collection.find_one({"chatId": chatId}, {"_id": 0, "chatId": 1, "messages": {"$slice": -limit}})
+            return chat["messages"] if chat and "messages" in chat else []
 
     def getDocumentsContext(self, chatId: str) -> str:
         """Gets the context of all documents associated with a chat."""
@@ -803,13 +1342,7 @@ class ChatHistory:
         if not chatId:
             chatId = str(ObjectId())
         
-        message: Message = {
-            "messageId": str(ObjectId()),
-            "user": "user" if isUser else "bot",
-            "content": content,
-            "date": datetime.now().strftime("%Y-%m-%d"),
-            "time": datetime.now().strftime("%H:%M:%S")
-        }
+        message = self._buildMessage(content, isUser)
         
         with self._getDbConnection():
             try:
@@ -817,16 +1350,7 @@ class ChatHistory:
                     {"chatId": chatId},
                     {
                         "$push": {"messages": message},
-                        "$setOnInsert": {
-                            "date": datetime.now().strftime("%Y-%m-%d"),
-                            "title": content[:30],
-                            "pinned": False,
-                            "archived": False,
-                            "groupDetails": {
-                                "groupName": "Default",
-                                "groupColor": "gray"
-                            }
-                        },
+                        "$setOnInsert": self._newChatFields(content),
                         "$set": {"lastUpdated": datetime.now()}
                     },
                     upsert=True
@@ -887,6 +1411,7 @@ class ChatHistory:
                     for i, message in enumerate(chat["messages"]):
                         if message["messageId"] == messageId:
                             message["content"] = newContent
+                            message["tokens"] = self._countTokens(newContent)
                             indexToPrune = i + 1
                             break
 
@@ -1018,6 +1543,772 @@ class ChatHistory:
                 logger.error(f"Error searching chats for term '{term}': {e}")
                 raise ChatHistoryError(f"Failed to search chats: {str(e)}")
 
+## Keyset pagination
+## Chats are listed pinned first, then most recently updated; chatId breaks ties
+chatListSort = [("pinned", DESCENDING), ("lastUpdated", DESCENDING), ("chatId", DESCENDING)]
+chatSummaryFields = ("chatId", "title", "date", "pinned", "archived", "lastUpdated", "groupDetails")
+chatListFields = chatSummaryFields + ("documents",)
+
+def encodeCursor(values: Dict[str, Any]) -> str:
+    """Encodes the sort key of the last item of a page as an opaque URL-safe cursor."""
+    payload = {
+        key: {"$date": value.isoformat()} if isinstance(value, datetime) else value
+        for key, value in values.items()
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decodeCursor(cursor: str, keys: Sequence[str]) -> Dict[str, Any]:
+    """
+    Decodes a cursor made by `encodeCursor`.
+
+    Raises:
+        InvalidCursorError: If the cursor is malformed or does not hold exactly `keys`.
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(payload, dict) or set(payload) != set(keys):
+            raise ValueError("unexpected cursor keys")
+        return {
+            key: datetime.fromisoformat(value["$date"]) if isinstance(value, dict) else value
+            for key, value in payload.items()
+        }
+    except (ValueError, TypeError, KeyError) as e:
+        raise InvalidCursorError(f"Invalid pagination cursor: {str(e)}")
+
+def keysetFilter(keys: Sequence[Tuple[str, Any]]) -> Dict[str, Any]:
+    """
+    Builds the filter for the items after `keys` in a sort that is descending on every key.
+
+    A null/missing value sorts lowest, so it is treated as "less than" any stored value.
+    """
+    clauses = []
+    for i, (field, value) in enumerate(keys):
+        if value is None:
+            continue
+        equalPrefix = {prefixField: prefixValue for prefixField, prefixValue in keys[:i]}
+        clauses.append({**equalPrefix, "$or": [{field: {"$lt": value}}, {field: None}]})
+    return {"$or": clauses} if clauses else {"_id": {"$exists": False}}
+
+## Chat storage for AsyncChatHistory
+sharedChatsCollection = "chats"
+messageBucketsCollection = "messageBuckets"
+
+def _sharedChatStorage() -> bool:
+    return os.environ.get("CHAT_STORAGE_MODE", "perUser").lower() == "shared"
+
+def _bucketedMessageStorage() -> bool:
+    return os.environ.get("CHAT_MESSAGE_STORAGE", "embedded").lower() == "bucketed"
+
+## Indexes of the shared chat collection: point lookup, sidebar listing, archived filter, search
+sharedChatIndexes = [
+    IndexModel([("userId", ASCENDING), ("chatId", ASCENDING)], unique=True, name="userChat"),
+    IndexModel([("userId", ASCENDING)] + chatListSort, name="chatList"),
+    IndexModel([("userId", ASCENDING), ("archived", ASCENDING), ("lastUpdated", DESCENDING)], name="chatArchived"),
+    IndexModel([("userId", ASCENDING), ("messages.content", TEXT)], name="messagesContentTextIndex")
+]
+
+## Indexes of the bucket collection: range reads/truncation by (chat, bucket), point lookup by messageId, search
+messageBucketIndexes = [
+    IndexModel([("userId", ASCENDING), ("chatId", ASCENDING), ("bucket", ASCENDING)], unique=True, name="chatBucket"),
+    IndexModel([("userId", ASCENDING), ("chatId", ASCENDING), ("messages.messageId", ASCENDING)], name="chatMessageId"),
+    IndexModel([("userId", ASCENDING), ("messages.content", TEXT)], name="messagesContentTextIndex")
+]
+
+def recentBucketedMessagesPipeline(userId: str, chatId: str, tokenLimit: int) -> List[Dict[str, Any]]:
+    """
+    Bucketed counterpart of `recentMessagesPipeline`.
+
+    Buckets keep a running `tokens` total, so only the newest buckets that can contribute to the
+    context are unwound.
+    """
+    return [
+        {"$match": {"userId": userId, "chatId": chatId}},
+        {"$setWindowFields": {
+            "sortBy": {"bucket": -1},
+            "output": {"newerTokens": {"$sum": "$tokens", "window": {"documents": ["unbounded", -1]}}}
+        }},
+        {"$match": {"$expr": {"$lt": [{"$ifNull": ["$newerTokens", 0]}, tokenLimit]}}},
+        {"$unwind": "$messages"},
+        {"$replaceWith": "$messages"},
+        {"$setWindowFields": {
+            "sortBy": {"seq": -1},
+            "output": {"runningTokens": {"$sum": "$tokens", "window": {"documents": ["unbounded", "current"]}}}
+        }},
+        {"$match": {"runningTokens": {"$lte": tokenLimit}}},
+        {"$sort": {"seq": 1}},
+        {"$project": {"runningTokens": 0}}
+    ]
+
+async def ensureChatIndexes() -> None:
+    """
+    Creates the indexes of the shared chat collection and the message bucket collection for the
+    configured storage modes. Called once at API startup so no index work happens on the request
+    path; creating an index that already exists is a no-op.
+    """
+    dbName = os.environ.get("MONGO_DB_NAME")
+    if not dbName:
+        raise ChatHistoryError("MongoDB connection details are not set in environment variables")
+    db = getAsyncMongoClient()[dbName]
+    if _sharedChatStorage():
+        await db[sharedChatsCollection].create_indexes(sharedChatIndexes)
+    if _bucketedMessageStorage():
+        await db[messageBucketsCollection].create_indexes(messageBucketIndexes)
+
+class MessageStore:
+    """
+    Base of the message stores: the database, the chat collection and how to address one user's chats.
+
+    Attributes:
+        sharedChats (bool): Chats of all users live in one collection keyed by (userId, chatId)
+            instead of one collection per user.
+    """
+    def __init__(self, db, chats, userId: str, sharedChats: bool = False):
+        self.db = db
+        self.chats = chats
+        self.userId = str(userId)
+        self.sharedChats = sharedChats
+
+    def _userFilter(self) -> Dict[str, Any]:
+        return {"userId": self.userId} if self.sharedChats else {}
+
+    def _chatFilter(self, chatId: str) -> Dict[str, Any]:
+        return {**self._userFilter(), "chatId": chatId}
+
+class EmbeddedMessageStore(MessageStore):
+    """
+    Messages stored as an array inside the chat document (the original `ChatHistory` layout).
+
+    Simple, but a chat is bounded by MongoDB's 16 MB document limit and edits rewrite the array.
+    """
+
+    async def add(self, chatId: str, message: Message, newChatFields: Dict[str, Any]) -> None:
+        await self.chats.update_one(
+            self._chatFilter(chatId),
+            {
+                "$push": {"messages": message},
+                "$setOnInsert": newChatFields,
+                "$set": {"lastUpdated": datetime.now()}
+            },
+            upsert=True
+        )
+
+    async def get(self, chatId: str, messageId: str) -> Optional[Message]:
+        chat = await self.chats.find_one(
+            {**self._chatFilter(chatId), "messages.messageId": messageId},
+            {"messages.$": 1}
+        )
+        return chat["messages"][0] if chat and chat.get("messages") else None
+
+    async def getAll(self, chatId: str) -> List[Message]:
+        chat = await self.chats.find_one(self._chatFilter(chatId), {"messages": 1})
+        return chat.get("messages", []) if chat else []
+
+    async def getRecent(self, chatId: str, tokenLimit: int) -> List[Message]:
+        return await self.chats.aggregate(recentMessagesPipeline(chatId, tokenLimit, self._chatFilter(chatId))).to_list(length=None)
+
+    async def getPage(self, chatId: str, limit: int, beforeSeq: Optional[int] = None) -> List[Message]:
+        ## An embedded message's seq is its array index
+        chat = await self.chats.find_one(self._chatFilter(chatId), {"_id": 0, "total": {"$size": {"$ifNull": ["$messages", []]}}})
+        if not chat:
+            return []
+        end = chat["total"] if beforeSeq is None else min(beforeSeq, chat["total"])
+        start = max(end - limit, 0)
+        if end <= start:
+            return []
+        page = await self.chats.find_one(self._chatFilter(chatId), {"_id": 0, "chatId": 1, "messages": {"$slice": [start, end - start]}})
+        return [{**message, "seq": start + i} for i, message in enumerate(page.get("messages", []))]
+
+    async def update(self, chatId: str, messageId: str, content: str, tokens: int) -> None:
+        chat = await self.chats.find_one(self._chatFilter(chatId), {"messages": 1})
+        if not chat or "messages" not in chat:
+            raise ChatHistoryError(f"No chat found with ID: {chatId}")
+
+        indexToPrune = None
+        for i, message in enumerate(chat["messages"]):
+            if message["messageId"] == messageId:
+                message["content"] = content
+                message["tokens"] = tokens
+                indexToPrune = i + 1
+                break
+        if indexToPrune is None:
+            raise ChatHistoryError(f"No message found with ID: {messageId} in chat: {chatId}")
+
+        await self.chats.update_one(
+            self._chatFilter(chatId),
+            {"$set": {"messages": chat["messages"][:indexToPrune], "lastUpdated": datetime.now()}}
+        )
+
+    async def deleteChat(self, chatId: str) -> None:
+        ## Messages are deleted with the chat document
+        return None
+
+    async def _ensureTextIndex(self) -> None:
+        """Ensures text index exists for message content."""
+        try:
+            indexes = await self.chats.list_indexes().to_list(length=None)
+            textIndexExists = any(
+                index['key'] == [('messages.content', 'text')]
+                for index in indexes
+            )
+
+            if not textIndexExists:
+                indexName = "messagesContentTextIndex"
+                fieldsToIndex = [("messages.content", TEXT)]
+                await self.chats.create_index(fieldsToIndex, name=indexName)
+            else:
+                logger.info("Text index for messages.content already exists.")
+        except OperationFailure as e:
+            logger.error(f"Failed to create or verify text index: {e}")
+            raise ChatHistoryError(f"Failed to create or verify text index: {str(e)}")
+
+    async def search(self, term: str) -> List[Dict[str, Any]]:
+        if not self.sharedChats:
+            await self._ensureTextIndex()
+        return await self.chats.find(
+            {**self._userFilter(), "$text": {"$search": term}},
+            {"score": {"$meta": "textScore"}, "messages": 0}
+        ).sort([("score", {"$meta": "textScore"})]).to_list(length=None)
+
+class BucketedMessageStore(MessageStore):
+    """
+    Messages stored in fixed-size buckets in a shared `messageBuckets` collection.
+
+    Bucket structure:
+      {
+        "userId": <str>, "chatId": <str>,
+        "bucket": <int>,              # seq // bucketSize
+        "count": <int>,               # Messages in the bucket
+        "tokens": <int>,              # Sum of the messages' token counts
+        "messages": [ {<Message fields>, "seq": <int>}, ... ]   # Sorted by seq
+      }
+
+    The chat document keeps `messageCount`, which hands out each message's `seq`. Adding a message
+    is one counter increment plus one `$push`; reads touch only the buckets they need, and editing a
+    message rewrites one bucket and deletes the later ones on the server.
+    """
+    def __init__(self, db, chats, userId: str, bucketSize: int, sharedChats: bool = False):
+        super().__init__(db, chats, userId, sharedChats)
+        self.buckets = db[messageBucketsCollection]
+        self.bucketSize = bucketSize
+
+    def _chatKey(self, chatId: str) -> Dict[str, Any]:
+        return {"userId": self.userId, "chatId": chatId}
+
+    async def add(self, chatId: str, message: Message, newChatFields: Dict[str, Any]) -> None:
+        chat = await self.chats.find_one_and_update(
+            self._chatFilter(chatId),
+            {
+                "$inc": {"messageCount": 1},
+                "$setOnInsert": newChatFields,
+                "$set": {"lastUpdated": datetime.now()}
+            },
+            projection={"messageCount": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        seq = chat["messageCount"] - 1
+        await self.buckets.update_one(
+            {**self._chatKey(chatId), "bucket": seq // self.bucketSize},
+            {
+                "$push": {"messages": {"$each": [{**message, "seq": seq}], "$sort": {"seq": 1}}},
+                "$inc": {"count": 1, "tokens": message["tokens"]}
+            },
+            upsert=True
+        )
+
+    async def get(self, chatId: str, messageId: str) -> Optional[Message]:
+        bucket = await self.buckets.find_one(
+            {**self._chatKey(chatId), "messages.messageId": messageId},
+            {"_id": 0, "messages.$": 1}
+        )
+        return bucket["messages"][0] if bucket and bucket.get("messages") else None
+
+    async def getAll(self, chatId: str) -> List[Message]:
+        buckets = await self.buckets.find(self._chatKey(chatId), {"_id": 0, "messages": 1}).sort("bucket", ASCENDING).to_list(length=None)
+        return [message for bucket in buckets for message in bucket["messages"]]
+
+    async def getRecent(self, chatId: str, tokenLimit: int) -> List[Message]:
+        pipeline = recentBucketedMessagesPipeline(self.userId, chatId, tokenLimit)
+        return await self.buckets.aggregate(pipeline).to_list(length=None)
+
+    async def getPage(self, chatId: str, limit: int, beforeSeq: Optional[int] = None) -> List[Message]:
+        query = self._chatKey(chatId)
+        if beforeSeq is not None:
+            if beforeSeq <= 0:
+                return []
+            query["bucket"] = {"$lte": (beforeSeq - 1) // self.bucketSize}
+        ## Every bucket but the newest is full, so this many buckets always hold the `limit` messages before beforeSeq
+        bucketCount = limit // self.bucketSize + 2
+        buckets = await self.buckets.find(query, {"_id": 0, "messages": 1}).sort("bucket", DESCENDING).limit(bucketCount).to_list(length=None)
+        messages = [
+            message for bucket in reversed(buckets) for message in bucket["messages"]
+            if beforeSeq is None or message["seq"] < beforeSeq
+        ]
+        return messages[-limit:]
+
+    async def update(self, chatId: str, messageId: str, content: str, tokens: int) -> None:
+        message = await self.get(chatId, messageId)
+        if message is None:
+            raise ChatHistoryError(f"No message found with ID: {messageId} in chat: {chatId}")
+        seq = message["seq"]
+        bucket = seq // self.bucketSize
+
+        ## Edit the message and drop everything after it in its bucket, then drop later buckets
+        await self.buckets.update_one(
+            {**self._chatKey(chatId), "bucket": bucket},
+            [
+                {"$set": {"messages": {"$map": {
+                    "input": {"$filter": {"input": "$messages", "cond": {"$lte": ["$$this.seq", seq]}}},
+                    "in": {"$cond": [
+                        {"$eq": ["$$this.messageId", messageId]},
+                        {"$mergeObjects": ["$$this", {"content": {"$literal": content}, "tokens": tokens}]},
+                        "$$this"
+                    ]}
+                }}}},
+                {"$set": {"count": {"$size": "$messages"}, "tokens": {"$sum": "$messages.tokens"}}}
+            ]
+        )
+        await self.buckets.delete_many({**self._chatKey(chatId), "bucket": {"$gt": bucket}})
+        await self.chats.update_one(
+            self._chatFilter(chatId),
+            {"$set": {"messageCount": seq + 1, "lastUpdated": datetime.now()}}
+        )
+
+    async def deleteChat(self, chatId: str) -> None:
+        await self.buckets.delete_many(self._chatKey(chatId))
+
+    async def search(self, term: str) -> List[Dict[str, Any]]:
+        matches = await self.buckets.aggregate([
+            {"$match": {"userId": self.userId, "$text": {"$search": term}}},
+            {"$group": {"_id": "$chatId", "score": {"$max": {"$meta": "textScore"}}}},
+            {"$sort": {"score": -1}}
+        ]).to_list(length=None)
+        scores = {match["_id"]: match["score"] for match in matches}
+        chats = await self.chats.find({**self._userFilter(), "chatId": {"$in": list(scores)}}, {"messages": 0}).to_list(length=None)
+        for chat in chats:
+            chat["score"] = scores[chat["chatId"]]
+        return sorted(chats, key=lambda chat: chat["score"], reverse=True)
+
+@traceMethods("asyncChatHistory")
+class AsyncChatHistory(ChatHistoryBase):
+    """
+    Non-blocking counterpart of `ChatHistory`, built on motor and an async GridFS bucket.
+
+    Uses the same MongoDB layout and exposes the same methods as `ChatHistory`, but every
+    database call is a coroutine so FastAPI handlers never block the event loop. CPU-bound work
+    (document validation, text extraction, token counting) is pushed to worker threads.
+    Instances borrow connections from the shared motor client (`getAsyncMongoClient`).
+
+    Chats live in one collection per user, or with CHAT_STORAGE_MODE=shared in the single `chats`
+    collection keyed by (userId, chatId), whose indexes are created at startup (`ensureChatIndexes`).
+    Existing chats are copied with `python -m aiStuff.migrations migrate-shared`.
+
+    Search uses MongoDB `$text` by default, or the engine selected by CHAT_SEARCH_ENGINE
+    (`chatSearch.py`), which is updated on every add, edit and delete.
+
+    Messages are kept by a message store selected with CHAT_MESSAGE_STORAGE: `embedded` (default,
+    the `ChatHistory` layout) or `bucketed` (`BucketedMessageStore`, buckets of
+    CHAT_MESSAGE_BUCKET_SIZE messages). Existing chats must be moved with
+    `python -m aiStuff.migrations migrate-buckets` before switching to `bucketed`.
+
+    With TELEMETRY_ENABLED=true every public method is timed as an `asyncChatHistory.<method>` span.
+    """
+    _indexedCollections = set()
+
+    def __init__(self, userId: str = "defaultUser", chatId: Optional[str] = None):
+        super().__init__(userId, chatId)
+        self.messageStore = None
+        self.sharedChats = _sharedChatStorage()
+        self.searchEngine = getChatSearchEngine()
+
+    def _userFilter(self) -> Dict[str, Any]:
+        return {"userId": str(self.userId)} if self.sharedChats else {}
+
+    async def _updateSearchIndex(self, operation: str, *args: Any) -> None:
+        """Applies a change to the search engine; failures are logged, the index can be rebuilt with the index-search migration."""
+        if self.searchEngine is None:
+            return
+        try:
+            await getattr(self.searchEngine, operation)(str(self.userId), *args)
+        except Exception as e:
+            logger.error(f"Failed to update the chat search index ({operation}): {e}")
+
+    def _chatFilter(self, chatId: str) -> Dict[str, Any]:
+        return {**self._userFilter(), "chatId": chatId}
+
+    async def _ensureChatIndexes(self) -> None:
+        """Creates the chat listing index on this user's collection, once per process (per-user mode only)."""
+        if self.sharedChats:
+            return
+        if self.collection.name not in AsyncChatHistory._indexedCollections:
+            await self.collection.create_index(chatListSort, name="chatList")
+            AsyncChatHistory._indexedCollections.add(self.collection.name)
+
+    def _connectToDb(self) -> None:
+        """Binds this instance to the shared async MongoDB client."""
+        if self.client is not None:
+            return
+        try:
+            mongoUri = os.environ.get("MONGO_URI")
+            dbName = os.environ.get("MONGO_DB_NAME")
+            if not mongoUri or not dbName:
+                raise ChatHistoryError("MongoDB connection details are not set in environment variables")
+
+            self.client = getAsyncMongoClient()
+            self.db = self.client[dbName]
+            self.collection = self.db[sharedChatsCollection if self.sharedChats else str(self.userId)]
+            self.fs = AsyncIOMotorGridFSBucket(self.db)
+            if _bucketedMessageStorage():
+                bucketSize = int(os.environ.get("CHAT_MESSAGE_BUCKET_SIZE", 50))
+                self.messageStore = BucketedMessageStore(self.db, self.collection, self.userId, bucketSize, self.sharedChats)
+            else:
+                self.messageStore = EmbeddedMessageStore(self.db, self.collection, self.userId, self.sharedChats)
+        except ChatHistoryError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to connect to database: {e}")
+            raise ChatHistoryError(f"Database connection error: {str(e)}")
+
+    async def _getDocs(self, chatId: str) -> List[Dict[str, Any]]:
+        """Gets documents associated with a chat."""
+        self._connectToDb()
+        chat = await self.collection.find_one(self._chatFilter(chatId), {"documents": 1})
+        return chat.get("documents", []) if chat else []
+
+    async def _getDocContent(self, docId: str) -> Tuple[Optional[str], Optional[bytes]]:
+        """Gets content of a document from GridFS."""
+        filename, content, _ = await self.getFileContent(docId)
+        return filename, content
+
+    async def _prepareDocsForLlm(self, chatId: str) -> str:
+        """Prepares document content for LLM processing."""
+        docs = await self._getDocs(chatId)
+        formattedDocs = []
+
+        for doc in docs:
+            filename, content = await self._getDocContent(doc['docId'])
+            if filename and content:
+                textContent = await asyncio.to_thread(self._extractTextContent, doc['fileType'], content, filename)
+                if textContent:
+                    formattedDocs.append(f"Document: {filename}\nContent: {textContent}\n")
+
+        return "\n".join(formattedDocs)
+
+    async def getAllChats(self) -> List[ChatDocument]:
+        """Gets all chats for the user."""
+        self._connectToDb()
+        chats = await self.collection.find(self._userFilter(), {"messages": 0}).to_list(length=None)
+        return [self._convertObjectId(chat) for chat in chats]
+
+    async def getMessage(self, chatId: str, messageId: str) -> Message:
+        """Gets a specific message from a chat."""
+        self._connectToDb()
+        message = await self.messageStore.get(chatId, messageId)
+        if message is not None:
+            return message
+
+        raise ChatHistoryError(f"No message found with ID: {messageId} in chat: {chatId}")
+
+    async def getMessages(self, chatId: str) -> List[Message]:
+        """Gets all messages for a specific chat."""
+        self._connectToDb()
+        return await self.messageStore.getAll(chatId)
+
+    async def getRecentMessages(self, chatId: str) -> List[Message]:
+        """Gets recent messages for a specific chat, limited by token count."""
+        self._connectToDb()
+        return await self.messageStore.getRecent(chatId, self._contextTokenLimit())
+
+    async def getLatestMessages(self, chatId: str, limit: int) -> List[Message]:
+        """Gets the last `limit` messages of a chat."""
+        page = await self.getMessagesPage(chatId, limit)
+        return page["messages"]
+
+    async def getChatsPage(self, limit: int = 50, cursor: Optional[str] = None, fields: Optional[Sequence[str]] = None) -> ChatPage:
+        """
+        Gets one page of the user's chats, pinned first and then most recently updated.
+
+        Args:
+            limit (int): Maximum chats to return.
+            cursor (Optional[str]): `nextCursor` of the previous page; None for the first page.
+            fields (Optional[Sequence[str]]): Chat fields to return (from `chatListFields`); defaults to
+                `chatSummaryFields`, which leaves out the documents list.
+
+        Returns:
+            ChatPage: The chats and the cursor of the next page (None on the last page).
+
+        Raises:
+            InvalidCursorError: If the cursor or a field name is invalid.
+        """
+        fields = tuple(fields or chatSummaryFields)
+        unknownFields = set(fields) - set(chatListFields)
+        if unknownFields:
+            raise InvalidCursorError(f"Unknown chat fields: {', '.join(sorted(unknownFields))}")
+        query = self._userFilter()
+        if cursor:
+            after = decodeCursor(cursor, ("pinned", "lastUpdated", "chatId"))
+            query = {**query, **keysetFilter([(field, after[field]) for field, _ in chatListSort])}
+
+        self._connectToDb()
+        await self._ensureChatIndexes()
+        projection = {"_id": 0, "pinned": 1, "lastUpdated": 1, "chatId": 1, **{field: 1 for field in fields}}
+        chats = await self.collection.find(query, projection).sort(chatListSort).limit(limit + 1).to_list(length=None)
+
+        nextCursor = None
+        if len(chats) > limit:
+            last = chats[limit - 1]
+            nextCursor = encodeCursor({field: last.get(field) for field, _ in chatListSort})
+        return {"chats": [self._convertObjectId(chat) for chat in chats[:limit]], "nextCursor": nextCursor}
+
+    async def getMessagesPage(self, chatId: str, limit: int = 100, cursor: Optional[str] = None) -> MessagePage:
+        """
+        Gets the newest `limit` messages older than `cursor`, oldest first.
+
+        Args:
+            chatId (str): The chat to read.
+            limit (int): Maximum messages to return.
+            cursor (Optional[str]): `nextCursor` of the previous page; None for the newest messages.
+
+        Returns:
+            MessagePage: The messages (each with its `seq`) and the cursor for the older page
+            (None when the first message has been reached).
+
+        Raises:
+            InvalidCursorError: If the cursor is invalid.
+        """
+        beforeSeq = decodeCursor(cursor, ("seq",))["seq"] if cursor else None
+        self._connectToDb()
+        messages = await self.messageStore.getPage(chatId, limit, beforeSeq)
+        nextCursor = encodeCursor({"seq": messages[0]["seq"]}) if messages and messages[0]["seq"] > 0 else None
+        return {"messages": messages, "nextCursor": nextCursor}
+
+    async def getDocumentsContext(self, chatId: str) -> str:
+        """Gets the context of all documents associated with a chat."""
+        return await self._prepareDocsForLlm(chatId)
+
+    async def getUploadedFiles(self, chatId: str) -> List[Dict[str, Any]]:
+        """Gets the list of uploaded files for a specific chat."""
+        self._connectToDb()
+        chat = await self.collection.find_one(self._chatFilter(chatId), {"documents": 1})
+        if chat and "documents" in chat:
+            return self._convertObjectId(chat["documents"])
+        return []
+
+    async def getFileContent(self, docId: str) -> Tuple[Optional[str], Optional[bytes], Optional[str]]:
+        """Gets the content, filename, and content type of a file from GridFS."""
+        self._connectToDb()
+        try:
+            gridOut = await self.fs.open_download_stream(ObjectId(docId))
+            content = await gridOut.read()
+            metadata = gridOut.metadata or {}
+            contentType = metadata.get("contentType") or getattr(gridOut, "content_type", None)
+            return gridOut.filename, content, contentType
+        except gridfs.errors.NoFile:
+            logger.error(f"No file found with id: {docId}")
+            return None, None, None
+
+    async def addMessage(self, chatId: str, content: str, isUser: bool = True) -> str:
+        """Adds a new message to a chat."""
+        if not chatId:
+            chatId = str(ObjectId())
+
+        ## Token counting is CPU-bound on long answers
+        message = await asyncio.to_thread(self._buildMessage, content, isUser)
+
+        self._connectToDb()
+        try:
+            await self.messageStore.add(chatId, message, self._newChatFields(content))
+        except Exception as e:
+            logger.error(f"Error adding message to chat {chatId}: {e}")
+            raise ChatHistoryError(f"Failed to add message: {str(e)}")
+        await self._updateSearchIndex("addMessage", chatId, message["messageId"], content)
+
+        return chatId
+
+    async def updateGroupStatus(self, chatId: str, groupName: str = 'CustomGroup', groupColor: str = 'red') -> None:
+        """Updates the group status of a chat."""
+        self._connectToDb()
+        try:
+            result = await self.collection.update_one(
+                self._chatFilter(chatId),
+                {
+                    "$set": {
+                        "groupDetails": {
+                            "groupName": groupName,
+                            "groupColor": groupColor
+                        },
+                        "lastUpdated": datetime.now()
+                    }
+                }
+            )
+            if result.matched_count == 0:
+                raise ChatHistoryError(f"No chat found with ID: {chatId}")
+        except Exception as e:
+            logger.error(f"Error updating group status for chat {chatId}: {e}")
+            raise ChatHistoryError(f"Failed to update group status: {str(e)}")
+
+    async def updateChatTitle(self, chatId: str, newTitle: str) -> None:
+        """Updates the title of a chat."""
+        self._connectToDb()
+        try:
+            result = await self.collection.update_one(
+                self._chatFilter(chatId),
+                {"$set": {"title": newTitle, "lastUpdated": datetime.now()}}
+            )
+            if result.matched_count == 0:
+                raise ChatHistoryError(f"No chat found with ID: {chatId}")
+        except Exception as e:
+            logger.error(f"Error updating title for chat {chatId}: {e}")
+            raise ChatHistoryError(f"Failed to update chat title: {str(e)}")
+
+    async def updateMessage(self, chatId: str, messageId: str, newContent: str) -> None:
+        """
+        Updates the content of a message with the given messageID.
+        Also updates the chat history of the given chatId: All the messages after this message are discarded (Deleted).
+        """
+        self._connectToDb()
+        try:
+            tokens = await asyncio.to_thread(self._countTokens, newContent)
+            await self.messageStore.update(chatId, messageId, newContent, tokens)
+        except Exception as e:
+            logger.error(f"Error updating message {messageId} in chat {chatId}: {e}")
+            raise ChatHistoryError(f"Failed to update message: {str(e)}")
+        await self._updateSearchIndex("updateMessage", chatId, messageId, newContent)
+
+    async def uploadDoc(self, chatId: str, file: bytes, filename: str, fileType: str) -> str:
+        """Uploads a document and associate it with a chat."""
+        if fileType not in ["csv", "pdf", "txt"]:
+            raise ValueError("Unsupported file type. Only CSV, PDF, and TXT are allowed.")
+
+        isReadable, message = await asyncio.to_thread(self._checkDocumentReadability, file, fileType)
+        if not isReadable:
+            raise ValueError(message)
+
+        self._connectToDb()
+        try:
+            contentType = f"application/{fileType}"
+            gridIn = self.fs.open_upload_stream(filename, metadata={"contentType": contentType})
+            await gridIn.write(file)
+            await gridIn.set("contentType", contentType)
+            await gridIn.close()
+            fileId = gridIn._id
+
+            docInfo = {
+                "docId": str(fileId),
+                "filename": filename,
+                "fileType": fileType,
+                "uploadDate": datetime.now()
+            }
+
+            await self.collection.update_one(
+                self._chatFilter(chatId),
+                {
+                    "$push": {"documents": docInfo},
+                    "$set": {"lastUpdated": datetime.now()}
+                },
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Error uploading document for chat {chatId}: {e}")
+            raise ChatHistoryError(f"Failed to upload document: {str(e)}")
+
+        return str(fileId)
+
+    async def deleteChat(self, chatId: str) -> None:
+        """Delete a chat and its associated documents."""
+        self._connectToDb()
+        try:
+            chat = await self.collection.find_one(self._chatFilter(chatId), {"documents": 1})
+            if chat and "documents" in chat:
+                await asyncio.gather(*(self.fs.delete(ObjectId(doc["docId"])) for doc in chat["documents"]))
+
+            await self.collection.delete_one(self._chatFilter(chatId))
+            await self.messageStore.deleteChat(chatId)
+        except Exception as e:
+            logger.error(f"Error deleting chat {chatId}: {e}")
+            raise ChatHistoryError(f"Failed to delete chat: {str(e)}")
+        await self._updateSearchIndex("deleteChat", chatId)
+
+    async def deleteDocument(self, chatId: str, docId: str) -> None:
+        """Deletes a document from a chat and removes it from GridFS."""
+        self._connectToDb()
+        try:
+            result = await self.collection.update_one(
+                self._chatFilter(chatId),
+                {
+                    "$pull": {"documents": {"docId": docId}},
+                    "$set": {"lastUpdated": datetime.now()}
+                }
+            )
+
+            if result.matched_count == 0:
+                raise ChatHistoryError(f"No chat found with ID: {chatId}")
+
+            if result.modified_count == 0:
+                raise ChatHistoryError(f"No document found with ID: {docId} in chat: {chatId}")
+            await self.fs.delete(ObjectId(docId))
+
+        except Exception as e:
+            logger.error(f"Error deleting document {docId} from chat {chatId}: {e}")
+            raise ChatHistoryError(f"Failed to delete document: {str(e)}")
+
+    async def archiveChat(self, chatId: str) -> None:
+        """Archives a chat."""
+        await self._updateChatStatus(chatId, "archived", True)
+
+    async def unarchiveChat(self, chatId: str) -> None:
+        """Unarchives a chat."""
+        await self._updateChatStatus(chatId, "archived", False)
+
+    async def pinChat(self, chatId: str) -> None:
+        """Pins a chat."""
+        await self._updateChatStatus(chatId, "pinned", True)
+
+    async def unpinChat(self, chatId: str) -> None:
+        """Unpins a chat."""
+        await self._updateChatStatus(chatId, "pinned", False)
+
+    async def _updateChatStatus(self, chatId: str, field: str, value: bool) -> None:
+        """Updates a status field of a chat."""
+        self._connectToDb()
+        try:
+            await self.collection.update_one(
+                self._chatFilter(chatId),
+                {"$set": {field: value}}
+            )
+        except Exception as e:
+            logger.error(f"Error updating {field} status for chat {chatId}: {e}")
+            raise ChatHistoryError(f"Failed to update chat status: {str(e)}")
+
+    async def searchChats(self, term: str, limit: int = 50) -> List[ChatDocument]:
+        """
+        Searches for chats containing a specific term.
+
+        With a search engine configured, chats are ranked by their best BM25 message score, the last
+        word of `term` matches as a prefix, "quoted text" as a phrase, and each chat carries the
+        highlighted `matches` ({messageId, snippet}) that hit.
+        """
+        self._connectToDb()
+        try:
+            if self.searchEngine is None:
+                results = await self.messageStore.search(term)
+                return [self._convertObjectId(result) for result in results]
+
+            hits = await self.searchEngine.search(str(self.userId), term, limit * 5)
+            ranked: Dict[str, Dict[str, Any]] = {}
+            for hit in hits:
+                entry = ranked.setdefault(hit["chatId"], {"score": hit["score"], "matches": []})
+                entry["matches"].append({"messageId": hit["messageId"], "snippet": hit["snippet"]})
+            chatIds = list(ranked)[:limit]
+            chats = await self.collection.find({**self._userFilter(), "chatId": {"$in": chatIds}}, {"messages": 0}).to_list(length=None)
+            for chat in chats:
+                chat.update(ranked[chat["chatId"]])
+            chats.sort(key=lambda chat: chat["score"], reverse=True)
+            return [self._convertObjectId(chat) for chat in chats]
+        except Exception as e:
+            logger.error(f"Error searching chats for term '{term}': {e}")
+            raise ChatHistoryError(f"Failed to search chats: {str(e)}")
+
 class ResourceManager:
     def __init__(self):
         self.client = MongoClient(os.getenv('MONGODB_URI'))
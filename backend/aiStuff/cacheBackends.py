@@ -0,0 +1,567 @@
+## cacheBackends.py
+## Pluggable key/value stores behind the caches in caches.py.
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple, TypedDict
+from urllib.parse import unquote, urlparse
+
+logger = logging.getLogger(__name__)
+
+## Type aliases
+CacheUsage = TypedDict('CacheUsage', {
+    'entries': int,
+    'bytes': int
+})
+
+defaultSqlitePath = os.path.join(os.path.dirname(__file__), '../data/cache.db')
+
+def _expiresAt(ttlSeconds: Optional[float]) -> Optional[float]:
+    ## Wall-clock time, so processes sharing a store agree on expiry
+    return time.time() + ttlSeconds if ttlSeconds is not None else None
+
+class CacheBackend(ABC):
+    """
+    Interface of the pluggable cache stores.
+
+    Values are bytes under string keys, grouped in namespaces (one per cache). `set` takes the
+    entry's TTL and the namespace's limits: once the namespace holds more than `maxEntries` entries
+    or `maxBytes` bytes, its least recently used entries are evicted. Expired entries are never
+    returned.
+    """
+    name = "base"
+
+    @abstractmethod
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    def set(self, namespace: str, key: str, value: bytes, ttlSeconds: Optional[float] = None,
+            maxEntries: Optional[int] = None, maxBytes: Optional[int] = None) -> int:
+        """Stores `value`; returns the number of entries evicted to stay within the limits."""
+        ...
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    def deletePrefix(self, namespace: str, prefix: str = "") -> int:
+        """Deletes the entries whose key starts with `prefix` (all of them for ""); returns how many."""
+        ...
+
+    @abstractmethod
+    def keys(self, namespace: str, prefix: str = "") -> List[str]:
+        ...
+
+    @abstractmethod
+    def usage(self, namespace: str) -> CacheUsage:
+        ...
+
+    def close(self) -> None:
+        return None
+
+class MemoryBackend(CacheBackend):
+    """In-process LRU store: fastest, but every worker process has its own copy and it starts cold."""
+    name = "memory"
+
+    def __init__(self):
+        ## namespace -> key -> (expiresAt, value), least recently used first
+        self._namespaces: Dict[str, "OrderedDict[str, Tuple[Optional[float], bytes]]"] = {}
+        self._bytes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _entries(self, namespace: str) -> "OrderedDict[str, Tuple[Optional[float], bytes]]":
+        if namespace not in self._namespaces:
+            self._namespaces[namespace] = OrderedDict()
+            self._bytes[namespace] = 0
+        return self._namespaces[namespace]
+
+    def _drop(self, namespace: str, key: str) -> None:
+        _, value = self._namespaces[namespace].pop(key)
+        self._bytes[namespace] -= len(value)
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        with self._lock:
+            entries = self._entries(namespace)
+            entry = entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.time():
+                self._drop(namespace, key)
+                return None
+            entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, namespace: str, key: str, value: bytes, ttlSeconds: Optional[float] = None,
+            maxEntries: Optional[int] = None, maxBytes: Optional[int] = None) -> int:
+        evicted = 0
+        with self._lock:
+            entries = self._entries(namespace)
+            if key in entries:
+                self._drop(namespace, key)
+            entries[key] = (_expiresAt(ttlSeconds), value)
+            self._bytes[namespace] += len(value)
+            while len(entries) > 1 and (
+                (maxEntries is not None and len(entries) > maxEntries)
+                or (maxBytes is not None and self._bytes[namespace] > maxBytes)
+            ):
+                self._drop(namespace, next(iter(entries)))
+                evicted += 1
+        return evicted
+
+    def delete(self, namespace: str, key: str) -> bool:
+        with self._lock:
+            if key not in self._entries(namespace):
+                return False
+            self._drop(namespace, key)
+            return True
+
+    def deletePrefix(self, namespace: str, prefix: str = "") -> int:
+        with self._lock:
+            keys = [key for key in self._entries(namespace) if key.startswith(prefix)]
+            for key in keys:
+                self._drop(namespace, key)
+            return len(keys)
+
+    def keys(self, namespace: str, prefix: str = "") -> List[str]:
+        now = time.time()
+        with self._lock:
+            return [
+                key for key, (expiresAt, _) in self._entries(namespace).items()
+                if key.startswith(prefix) and (expiresAt is None or expiresAt >= now)
+            ]
+
+    def usage(self, namespace: str) -> CacheUsage:
+        with self._lock:
+            return {'entries': len(self._entries(namespace)), 'bytes': self._bytes[namespace]}
+
+class SqliteBackend(CacheBackend):
+    """
+    Disk-backed store in a SQLite file (WAL mode) that every worker process on the host shares, and
+    that survives restarts. Recency is tracked per entry, so the namespace limits evict the least
+    recently used entries across all processes; expired entries are purged as they are read and
+    periodically on writes.
+
+    Configuration (read from the environment):
+        CACHE_SQLITE_PATH: Location of the cache file (default backend/data/cache.db).
+    """
+    name = "sqlite"
+    _schema = """
+        CREATE TABLE IF NOT EXISTS cache (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            expiresAt REAL,
+            accessedAt REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS cacheByAccess ON cache (namespace, accessedAt, size);
+    """
+    ## Writes between purges of a namespace's expired entries
+    purgeInterval = 256
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.getenv("CACHE_SQLITE_PATH") or defaultSqlitePath
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.executescript(self._schema)
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _transaction(self, statements: List[Tuple[str, tuple]]) -> List[Any]:
+        """Runs `statements` in one write transaction; returns each statement's row count."""
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                counts = [self._connection.execute(sql, params).rowcount for sql, params in statements]
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+            return counts
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, expiresAt FROM cache WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] < now:
+                self._connection.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+                return None
+            self._connection.execute("UPDATE cache SET accessedAt = ? WHERE namespace = ? AND key = ?", (now, namespace, key))
+            return bytes(row[0])
+
+    def set(self, namespace: str, key: str, value: bytes, ttlSeconds: Optional[float] = None,
+            maxEntries: Optional[int] = None, maxBytes: Optional[int] = None) -> int:
+        now = time.time()
+        statements: List[Tuple[str, tuple]] = [(
+            "INSERT INTO cache (namespace, key, value, size, expiresAt, accessedAt) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, size = excluded.size, "
+            "expiresAt = excluded.expiresAt, accessedAt = excluded.accessedAt",
+            (namespace, key, sqlite3.Binary(value), len(value), _expiresAt(ttlSeconds), now)
+        )]
+        self._writes += 1
+        if self._writes % self.purgeInterval == 0:
+            statements.append(("DELETE FROM cache WHERE namespace = ? AND expiresAt < ?", (namespace, now)))
+        evictions: List[Tuple[str, tuple]] = []
+        if maxEntries is not None:
+            evictions.append((
+                "DELETE FROM cache WHERE namespace = ? AND key IN (SELECT key FROM cache WHERE namespace = ? "
+                "ORDER BY accessedAt DESC LIMIT -1 OFFSET ?)",
+                (namespace, namespace, maxEntries)
+            ))
+        if maxBytes is not None:
+            ## Keeps the most recently used entries whose running total fits; the new entry always stays
+            evictions.append((
+                "DELETE FROM cache WHERE namespace = ? AND key IN (SELECT key FROM (SELECT key, "
+                "SUM(size) OVER (ORDER BY accessedAt DESC, key ROWS UNBOUNDED PRECEDING) AS running "
+                "FROM cache WHERE namespace = ?) WHERE running > ? AND key != ?)",
+                (namespace, namespace, maxBytes, key)
+            ))
+        counts = self._transaction(statements + evictions)
+        return sum(counts[len(statements):])
+
+    def delete(self, namespace: str, key: str) -> bool:
+        return self._transaction([("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))])[0] > 0
+
+    @staticmethod
+    def _prefixRange(prefix: str) -> Tuple[str, str]:
+        ## Keys starting with `prefix` sort between it and it followed by the highest code point
+        return prefix, prefix + "\U0010ffff"
+
+    def deletePrefix(self, namespace: str, prefix: str = "") -> int:
+        low, high = self._prefixRange(prefix)
+        return self._transaction([(
+            "DELETE FROM cache WHERE namespace = ? AND key >= ? AND key < ?", (namespace, low, high)
+        )])[0]
+
+    def keys(self, namespace: str, prefix: str = "") -> List[str]:
+        low, high = self._prefixRange(prefix)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key FROM cache WHERE namespace = ? AND key >= ? AND key < ? AND (expiresAt IS NULL OR expiresAt >= ?)",
+                (namespace, low, high, time.time())
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def usage(self, namespace: str) -> CacheUsage:
+        with self._lock:
+            entries, size = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache WHERE namespace = ?", (namespace,)
+            ).fetchone()
+        return {'entries': entries, 'bytes': size}
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+class RespError(Exception):
+    """An error reply from a Redis-protocol server."""
+
+class RedisBackend(CacheBackend):
+    """
+    Store on a Redis-protocol server (Redis, Valkey, KeyDB, ...) shared by every worker on every
+    host, spoken over a minimal RESP2 client so no client library is needed.
+
+    Keys are `<prefix><namespace>:<key>` and expire through the server's PX expiry. The server
+    evicts by its own `maxmemory-policy` (use allkeys-lru), so the per-namespace limits are not
+    enforced here. After a connection failure the backend reports misses for
+    `CACHE_REDIS_RETRY_SECONDS` rather than blocking every request on the timeout.
+
+    Configuration (read from the environment):
+        CACHE_REDIS_URL: redis://[:password@]host[:port][/db] (default redis://localhost:6379/0).
+        CACHE_REDIS_PREFIX: Prefix of every key (default "elecdata:").
+        CACHE_REDIS_TIMEOUT_SECONDS: Connect and read timeout (default 1).
+        CACHE_REDIS_RETRY_SECONDS: Pause after a connection failure (default 5).
+    """
+    name = "redis"
+    scanCount = 1000
+
+    def __init__(self, url: Optional[str] = None, prefix: Optional[str] = None):
+        parsed = urlparse(url or os.getenv("CACHE_REDIS_URL") or "redis://localhost:6379/0")
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.prefix = prefix if prefix is not None else os.getenv("CACHE_REDIS_PREFIX", "elecdata:")
+        self.timeout = float(os.getenv("CACHE_REDIS_TIMEOUT_SECONDS", 1))
+        self.retrySeconds = float(os.getenv("CACHE_REDIS_RETRY_SECONDS", 5))
+        self._socket: Optional[socket.socket] = None
+        self._reader = None
+        self._lock = threading.Lock()
+        self._downUntil = 0.0
+
+    ## RESP2 protocol
+    @staticmethod
+    def _encode(*args: Any) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    def _readReply(self) -> Any:
+        line = self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by the cache server")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode()
+        if kind == b"-":
+            return RespError(body.decode())
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("Connection closed by the cache server")
+            return data[:-2]
+        if kind == b"*":
+            length = int(body)
+            return None if length < 0 else [self._readReply() for _ in range(length)]
+        raise ConnectionError(f"Unexpected reply from the cache server: {line[:20]!r}")
+
+    def _connect(self) -> None:
+        self._socket = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._socket.makefile("rb")
+        handshake = []
+        if self.password:
+            handshake.append(("AUTH", self.password))
+        if self.db:
+            handshake.append(("SELECT", self.db))
+        for reply in self._roundTrip(handshake):
+            if isinstance(reply, RespError):
+                raise ConnectionError(f"Cache server rejected the handshake: {reply}")
+
+    def _disconnect(self) -> None:
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+        self._socket = None
+        self._reader = None
+
+    def _roundTrip(self, commands: List[tuple]) -> List[Any]:
+        if not commands:
+            return []
+        self._socket.sendall(b"".join(self._encode(*command) for command in commands))
+        return [self._readReply() for _ in commands]
+
+    def _pipeline(self, commands: List[tuple]) -> List[Any]:
+        """Sends `commands` in one round trip (reconnecting once if the connection dropped); returns their replies."""
+        with self._lock:
+            if time.monotonic() < self._downUntil:
+                raise ConnectionError("Cache server unavailable")
+            for attempt in range(2):
+                try:
+                    if self._socket is None:
+                        self._connect()
+                    replies = self._roundTrip(commands)
+                    break
+                except (OSError, ConnectionError) as e:
+                    self._disconnect()
+                    if attempt == 1:
+                        self._downUntil = time.monotonic() + self.retrySeconds
+                        raise ConnectionError(f"Cache server unavailable: {str(e)}")
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def _command(self, *args: Any) -> Any:
+        return self._pipeline([args])[0]
+
+    ## Keys
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}{namespace}:{key}"
+
+    @staticmethod
+    def _escapePattern(text: str) -> str:
+        return "".join("\\" + char if char in "*?[]\\" else char for char in text)
+
+    def _scan(self, namespace: str, prefix: str) -> List[bytes]:
+        pattern = self._escapePattern(self._key(namespace, prefix)) + "*"
+        keys, cursor = [], b"0"
+        while True:
+            cursor, batch = self._command("SCAN", cursor, "MATCH", pattern, "COUNT", self.scanCount)
+            keys.extend(batch)
+            if cursor == b"0":
+                return keys
+
+    ## CacheBackend
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        return self._command("GET", self._key(namespace, key))
+
+    def set(self, namespace: str, key: str, value: bytes, ttlSeconds: Optional[float] = None,
+            maxEntries: Optional[int] = None, maxBytes: Optional[int] = None) -> int:
+        if ttlSeconds is None:
+            self._command("SET", self._key(namespace, key), value)
+        else:
+            self._command("SET", self._key(namespace, key), value, "PX", max(1, int(ttlSeconds * 1000)))
+        return 0
+
+    def delete(self, namespace: str, key: str) -> bool:
+        return self._command("DEL", self._key(namespace, key)) > 0
+
+    def deletePrefix(self, namespace: str, prefix: str = "") -> int:
+        keys = self._scan(namespace, prefix)
+        deleted = 0
+        for start in range(0, len(keys), self.scanCount):
+            deleted += self._command("DEL", *keys[start:start + self.scanCount])
+        return deleted
+
+    def keys(self, namespace: str, prefix: str = "") -> List[str]:
+        offset = len(self._key(namespace, ""))
+        return [key.decode()[offset:] for key in self._scan(namespace, prefix)]
+
+    def usage(self, namespace: str) -> CacheUsage:
+        keys = self._scan(namespace, "")
+        sizes = self._pipeline([("STRLEN", key) for key in keys]) if keys else []
+        return {'entries': len(keys), 'bytes': sum(sizes)}
+
+    def close(self) -> None:
+        with self._lock:
+            self._disconnect()
+
+class CacheNamespace:
+    """
+    One cache's view of a backend: its namespace, default TTL and limits, and hit/miss counters
+    (per process). Backend failures (e.g. an unreachable Redis) are logged and reported as misses,
+    so a cache outage slows requests down instead of failing them.
+
+    Attributes:
+        name (str): The namespace.
+        backend (CacheBackend): The store, the process-wide `getCacheBackend()` by default.
+        ttlSeconds (Optional[float]): Default lifetime of an entry (None keeps it until evicted).
+        maxEntries (Optional[int]): Entries kept before the least recently used is evicted.
+        maxBytes (Optional[int]): Bytes kept before the least recently used entries are evicted.
+    """
+    def __init__(self, name: str, backend: Optional[CacheBackend] = None, ttlSeconds: Optional[float] = 3600,
+                 maxEntries: Optional[int] = None, maxBytes: Optional[int] = None):
+        self.name = name
+        self.backend = backend or getCacheBackend()
+        self.ttlSeconds = ttlSeconds
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def _failed(self, operation: str, e: Exception) -> None:
+        self.errors += 1
+        logger.warning(f"Cache {self.backend.name}/{self.name} {operation} failed: {str(e)}")
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            value = self.backend.get(self.name, key)
+        except Exception as e:
+            self._failed("get", e)
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: bytes, ttlSeconds: Optional[float] = None) -> bool:
+        try:
+            self.evictions += self.backend.set(
+                self.name, key, value, self.ttlSeconds if ttlSeconds is None else ttlSeconds, self.maxEntries, self.maxBytes
+            )
+            return True
+        except Exception as e:
+            self._failed("set", e)
+            return False
+
+    def delete(self, key: str) -> bool:
+        try:
+            return self.backend.delete(self.name, key)
+        except Exception as e:
+            self._failed("delete", e)
+            return False
+
+    def deletePrefix(self, prefix: str = "") -> int:
+        try:
+            return self.backend.deletePrefix(self.name, prefix)
+        except Exception as e:
+            self._failed("delete", e)
+            return 0
+
+    def clear(self) -> int:
+        return self.deletePrefix("")
+
+    def keys(self, prefix: str = "") -> List[str]:
+        try:
+            return self.backend.keys(self.name, prefix)
+        except Exception as e:
+            self._failed("keys", e)
+            return []
+
+    def stats(self) -> Dict[str, Any]:
+        try:
+            usage: Dict[str, Any] = dict(self.backend.usage(self.name))
+        except Exception as e:
+            self._failed("usage", e)
+            usage = {'entries': None, 'bytes': None}
+        lookups = self.hits + self.misses
+        return {
+            **usage,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "errors": self.errors,
+            "backend": self.backend.name,
+        }
+
+cacheBackends = {
+    "memory": MemoryBackend,
+    "sqlite": SqliteBackend,
+    "redis": RedisBackend,
+}
+
+_cacheBackend: Optional[CacheBackend] = None
+_cacheBackendLock = threading.Lock()
+
+def getCacheBackend() -> CacheBackend:
+    """
+    Returns the process-wide cache backend selected by CACHE_BACKEND: `memory` (the default),
+    `sqlite` (shared by the workers on a host) or `redis` (shared by every host).
+    """
+    global _cacheBackend
+    if _cacheBackend is None:
+        with _cacheBackendLock:
+            if _cacheBackend is None:
+                backendName = os.getenv("CACHE_BACKEND", "memory").lower()
+                if backendName not in cacheBackends:
+                    raise ValueError(f"Unknown CACHE_BACKEND: {backendName}")
+                _cacheBackend = cacheBackends[backendName]()
+    return _cacheBackend
+
+def closeCacheBackend() -> None:
+    global _cacheBackend
+    with _cacheBackendLock:
+        if _cacheBackend is not None:
+            _cacheBackend.close()
+            _cacheBackend = None
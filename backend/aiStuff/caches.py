@@ -0,0 +1,468 @@
+## caches.py
+
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, FrozenSet, Hashable, List, Optional, Tuple, TypedDict
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+from .cacheBackends import CacheBackend, CacheNamespace
+from .sqlAnalysis import canonicalSql
+
+if TYPE_CHECKING:
+    ## valueIndex imports agentHelpers, which imports this module
+    from .valueIndex import ValueIndex
+
+## Type aliases
+DistinctValues = TypedDict('DistinctValues', {
+    'values': List[str],
+    'truncated': bool
+})
+
+CachedAnswer = TypedDict('CachedAnswer', {
+    'content': str,
+    'tier': str
+})
+
+## Joins the parts of tuple keys; it cannot appear in questions, SQL or identifiers
+keySeparator = "\x1f"
+
+def cacheKey(key: Hashable) -> str:
+    """The backend key of `key`: a string as is, a tuple's parts joined by `keySeparator`."""
+    if isinstance(key, tuple):
+        return keySeparator.join(str(part) for part in key)
+    return str(key)
+
+class TTLCache:
+    """
+    Cache of JSON values with per-entry expiry and least-recently-used eviction, kept in a
+    namespace of the configured cache backend (`cacheBackends.getCacheBackend`). With the sqlite or
+    redis backend every worker process shares the entries and they survive restarts; values are
+    stored as JSON rather than pickled, so a writable cache file or server cannot run code in the
+    workers. Tuples and sets come back as lists.
+
+    Attributes:
+        maxEntries (int): Entries kept before the least recently used one is evicted.
+        ttlSeconds (float): Default lifetime of an entry.
+        hits (int): Lookups served from the cache.
+        misses (int): Lookups that found nothing (or an expired entry).
+    """
+    def __init__(self, namespace: str, maxEntries: int = 1024, ttlSeconds: float = 3600, backend: Optional[CacheBackend] = None):
+        self.maxEntries = maxEntries
+        self.ttlSeconds = ttlSeconds
+        self._store = CacheNamespace(namespace, backend, ttlSeconds=ttlSeconds, maxEntries=maxEntries)
+
+    @property
+    def hits(self) -> int:
+        return self._store.hits
+
+    @property
+    def misses(self) -> int:
+        return self._store.misses
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        payload = self._store.get(cacheKey(key))
+        if payload is None:
+            return None
+        try:
+            return json.loads(payload)
+        except ValueError:
+            ## Written by an incompatible version of the code
+            self._store.delete(cacheKey(key))
+            return None
+
+    def set(self, key: Hashable, value: Any, ttlSeconds: Optional[float] = None) -> None:
+        self._store.set(cacheKey(key), json.dumps(value).encode(), ttlSeconds)
+
+    def delete(self, key: Hashable) -> bool:
+        return self._store.delete(cacheKey(key))
+
+    def deletePrefix(self, prefix: Tuple[Any, ...]) -> int:
+        """Deletes every entry whose tuple key starts with the parts of `prefix`; returns how many were removed."""
+        return self._store.deletePrefix(cacheKey(prefix) + keySeparator)
+
+    def clear(self) -> int:
+        return self._store.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return self._store.stats()
+
+class DistinctValueCache:
+    """
+    Caches the DISTINCT values of (table, column) pairs used to ground WHERE literals.
+
+    Electoral reference columns rarely change, so values are kept for `ttlSeconds` and at most
+    `maxValues` are stored per column, which also bounds the prompt context built from them.
+    Call `invalidate` after a data load to drop stale entries.
+    """
+    def __init__(self, ttlSeconds: float = 3600, maxValues: int = 200, maxEntries: int = 1024, backend: Optional[CacheBackend] = None):
+        self.maxValues = maxValues
+        self._cache = TTLCache("distinctValues", maxEntries=maxEntries, ttlSeconds=ttlSeconds, backend=backend)
+
+    @staticmethod
+    def _key(table: str, column: str) -> Tuple[str, str]:
+        return table.lower(), column.lower()
+
+    def get(self, table: str, column: str) -> Optional[DistinctValues]:
+        return self._cache.get(self._key(table, column))
+
+    def set(self, table: str, column: str, values: List[Any]) -> DistinctValues:
+        """Stores `values` (capped at `maxValues`) and returns the cached entry."""
+        entry: DistinctValues = {
+            'values': [str(value) for value in values[:self.maxValues]],
+            'truncated': len(values) > self.maxValues
+        }
+        self._cache.set(self._key(table, column), entry)
+        return entry
+
+    def invalidate(self, table: Optional[str] = None, column: Optional[str] = None) -> int:
+        """
+        Drops cached values. With no arguments everything is dropped; with `table` only that
+        table's columns; with both, a single column.
+
+        Returns:
+            int: Number of entries removed.
+        """
+        if table is None:
+            return self._cache.clear()
+        if column is None:
+            return self._cache.deletePrefix((table.lower(),))
+        return int(self._cache.delete(self._key(table, column)))
+
+    def stats(self) -> Dict[str, Any]:
+        return self._cache.stats()
+
+def normalizeQuestion(question: str) -> str:
+    """Case-folds `question`, collapses whitespace and drops trailing punctuation."""
+    return " ".join(question.casefold().split()).rstrip(" ?!.")
+
+class AnswerCache:
+    """
+    Caches workflow answers so repeated questions skip the route/generate/ground/execute/summarize
+    chain.
+
+    The exact tier is keyed on the normalized question, a hash of the trailing `contextLines` lines
+    of the chat history and the data version. The optional semantic tier embeds the question and
+    reuses the answer of the most similar cached question with the same context and data version
+    when the cosine similarity reaches `similarityThreshold` and both questions mention the same
+    entities: the same numbers and the same values found by `valueIndex` (so "Bennelong in 2019"
+    never reuses the answer for 2022, nor "Labor seats in NSW" the one for "Labor seats in VIC").
+    While the value index is not ready the semantic tier is skipped. Semantic entries point at exact
+    entries, so TTL and LRU eviction apply to both tiers.
+
+    Answers and question embeddings are kept in the cache backend ("answers" and "embeddings"
+    namespaces), so with a shared backend every worker serves the others' answers and a question is
+    embedded once. The similarity index itself is per process: it covers the answers this worker
+    stored, or looked up semantically.
+
+    Attributes:
+        dataVersion (Optional[str]): The schema/data version answers are valid for; changing it
+            drops the entries of the previous version.
+        exactHits (int): Lookups served by the exact tier.
+        semanticHits (int): Lookups served by the semantic tier.
+        misses (int): Lookups that found no answer in either tier.
+        bypasses (int): Lookups skipped because the caller asked to bypass the cache.
+    """
+    def __init__(
+        self,
+        ttlSeconds: float = 86400,
+        maxEntries: int = 2048,
+        contextLines: int = 4,
+        embed: Optional[Callable[[str], Awaitable[List[float]]]] = None,
+        similarityThreshold: float = 0.95,
+        backend: Optional[CacheBackend] = None,
+        valueIndex: Optional['ValueIndex'] = None
+    ):
+        self.contextLines = contextLines
+        self.embed = embed
+        self.valueIndex = valueIndex
+        self.similarityThreshold = similarityThreshold
+        self.dataVersion: Optional[str] = None
+        self._answers = TTLCache("answers", maxEntries=maxEntries, ttlSeconds=ttlSeconds, backend=backend)
+        ## Embeddings do not depend on the data, so they outlive answers
+        self._embeddings = CacheNamespace("embeddings", backend, ttlSeconds=7 * 86400, maxEntries=maxEntries * 2)
+        self._vectors: "OrderedDict[Tuple[str, str, str], Tuple[np.ndarray, FrozenSet[str]]]" = OrderedDict()
+        self._maxVectors = maxEntries
+        self._lock = threading.Lock()
+        self.exactHits = 0
+        self.semanticHits = 0
+        self.misses = 0
+        self.bypasses = 0
+
+    def contextHash(self, chatHistory: str) -> str:
+        lines = [line.strip() for line in (chatHistory or "").splitlines() if line.strip()]
+        relevant = lines[-self.contextLines:] if self.contextLines > 0 else []
+        return hashlib.sha1("\n".join(relevant).encode()).hexdigest()
+
+    def _entities(self, question: str) -> Optional[FrozenSet[str]]:
+        """
+        The numbers and indexed values mentioned in the normalised `question`, or None while the
+        value index is loading (the entities could not be compared).
+        """
+        numbers = frozenset(re.findall(r'\d+', question))
+        if self.valueIndex is None:
+            return numbers
+        if not self.valueIndex.ready:
+            return None
+        return numbers | frozenset(mention['value'] for mention in self.valueIndex.findMentions(question))
+
+    def setDataVersion(self, version: str) -> bool:
+        """Records the current schema/data version; returns True (and drops the previous version's entries) if it changed."""
+        with self._lock:
+            if version == self.dataVersion:
+                return False
+            previous = self.dataVersion
+            self.dataVersion = version
+            self._vectors.clear()
+        if previous is None:
+            return False
+        ## Only the old version's answers: with a shared backend other workers may already have stored new ones
+        self._answers.deletePrefix((previous,))
+        return True
+
+    def _key(self, question: str, chatHistory: str) -> Tuple[str, str, str]:
+        return (self.dataVersion or "", self.contextHash(chatHistory), normalizeQuestion(question))
+
+    async def get(self, question: str, chatHistory: str = '') -> Optional[CachedAnswer]:
+        """Returns the cached answer for `question` in this chat context, from the exact then semantic tier."""
+        key = self._key(question, chatHistory)
+        content = self._answers.get(key)
+        if content is not None:
+            self.exactHits += 1
+            return {'content': content, 'tier': 'exact'}
+        entities = self._entities(key[2]) if self.embed is not None else None
+        if entities is None:
+            self.misses += 1
+            return None
+
+        vector = await self._embedding(key[2])
+        with self._lock:
+            candidates = [
+                (candidateKey, candidateVector) for candidateKey, (candidateVector, candidateEntities) in self._vectors.items()
+                if candidateKey[:2] == key[:2] and candidateEntities == entities
+            ]
+        if candidates:
+            similarities = np.stack([candidateVector for _, candidateVector in candidates]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.similarityThreshold:
+                content = self._answers.get(candidates[best][0])
+                if content is not None:
+                    self.semanticHits += 1
+                    return {'content': content, 'tier': 'semantic'}
+                with self._lock:
+                    self._vectors.pop(candidates[best][0], None)
+        self.misses += 1
+        return None
+
+    async def set(self, question: str, chatHistory: str, content: str) -> None:
+        key = self._key(question, chatHistory)
+        self._answers.set(key, content)
+        entities = self._entities(key[2]) if self.embed is not None else None
+        if entities is None:
+            return
+        vector = await self._embedding(key[2])
+        with self._lock:
+            self._vectors[key] = (vector, entities)
+            self._vectors.move_to_end(key)
+            while len(self._vectors) > self._maxVectors:
+                self._vectors.popitem(last=False)
+
+    async def _embedding(self, question: str) -> np.ndarray:
+        """The normalised embedding of `question`, from the embeddings namespace when it was embedded before."""
+        key = hashlib.sha1(question.encode()).hexdigest()
+        cached = self._embeddings.get(key)
+        if cached is not None:
+            return np.frombuffer(cached, dtype=np.float32)
+        vector = np.asarray(await self.embed(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        vector = vector / norm if norm else vector
+        self._embeddings.set(key, vector.tobytes())
+        return vector
+
+    def recordBypass(self) -> None:
+        self.bypasses += 1
+
+    def clear(self) -> None:
+        self._answers.clear()
+        with self._lock:
+            self._vectors.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.exactHits + self.semanticHits
+        lookups = hits + self.misses
+        answers = self._answers.stats()
+        return {
+            "entries": answers["entries"],
+            "bytes": answers["bytes"],
+            "backend": answers["backend"],
+            "exactHits": self.exactHits,
+            "semanticHits": self.semanticHits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "hitRatio": hits / lookups if lookups else 0.0,
+            "semanticEnabled": self.embed is not None,
+            "embeddings": self._embeddings.stats() if self.embed is not None else None,
+            "dataVersion": self.dataVersion,
+        }
+
+## Arrow schema metadata key holding the frame's `attrs` (e.g. the cost guard's `rowLimit`), which
+## `Table.from_pandas` does not carry
+arrowAttrsKey = b'elecdata.attrs'
+
+def serializeFrame(data: pd.DataFrame) -> Optional[bytes]:
+    """
+    Serializes a DataFrame as an Arrow IPC stream; `data.attrs` survive the round trip through
+    `deserializeFrame`. Frames are never pickled, since the payloads may come back from a shared
+    cache file or server.
+
+    Returns:
+        Optional[bytes]: The payload, or None without pyarrow or when the frame does not convert
+            (e.g. duplicate column names or mixed-type object columns).
+    """
+    if pa is None or not data.columns.is_unique:
+        return None
+    try:
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        if data.attrs:
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}), arrowAttrsKey: json.dumps(data.attrs).encode()})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    except (pa.ArrowException, TypeError, ValueError):
+        return None
+
+def deserializeFrame(payload: bytes) -> pd.DataFrame:
+    table = pa.ipc.open_stream(payload).read_all()
+    data = table.to_pandas()
+    attrs = (table.schema.metadata or {}).get(arrowAttrsKey)
+    if attrs is not None:
+        data.attrs.update(json.loads(attrs))
+    return data
+
+## First byte of a stored result; results stored in other formats (pickles written by older
+## versions) are dropped unread
+arrowFrameFormat = b'A'
+
+class ResultCache:
+    """
+    Caches SQL query results so the same query (from any user or chat) runs once per data version.
+
+    Entries are keyed on the canonical form of the SQL (`sqlAnalysis.canonicalSql`: layout, comments
+    and keyword/identifier case do not matter), the data version and the invalidation generation,
+    and stored as Arrow IPC streams
+    (`serializeFrame`) in the "sqlResults" namespace of the cache backend, so every hit returns a
+    fresh DataFrame, the memory held is known exactly and, with a shared backend, every worker
+    reuses the others' results. The least recently used entries are evicted once the payloads
+    exceed `maxBytes`; results larger than `maxEntryBytes`, or that Arrow cannot store, are not
+    cached. Entries expire after `ttlSeconds`. The redis backend does not enforce `maxBytes`: there
+    the server's `maxmemory-policy` (allkeys-lru) does the eviction.
+
+    `setDataVersion` records the version read from the database and drops the previous version's
+    entries when it changes. `bumpVersion` invalidates everything on demand, e.g. straight after an
+    ETL load, by incrementing the generation kept in the backend: one write, after which the older
+    entries are unreachable and age out through the TTL and LRU eviction. Callers take the
+    `entryKey` before running a query and store the result under it, so a query that was running
+    across a bump or a data change cannot store its stale result under the new key.
+
+    Attributes:
+        maxBytes (int): Serialized bytes kept before the least recently used entries are evicted.
+        maxEntryBytes (int): Largest single result that is cached.
+        ttlSeconds (float): Lifetime of an entry.
+        dataVersion (Optional[str]): The data version results are valid for.
+        bumps (int): Times `bumpVersion` was called in this process.
+        skipped (int): Results not cached because they exceeded `maxEntryBytes` or could not be
+            serialized.
+    """
+    def __init__(self, maxBytes: int = 256 * 1024 * 1024, ttlSeconds: float = 3600, maxEntryBytes: Optional[int] = None,
+                 backend: Optional[CacheBackend] = None):
+        self.maxBytes = maxBytes
+        self.maxEntryBytes = maxEntryBytes if maxEntryBytes is not None else maxBytes // 8
+        self.ttlSeconds = ttlSeconds
+        self.dataVersion: Optional[str] = None
+        self.bumps = 0
+        self.skipped = 0
+        self._store = CacheNamespace("sqlResults", backend, ttlSeconds=ttlSeconds, maxBytes=maxBytes)
+        ## Kept apart from the results so the LRU limits never evict it
+        self._generations = CacheNamespace("sqlResultGeneration", backend, ttlSeconds=None)
+        self._seenGeneration = 0
+        self._lock = threading.Lock()
+
+    def generation(self) -> int:
+        """The invalidation generation shared by every worker through the backend (0 until the first bump)."""
+        value = self._generations.get("generation")
+        ## Generations only grow; a failed read (reported as a miss) must not fall back to older entries
+        with self._lock:
+            self._seenGeneration = max(self._seenGeneration, int(value) if value else 0)
+            return self._seenGeneration
+
+    def entryKey(self, sqlQuery: str) -> str:
+        """The key a result of `sqlQuery` is looked up and stored under right now."""
+        digest = hashlib.sha1(canonicalSql(sqlQuery).encode()).hexdigest()
+        return cacheKey((self.dataVersion or "", str(self.generation()), digest))
+
+    def get(self, sqlQuery: str, entryKey: Optional[str] = None) -> Optional[pd.DataFrame]:
+        key = entryKey or self.entryKey(sqlQuery)
+        payload = self._store.get(key)
+        if payload is None:
+            return None
+        if payload[:1] != arrowFrameFormat or pa is None:
+            self._store.delete(key)
+            return None
+        return deserializeFrame(payload[1:])
+
+    def set(self, sqlQuery: str, data: pd.DataFrame, entryKey: Optional[str] = None) -> bool:
+        """Stores the result of `sqlQuery` under `entryKey` (taken before it ran) or the current key; returns False if it cannot be cached."""
+        payload = serializeFrame(data)
+        if payload is None or len(payload) > self.maxEntryBytes:
+            with self._lock:
+                self.skipped += 1
+            return False
+        return self._store.set(entryKey or self.entryKey(sqlQuery), arrowFrameFormat + payload)
+
+    def setDataVersion(self, version: str) -> bool:
+        """Records the current data version; returns True (and drops the previous version's entries) if it changed."""
+        with self._lock:
+            if version == self.dataVersion:
+                return False
+            previous = self.dataVersion
+            self.dataVersion = version
+        if previous is None:
+            return False
+        self._store.deletePrefix(cacheKey((previous,)) + keySeparator)
+        return True
+
+    def bumpVersion(self) -> int:
+        """
+        Invalidates every cached result (in every worker, with a shared backend), e.g. after an ETL
+        load; returns the new generation. Two workers bumping at once may both write the same
+        generation, which still invalidates everything stored before.
+        """
+        generation = self.generation() + 1
+        self._generations.set("generation", str(generation).encode())
+        with self._lock:
+            self.bumps += 1
+        return generation
+
+    def clear(self) -> int:
+        return self._store.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._store.stats(),
+            "maxBytes": self.maxBytes,
+            "skipped": self.skipped,
+            "format": "arrow" if pa is not None else None,
+            "dataVersion": self.dataVersion,
+            "generation": self.generation(),
+            "bumps": self.bumps,
+        }
@@ -0,0 +1,287 @@
+## chatSearch.py
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple, TypedDict
+
+logger = logging.getLogger(__name__)
+
+## Type aliases
+SearchHit = TypedDict('SearchHit', {
+    'chatId': str,
+    'messageId': str,
+    'snippet': str,
+    'score': float
+})
+
+defaultIndexPath = os.path.join(os.path.dirname(__file__), '../data/chatSearch.db')
+
+class ChatSearchEngine(ABC):
+    """
+    Interface of the pluggable chat search engines used by `AsyncChatHistory`.
+
+    Engines are kept up to date incrementally: every stored message is indexed when it is added,
+    an edit replaces the message and drops the later ones (mirroring `updateMessage`), and deleting
+    a chat removes its messages.
+    """
+    @abstractmethod
+    async def addMessage(self, userId: str, chatId: str, messageId: str, content: str) -> None:
+        ...
+
+    @abstractmethod
+    async def updateMessage(self, userId: str, chatId: str, messageId: str, content: str) -> None:
+        ...
+
+    @abstractmethod
+    async def deleteChat(self, userId: str, chatId: str) -> None:
+        ...
+
+    @abstractmethod
+    async def search(self, userId: str, term: str, limit: int = 50) -> List[SearchHit]:
+        ...
+
+    def close(self) -> None:
+        return None
+
+def buildFtsQuery(term: str, prefixLastWord: bool = True) -> Optional[str]:
+    """
+    Turns user input into a safe FTS5 query.
+
+    "Quoted text" becomes a phrase query, other words are ANDed, a trailing `*` makes a word a
+    prefix query and, for search-as-you-type, the last bare word is always a prefix. FTS5 syntax in
+    the input is never interpreted.
+
+    Returns:
+        Optional[str]: The query, or None if `term` holds no searchable words.
+    """
+    parts = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', term):
+        if phrase:
+            words = re.findall(r'\w+', phrase)
+            if words:
+                parts.append(('"' + " ".join(words) + '"', False))
+        else:
+            isPrefix = word.endswith('*')
+            for piece in re.findall(r'\w+', word):
+                parts.append((f'"{piece}"', isPrefix))
+    if not parts:
+        return None
+    if prefixLastWord and not parts[-1][0].count(" "):
+        parts[-1] = (parts[-1][0], True)
+    return " ".join(query + ("*" if isPrefix else "") for query, isPrefix in parts)
+
+def queryTerms(query: str) -> List[Tuple[str, bool]]:
+    """Returns the (casefolded word, isPrefix) pairs of a query built by `buildFtsQuery`."""
+    terms = []
+    for quoted, star in re.findall(r'"([^"]*)"(\*?)', query):
+        words = quoted.split()
+        terms.extend((word.casefold(), bool(star) and index == len(words) - 1) for index, word in enumerate(words))
+    return terms
+
+def highlightSnippet(content: str, terms: List[Tuple[str, bool]], window: int = 12) -> str:
+    """
+    Returns up to `window` words of `content` around the first matching word, with every matching
+    word wrapped in <mark></mark> (the same output as FTS5 `snippet()`).
+    """
+    words = content.split()
+    def matches(word: str) -> bool:
+        folded = "".join(re.findall(r'\w+', word)).casefold()
+        return any(folded == term or (isPrefix and folded.startswith(term)) for term, isPrefix in terms)
+    hits = [index for index, word in enumerate(words) if matches(word)]
+    start = max(0, min(hits[0] - window // 4, len(words) - window)) if hits else 0
+    end = min(len(words), start + window)
+    hits = set(hits)
+    snippet = " ".join(f"<mark>{word}</mark>" if index in hits else word for index, word in enumerate(words[start:end], start))
+    return ("…" if start > 0 else "") + snippet + ("…" if end < len(words) else "")
+
+class SqliteSearchEngine(ChatSearchEngine):
+    """
+    Chat search on an on-disk SQLite FTS5 index with BM25 ranking and highlighted snippets.
+
+    Messages are kept in a `messages` table (rowid order follows insertion, so "messages after X
+    in a chat" is a rowid range) and indexed by an external-content FTS5 table kept in sync by
+    triggers. Each row also carries a per-user token in an indexed column, so a query is the
+    intersection of the user's posting list with the search terms and stays fast however many
+    users share the file.
+
+    Configuration (read from the environment):
+        CHAT_SEARCH_INDEX_PATH: Location of the index file (default backend/data/chatSearch.db).
+    """
+    _schema = """
+        CREATE TABLE IF NOT EXISTS messages (
+            rowid INTEGER PRIMARY KEY,
+            userKey TEXT NOT NULL,
+            userId TEXT NOT NULL,
+            chatId TEXT NOT NULL,
+            messageId TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS messagesByMessageId ON messages (userId, chatId, messageId);
+        CREATE INDEX IF NOT EXISTS messagesByChat ON messages (userId, chatId, rowid);
+        CREATE VIRTUAL TABLE IF NOT EXISTS messagesFts USING fts5(
+            userKey, content,
+            content='messages', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        );
+        CREATE TRIGGER IF NOT EXISTS messagesInsert AFTER INSERT ON messages BEGIN
+            INSERT INTO messagesFts (rowid, userKey, content) VALUES (new.rowid, new.userKey, new.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messagesDelete AFTER DELETE ON messages BEGIN
+            INSERT INTO messagesFts (messagesFts, rowid, userKey, content) VALUES ('delete', old.rowid, old.userKey, old.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messagesUpdate AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messagesFts (messagesFts, rowid, userKey, content) VALUES ('delete', old.rowid, old.userKey, old.content);
+            INSERT INTO messagesFts (rowid, userKey, content) VALUES (new.rowid, new.userKey, new.content);
+        END;
+    """
+
+    _upsertSql = (
+        "INSERT INTO messages (userKey, userId, chatId, messageId, content) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (userId, chatId, messageId) DO UPDATE SET content = excluded.content"
+    )
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.getenv("CHAT_SEARCH_INDEX_PATH") or defaultIndexPath
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.executescript(self._schema)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _userKey(userId: str) -> str:
+        ## A single alphanumeric token, so the tokenizer keeps it whole
+        return "u" + hashlib.sha1(str(userId).encode()).hexdigest()[:20]
+
+    def _execute(self, statements: List[tuple]) -> None:
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, params in statements:
+                    self._connection.execute(sql, params)
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    ## Synchronous operations (also used by the index-search migration)
+    def addMessageSync(self, userId: str, chatId: str, messageId: str, content: str) -> None:
+        self._execute([(
+            self._upsertSql,
+            (self._userKey(userId), str(userId), chatId, messageId, content or "")
+        )])
+
+    def updateMessageSync(self, userId: str, chatId: str, messageId: str, content: str) -> None:
+        userId = str(userId)
+        self._execute([
+            ("DELETE FROM messages WHERE userId = ? AND chatId = ? AND rowid > "
+             "(SELECT rowid FROM messages WHERE userId = ? AND chatId = ? AND messageId = ?)",
+             (userId, chatId, userId, chatId, messageId)),
+            ("UPDATE messages SET content = ? WHERE userId = ? AND chatId = ? AND messageId = ?",
+             (content or "", userId, chatId, messageId))
+        ])
+
+    def deleteChatSync(self, userId: str, chatId: str) -> None:
+        self._execute([("DELETE FROM messages WHERE userId = ? AND chatId = ?", (str(userId), chatId))])
+
+    def replaceChatSync(self, userId: str, chatId: str, messages: List[Dict[str, Any]]) -> None:
+        """Re-indexes a whole chat from its stored messages, in order."""
+        userId = str(userId)
+        userKey = self._userKey(userId)
+        self._execute(
+            [("DELETE FROM messages WHERE userId = ? AND chatId = ?", (userId, chatId))] + [
+                (self._upsertSql,
+                 (userKey, userId, chatId, message["messageId"], message.get("content") or ""))
+                for message in messages
+            ]
+        )
+
+    def searchSync(self, userId: str, term: str, limit: int = 50) -> List[SearchHit]:
+        query = buildFtsQuery(term)
+        if query is None:
+            return []
+        match = f'userKey : "{self._userKey(userId)}" AND content : ({query})'
+        with self._lock:
+            ## bm25 weights: ignore the userKey column, rank on content. Ranking alone is much cheaper
+            ## than ranking with snippet() over every match, so snippets are built for the top rows only
+            ranked = self._connection.execute(
+                "SELECT rowid, bm25(messagesFts, 0.0, 1.0) AS rank FROM messagesFts "
+                "WHERE messagesFts MATCH ? ORDER BY rank LIMIT ?",
+                (match, limit)
+            ).fetchall()
+            if not ranked:
+                return []
+            rows = self._connection.execute(
+                "SELECT rowid, chatId, messageId, content FROM messages "
+                f"WHERE rowid IN ({', '.join('?' * len(ranked))})",
+                [rowid for rowid, _ in ranked]
+            ).fetchall()
+        details = {rowid: (chatId, messageId, content) for rowid, chatId, messageId, content in rows}
+        terms = queryTerms(query)
+        return [
+            {
+                "chatId": details[rowid][0],
+                "messageId": details[rowid][1],
+                "snippet": highlightSnippet(details[rowid][2], terms),
+                "score": -rank
+            }
+            for rowid, rank in ranked if rowid in details
+        ]
+
+    ## Async facade used by AsyncChatHistory
+    async def addMessage(self, userId: str, chatId: str, messageId: str, content: str) -> None:
+        await asyncio.to_thread(self.addMessageSync, userId, chatId, messageId, content)
+
+    async def updateMessage(self, userId: str, chatId: str, messageId: str, content: str) -> None:
+        await asyncio.to_thread(self.updateMessageSync, userId, chatId, messageId, content)
+
+    async def deleteChat(self, userId: str, chatId: str) -> None:
+        await asyncio.to_thread(self.deleteChatSync, userId, chatId)
+
+    async def search(self, userId: str, term: str, limit: int = 50) -> List[SearchHit]:
+        return await asyncio.to_thread(self.searchSync, userId, term, limit)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+searchEngines = {
+    "sqlite": SqliteSearchEngine,
+}
+
+_searchEngine: Optional[ChatSearchEngine] = None
+_searchEngineLock = threading.Lock()
+
+def getChatSearchEngine() -> Optional[ChatSearchEngine]:
+    """
+    Returns the process-wide search engine selected by CHAT_SEARCH_ENGINE, or None for `mongo`
+    (the default), which keeps using MongoDB `$text` search.
+    """
+    global _searchEngine
+    engineName = os.getenv("CHAT_SEARCH_ENGINE", "mongo").lower()
+    if engineName == "mongo":
+        return None
+    if _searchEngine is None:
+        with _searchEngineLock:
+            if _searchEngine is None:
+                if engineName not in searchEngines:
+                    raise ValueError(f"Unknown CHAT_SEARCH_ENGINE: {engineName}")
+                _searchEngine = searchEngines[engineName]()
+    return _searchEngine
+
+def closeChatSearchEngine() -> None:
+    global _searchEngine
+    with _searchEngineLock:
+        if _searchEngine is not None:
+            _searchEngine.close()
+            _searchEngine = None
@@ -1,6 +1,6 @@
 ## CustomAgents.py
 
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, AsyncIterator
 from langchain_core.prompts import PromptTemplate
 from langchain.base_language import BaseLanguageModel
 from langchain.output_parsers import ResponseSchema, StructuredOutputParser
@@ -15,8 +15,7 @@ class SqlExpert:
     def __init__(self, llm: BaseLanguageModel):
         self.llm = llm
 
-    def generateAndRefineQuery(self, userQuery: str, dialect: str, tableInfo: str, chatHistory: str = '') -> str:
-        template = """Given an input question, perform the following steps:
+    _generateAndRefineTemplate = """Given an input question, perform the following steps:
 
         1. Generate a syntactically correct {dialect} SQL query.
         2. Provide feedback on the generated query, suggesting improvements if necessary.
@@ -38,7 +37,7 @@ class SqlExpert:
 
         Chat History: {chatHistory}
         User Query: {userQuery}
-
+        {feedback}
         Respond in the following format:
 
         1. INITIAL SQL QUERY:
@@ -56,9 +55,18 @@ class SqlExpert:
         Each section should be separated by the delimiter: -----
         """
 
-        response = self._invokeChain(template, userQuery=userQuery, dialect=dialect, tableInfo=tableInfo, chatHistory=chatHistory)
+    @staticmethod
+    def _feedbackSection(feedback: str) -> str:
+        """Formats feedback on a rejected earlier query (e.g. too expensive) for the prompt."""
+        return f"Feedback on a previous attempt (the final query MUST address it): {feedback}\n" if feedback else ""
+
+    def generateAndRefineQuery(self, userQuery: str, dialect: str, tableInfo: str, chatHistory: str = '', feedback: str = '') -> str:
+        response = self._invokeChain(self._generateAndRefineTemplate, userQuery=userQuery, dialect=dialect, tableInfo=tableInfo, chatHistory=chatHistory, feedback=self._feedbackSection(feedback))
         return response
 
+    async def generateAndRefineQueryAsync(self, userQuery: str, dialect: str, tableInfo: str, chatHistory: str = '', feedback: str = '') -> str:
+        return await self._invokeChainAsync(self._generateAndRefineTemplate, userQuery=userQuery, dialect=dialect, tableInfo=tableInfo, chatHistory=chatHistory, feedback=self._feedbackSection(feedback))
+
     def _invokeChain(self, template: str, **kwargs: Any) -> str:
         try:
             prompt = PromptTemplate.from_template(template)
@@ -67,32 +75,15 @@ class SqlExpert:
         except Exception as e:
             raise RuntimeError(f"Error invoking language model: {str(e)}")
 
-    def extractWhereColumns(self, sqlQuery: str) -> List[Dict[str, str]]:
-        template = """Given the following SQL query:
-        {sqlQuery}
-        
-        Extract the distinct column names and their corresponding table names used in the WHERE clause.
-        Use column that are hardcoded for filtering.
-
-        example:
-        SELECT * FROM table1 WHERE column1 = 'value1' AND column2 IN (SELECT column3 FROM table2 WHERE column4 = 'value2');
-        Here, we want to extract column1 and column4 but not column2.
-
-        Respond in the following JSON format:
-        [
-            {{
-                "table": "table_name",
-                "column": "column_name"
-            }},
-            ...
-        ]
-        """
-        
-        response = self._invokeChain(template, sqlQuery=sqlQuery)
-        return response
+    async def _invokeChainAsync(self, template: str, **kwargs: Any) -> str:
+        try:
+            prompt = PromptTemplate.from_template(template)
+            chain = prompt | self.llm
+            return (await chain.ainvoke(kwargs)).content.strip()
+        except Exception as e:
+            raise RuntimeError(f"Error invoking language model: {str(e)}")
 
-    def updateWhereConditions(self, originalQuery: str, userQuery: str, context: str) -> str:
-        template = """Given the following information:
+    _updateWhereConditionsTemplate = """Given the following information:
         
         Original SQL Query:
         {originalQuery}
@@ -109,17 +100,23 @@ class SqlExpert:
         
         Updated SQL Query:
         """
-        
-        response = self._invokeChain(template, originalQuery=originalQuery, userQuery=userQuery, context=context)
+
+    def updateWhereConditions(self, originalQuery: str, userQuery: str, context: str) -> str:
+        response = self._invokeChain(self._updateWhereConditionsTemplate, originalQuery=originalQuery, userQuery=userQuery, context=context)
+        return response.strip()
+
+    async def updateWhereConditionsAsync(self, originalQuery: str, userQuery: str, context: str) -> str:
+        response = await self._invokeChainAsync(self._updateWhereConditionsTemplate, originalQuery=originalQuery, userQuery=userQuery, context=context)
         return response.strip()
 
 ## Using Self - Refelction
 class ResponseSummarizer:
+    updatedSummaryMarker = "3. UPDATED SUMMARY:"
+
     def __init__(self, llm: BaseLanguageModel):
         self.llm = llm
 
-    def generateSummaryWithReflection(self, response: str, userQuery: str) -> str:
-        template = """Given a user query and a response, perform the following steps:
+    _summaryWithReflectionTemplate = """Given a user query and a response, perform the following steps:
 
         1. Generate a concise summary of the response.
         2. Reflect on this summary and provide feedback for improvement.
@@ -143,9 +140,52 @@ class ResponseSummarizer:
         Do not add the delimiter at the end of the response it should be placed between the sections.
         """
 
-        result = self._invokeLlm(template, response=response, userQuery=userQuery)
+    def generateSummaryWithReflection(self, response: str, userQuery: str) -> str:
+        result = self._invokeLlm(self._summaryWithReflectionTemplate, response=response, userQuery=userQuery)
         return result
 
+    async def generateSummaryWithReflectionAsync(self, response: str, userQuery: str) -> str:
+        return await self._invokeLlmAsync(self._summaryWithReflectionTemplate, response=response, userQuery=userQuery)
+
+    async def streamSummaryWithReflection(self, response: str, userQuery: str) -> AsyncIterator[str]:
+        """
+        Streams the same reflective summary as `generateSummaryWithReflection`, but yields only the text
+        of the final (UPDATED SUMMARY) section as it is produced; the initial summary and the reflection
+        are consumed silently. Code fences (```) are removed as `cleanSummaryResponse` removes them, so
+        the streamed text is the text that gets stored; backticks that may start a fence split across
+        chunks are held back until the next chunk.
+
+        Raises:
+            RuntimeError: If the model call fails or the output has no UPDATED SUMMARY section.
+        """
+        prompt = PromptTemplate.from_template(self._summaryWithReflectionTemplate)
+        chain = prompt | self.llm
+        buffer = ""
+        inSummary = False
+        pending = ""
+        try:
+            async for chunk in chain.astream({"response": response, "userQuery": userQuery}):
+                if inSummary:
+                    pending += chunk.content
+                else:
+                    buffer += chunk.content
+                    markerIndex = buffer.find(self.updatedSummaryMarker)
+                    if markerIndex == -1:
+                        continue
+                    inSummary = True
+                    pending = buffer[markerIndex + len(self.updatedSummaryMarker):].lstrip()
+                pending = pending.replace("```", "")
+                held = min(len(pending) - len(pending.rstrip("`")), 2)
+                text, pending = pending[:len(pending) - held], pending[len(pending) - held:]
+                if text:
+                    yield text
+        except Exception as e:
+            raise RuntimeError(f"Error invoking language model: {str(e)}")
+        if not inSummary:
+            raise RuntimeError("Language model response did not contain an updated summary.")
+        if pending:
+            yield pending
+
     def _invokeLlm(self, template: str, **kwargs: Any) -> str:
         try:
             prompt = PromptTemplate.from_template(template)
@@ -154,12 +194,19 @@ class ResponseSummarizer:
         except Exception as e:
             raise RuntimeError(f"Error invoking language model: {str(e)}")
 
+    async def _invokeLlmAsync(self, template: str, **kwargs: Any) -> str:
+        try:
+            prompt = PromptTemplate.from_template(template)
+            chain = prompt | self.llm
+            return (await chain.ainvoke(kwargs)).content.strip()
+        except Exception as e:
+            raise RuntimeError(f"Error invoking language model: {str(e)}")
+
 class ChatAgent:
     def __init__(self, llm: BaseLanguageModel):
         self.llm = llm
 
-    def generateResponse(self, userQuery: str, chatHistory: str = '') -> str:
-        template = """You are an AI assistant specializing in electoral data and general conversation.
+    _responseTemplate = """You are an AI assistant specializing in electoral data and general conversation.
 
         Chat History: {chatHistory}
         User Query: {userQuery}
@@ -169,16 +216,28 @@ class ChatAgent:
         Response:
         """
 
-        prompt = PromptTemplate.from_template(template)
+    def generateResponse(self, userQuery: str, chatHistory: str = '') -> str:
+        prompt = PromptTemplate.from_template(self._responseTemplate)
         chain = prompt | self.llm
         return chain.invoke({"userQuery": userQuery, "chatHistory": chatHistory}).content.strip()
 
+    async def generateResponseAsync(self, userQuery: str, chatHistory: str = '') -> str:
+        prompt = PromptTemplate.from_template(self._responseTemplate)
+        chain = prompt | self.llm
+        return (await chain.ainvoke({"userQuery": userQuery, "chatHistory": chatHistory})).content.strip()
+
+    async def streamResponse(self, userQuery: str, chatHistory: str = '') -> AsyncIterator[str]:
+        prompt = PromptTemplate.from_template(self._responseTemplate)
+        chain = prompt | self.llm
+        async for chunk in chain.astream({"userQuery": userQuery, "chatHistory": chatHistory}):
+            if chunk.content:
+                yield chunk.content
+
 class RouterAgent:
     def __init__(self, llm: BaseLanguageModel):
         self.llm = llm
 
-    def determineQueryType(self, userQuery: str, chatHistory: str = '') -> str:
-        template = """Determine whether the following user query requires a database query or a general conversation response. You have connection to a database with electoral data.
+    _queryTypeTemplate = """Determine whether the following user query requires a database query or a general conversation response. You have connection to a database with electoral data.
 
         Chat History: {chatHistory}
         User Query: {userQuery}
@@ -189,10 +248,16 @@ class RouterAgent:
         Query Type:
         """
 
-        prompt = PromptTemplate.from_template(template)
+    def determineQueryType(self, userQuery: str, chatHistory: str = '') -> str:
+        prompt = PromptTemplate.from_template(self._queryTypeTemplate)
         chain = prompt | self.llm
         return chain.invoke({"userQuery": userQuery, "chatHistory": chatHistory}).content.strip()
 
+    async def determineQueryTypeAsync(self, userQuery: str, chatHistory: str = '') -> str:
+        prompt = PromptTemplate.from_template(self._queryTypeTemplate)
+        chain = prompt | self.llm
+        return (await chain.ainvoke({"userQuery": userQuery, "chatHistory": chatHistory})).content.strip()
+
 class DatasetRegionMatcherAgent:
     def __init__(self, llm: BaseLanguageModel):
         self.llm = llm
@@ -255,13 +320,22 @@ class DatasetRegionMatcherAgent:
             return result
         except Exception as e:
             raise RuntimeError(f"Error processing LLM output: {str(e)}")
+
+    async def matchAsync(self, userQuery, regionsMetadata, datasetsMetadata):
+        try:
+            return await self.chain.ainvoke({
+                "regions_metadata": regionsMetadata,
+                "datasets_metadata": datasetsMetadata,
+                "user_query": userQuery
+            })
+        except Exception as e:
+            raise RuntimeError(f"Error processing LLM output: {str(e)}")
         
 class AnalystAgent:
     def __init__(self, llm):
         self.llm = llm
 
-    def generateAnalysis(self, userQuery: str, dataframes_info: List[Dict[str, str]]) -> str:
-        template = """You are a data analysis expert. Analyze the datasets based on the user query and provide only executable Python code as your response.
+    _analysisTemplate = """You are a data analysis expert. Analyze the datasets based on the user query and provide only executable Python code as your response.
 
         Context:
         - User query: {userQuery}
@@ -284,6 +358,13 @@ class AnalystAgent:
 
         Python Code:
         """
-        prompt = PromptTemplate.from_template(template)
+
+    def generateAnalysis(self, userQuery: str, dataframes_info: List[Dict[str, str]]) -> str:
+        prompt = PromptTemplate.from_template(self._analysisTemplate)
+        chain = prompt | self.llm
+        return chain.invoke({"userQuery": userQuery, "dataframes_overview": dataframes_info})
+
+    async def generateAnalysisAsync(self, userQuery: str, dataframes_info: List[Dict[str, str]]) -> str:
+        prompt = PromptTemplate.from_template(self._analysisTemplate)
         chain = prompt | self.llm
-        return chain.invoke({"userQuery": userQuery, "dataframes_overview": dataframes_info})
\ No newline at end of file
+        return await chain.ainvoke({"userQuery": userQuery, "dataframes_overview": dataframes_info})
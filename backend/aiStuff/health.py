@@ -0,0 +1,199 @@
+## health.py
+## Dependency checks and warm-up behind the API's /healthz and /readyz endpoints.
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypedDict
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import text
+
+from .agentHelpers import getAsyncMongoClient, getPostgresEngine
+
+logger = logging.getLogger(__name__)
+
+## Type aliases
+## status: ok | error | starting | disabled
+DependencyStatus = TypedDict('DependencyStatus', {
+    'status': str,
+    'latencyMs': Optional[float],
+    'detail': Optional[str]
+})
+
+dependencyNames = ("mongo", "postgres", "vectorDb", "llm")
+
+def _status(status: str, latencyMs: Optional[float] = None, detail: Optional[str] = None) -> DependencyStatus:
+    return {'status': status, 'latencyMs': round(latencyMs, 1) if latencyMs is not None else None, 'detail': detail}
+
+def requiredDependencies() -> List[str]:
+    """Dependencies that must be healthy for /readyz to pass (READINESS_REQUIRED_DEPENDENCIES)."""
+    configured = os.getenv("READINESS_REQUIRED_DEPENDENCIES", "mongo,postgres,llm")
+    return [name.strip() for name in configured.split(",") if name.strip() in dependencyNames]
+
+_vectorDbEngine: Optional[Engine] = None
+_vectorDbLock = threading.Lock()
+
+def _getVectorDbEngine() -> Optional[Engine]:
+    """A one-connection engine for pinging the vector database, or None when it is not configured."""
+    global _vectorDbEngine
+    connectionString = os.getenv("VECTORDB_CONNECTION_STRING")
+    if not connectionString:
+        return None
+    with _vectorDbLock:
+        if _vectorDbEngine is None:
+            _vectorDbEngine = create_engine(connectionString, pool_size=1, max_overflow=0, pool_pre_ping=True)
+        return _vectorDbEngine
+
+def _selectOne(engine: Engine) -> None:
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        connection.rollback()
+
+async def _timed(check: Callable[[], Awaitable[Any]], timeout: float) -> DependencyStatus:
+    startedAt = time.perf_counter()
+    try:
+        detail = await asyncio.wait_for(check(), timeout)
+    except asyncio.TimeoutError:
+        return _status("error", (time.perf_counter() - startedAt) * 1000, f"Timed out after {timeout:g}s")
+    except Exception as e:
+        return _status("error", (time.perf_counter() - startedAt) * 1000, str(e))
+    return _status("ok", (time.perf_counter() - startedAt) * 1000, detail)
+
+async def checkMongo(timeout: float) -> DependencyStatus:
+    async def ping() -> None:
+        await getAsyncMongoClient().admin.command("ping")
+    return await _timed(ping, timeout)
+
+async def checkPostgres(dbName: Optional[str], timeout: float) -> DependencyStatus:
+    if not dbName:
+        return _status("error", detail="ELECDATA_DB_NAME is not set")
+    return await _timed(lambda: asyncio.to_thread(_selectOne, getPostgresEngine(dbName)), timeout)
+
+async def checkVectorDb(timeout: float) -> DependencyStatus:
+    engine = _getVectorDbEngine()
+    if engine is None:
+        return _status("disabled", detail="VECTORDB_CONNECTION_STRING is not set")
+    return await _timed(lambda: asyncio.to_thread(_selectOne, engine), timeout)
+
+## The last model probe (a real call, so it is rate limited) and the task running the next one
+_llmProbe: Dict[str, Any] = {"result": None, "checkedAt": None, "task": None}
+
+async def _invokeLlm(workflow: Any) -> str:
+    await workflow.llm.ainvoke("Reply with OK.")
+    model = getattr(workflow.llm, "model_name", None) or getattr(workflow.llm, "model", None)
+    return f"{type(workflow.llm).__name__} {model or ''}".strip()
+
+def _recordLlmProbe(result: DependencyStatus) -> None:
+    _llmProbe["result"] = result
+    _llmProbe["checkedAt"] = time.monotonic()
+
+async def _probeLlm(workflow: Any) -> None:
+    _recordLlmProbe(await _timed(lambda: _invokeLlm(workflow), float(os.getenv("LLM_CHECK_TIMEOUT_SECONDS", 20))))
+
+def checkLlm(workflow: Any, startupError: Optional[str] = None) -> DependencyStatus:
+    """
+    The result of the last model call (one short prompt, bounded by LLM_CHECK_TIMEOUT_SECONDS,
+    default 20). A new call starts in the background once the last one is LLM_CHECK_INTERVAL_SECONDS
+    (default 300) old, so probes neither wait on the model nor run up its costs; `starting` until
+    the first call (or the WARMUP_LLM warm-up step) has finished.
+    """
+    if workflow is None:
+        return _status("error", detail=startupError) if startupError else _status("starting", detail="Workflow not initialised")
+    checkedAt, task = _llmProbe["checkedAt"], _llmProbe["task"]
+    stale = checkedAt is None or time.monotonic() - checkedAt >= float(os.getenv("LLM_CHECK_INTERVAL_SECONDS", 300))
+    if stale and (task is None or task.done()):
+        _llmProbe["task"] = asyncio.create_task(_probeLlm(workflow))
+    return _llmProbe["result"] or _status("starting", detail="Model probe running")
+
+async def checkDependencies(workflow: Any, startupError: Optional[str] = None, timeout: Optional[float] = None) -> Dict[str, DependencyStatus]:
+    """
+    Checks every dependency concurrently, each bounded by `timeout` (READINESS_CHECK_TIMEOUT_SECONDS,
+    default 2).
+    """
+    timeout = timeout if timeout is not None else float(os.getenv("READINESS_CHECK_TIMEOUT_SECONDS", 2))
+    mongo, postgres, vectorDb = await asyncio.gather(
+        checkMongo(timeout),
+        checkPostgres(os.getenv("ELECDATA_DB_NAME"), timeout),
+        checkVectorDb(timeout)
+    )
+    return {"mongo": mongo, "postgres": postgres, "vectorDb": vectorDb, "llm": checkLlm(workflow, startupError)}
+
+def warmPostgresPool(dbName: str, connections: int) -> int:
+    """Opens up to `connections` pooled connections at once and returns them to the pool."""
+    engine = getPostgresEngine(dbName)
+    opened = []
+    try:
+        for _ in range(connections):
+            connection = engine.connect()
+            opened.append(connection)
+            connection.execute(text("SELECT 1"))
+    finally:
+        for connection in opened:
+            connection.rollback()
+            connection.close()
+    return len(opened)
+
+async def warmUp(workflow: Any) -> Dict[str, Any]:
+    """
+    Primes the pools and caches before the app reports ready: fills the Postgres pool, pings
+    MongoDB, waits for the schema and the value index, and (with WARMUP_LLM=true) sends the model
+    one short prompt so its HTTP connection is open.
+
+    Every step is best-effort and bounded by WARMUP_TIMEOUT_SECONDS (default 60); failures are
+    logged and reported, not raised.
+
+    Returns:
+        Dict[str, Any]: Per-step status and timing.
+    """
+    timeout = float(os.getenv("WARMUP_TIMEOUT_SECONDS", 60))
+
+    async def postgres() -> str:
+        opened = await asyncio.to_thread(warmPostgresPool, workflow.dbName, int(os.getenv("POSTGRES_POOL_SIZE", 5)))
+        return f"{opened} connections"
+
+    async def mongo() -> None:
+        await getAsyncMongoClient().admin.command("ping")
+
+    async def schema() -> None:
+        if not await asyncio.to_thread(workflow.schemaSnapshot.ready.wait, timeout):
+            raise RuntimeError("Schema not reflected yet")
+
+    async def valueIndex() -> None:
+        if not workflow.valueIndex.enabled:
+            return
+        deadline = time.monotonic() + timeout
+        while not workflow.valueIndex.ready:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Value index not built yet")
+            await asyncio.sleep(0.25)
+
+    async def llm() -> str:
+        return await _invokeLlm(workflow)
+
+    steps: Dict[str, Callable[[], Awaitable[Any]]] = {"postgres": postgres, "mongo": mongo, "schema": schema, "valueIndex": valueIndex}
+    if os.getenv("WARMUP_LLM", "false").lower() == "true":
+        steps["llm"] = llm
+    results = await asyncio.gather(*(_timed(step, timeout) for step in steps.values()))
+    report = dict(zip(steps, results))
+    if "llm" in report:
+        _recordLlmProbe(report["llm"])
+    for name, result in report.items():
+        if result['status'] != "ok":
+            logger.warning(f"Warm-up step {name} failed: {result['detail']}")
+    summary = ", ".join(f"{name}={result['status']}" for name, result in report.items())
+    logger.info(f"Warm-up finished: {summary}")
+    return report
+
+def closeHealthChecks() -> None:
+    global _vectorDbEngine
+    if _llmProbe["task"] is not None:
+        _llmProbe["task"].cancel()
+        _llmProbe["task"] = None
+    with _vectorDbLock:
+        if _vectorDbEngine is not None:
+            _vectorDbEngine.dispose()
+            _vectorDbEngine = None
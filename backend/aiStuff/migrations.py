@@ -0,0 +1,284 @@
+## migrations.py
+## One-off data migrations for the chat history database.
+## Usage (from /backend): python -m aiStuff.migrations <migration> [--batch-size N] [--dry-run]
+
+import argparse
+import logging
+import os
+from typing import Any, Dict, Iterator, List
+
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.database import Database
+
+from .chatSearch import getChatSearchEngine, closeChatSearchEngine
+from .agentHelpers import (
+    countTokens
+    , getMongoClient
+    , closeMongoClient
+    , messageBucketsCollection
+    , messageBucketIndexes
+    , sharedChatsCollection
+    , sharedChatIndexes
+)
+
+logger = logging.getLogger(__name__)
+
+def _chatDatabase() -> Database:
+    dbName = os.environ.get("MONGO_DB_NAME")
+    if not dbName:
+        raise RuntimeError("MONGO_DB_NAME is not set")
+    return getMongoClient()[dbName]
+
+def _chatCollections(db: Database, includeShared: bool = True) -> Iterator[str]:
+    """
+    Yields the collections holding chat documents: one per user, plus the shared chat collection
+    unless `includeShared` is False. GridFS, system and bucket collections are skipped.
+    """
+    for name in db.list_collection_names():
+        if name.startswith("fs.") or name.startswith("system.") or name == messageBucketsCollection:
+            continue
+        if name == sharedChatsCollection and not includeShared:
+            continue
+        yield name
+
+def backfillMessageTokens(batchSize: int = 500, dryRun: bool = False) -> Dict[str, int]:
+    """
+    Stores a `tokens` count on every chat message that does not have one yet.
+
+    Messages are updated in place by messageId (array filters), so the migration can run while the
+    API is serving traffic and can be re-run safely.
+
+    Args:
+        batchSize (int): Message updates sent per bulk write.
+        dryRun (bool): Count the messages that would be updated without writing.
+
+    Returns:
+        Dict[str, int]: Chats and messages updated.
+    """
+    db = _chatDatabase()
+    totals = {"chats": 0, "messages": 0}
+
+    for collectionName in _chatCollections(db):
+        collection = db[collectionName]
+        pending: List[UpdateOne] = []
+        cursor = collection.find(
+            {"chatId": {"$exists": True}, "messages": {"$elemMatch": {"tokens": {"$exists": False}}}},
+            {"chatId": 1, "messages": 1}
+        )
+        for chat in cursor:
+            totals["chats"] += 1
+            for message in chat.get("messages", []):
+                if "tokens" in message:
+                    continue
+                totals["messages"] += 1
+                pending.append(UpdateOne(
+                    {"_id": chat["_id"]},
+                    {"$set": {"messages.$[message].tokens": countTokens(message.get("content", ""))}},
+                    array_filters=[{"message.messageId": message["messageId"], "message.tokens": {"$exists": False}}]
+                ))
+                if len(pending) >= batchSize:
+                    _flush(collection, pending, dryRun)
+        _flush(collection, pending, dryRun)
+
+    logger.info(f"Token backfill {'(dry run) ' if dryRun else ''}updated {totals['messages']} messages in {totals['chats']} chats")
+    return totals
+
+def migrateMessagesToBuckets(batchSize: int = 500, dryRun: bool = False) -> Dict[str, int]:
+    """
+    Moves embedded `messages` arrays into the `messageBuckets` collection used when
+    CHAT_MESSAGE_STORAGE=bucketed.
+
+    For each chat the buckets are written first (replacing any left by an interrupted run), then the
+    array is removed and `messageCount` set, guarded on the array size so a chat that received a new
+    message meanwhile is skipped and picked up by the next run. Run it before switching the API to
+    bucketed storage, while no messages are being written; re-running is safe.
+
+    Args:
+        batchSize (int): Chats read per batch from each collection.
+        dryRun (bool): Count the chats and messages that would be moved without writing.
+
+    Returns:
+        Dict[str, int]: Chats and messages moved, and chats skipped because they changed.
+    """
+    db = _chatDatabase()
+    bucketSize = int(os.environ.get("CHAT_MESSAGE_BUCKET_SIZE", 50))
+    buckets = db[messageBucketsCollection]
+    if not dryRun:
+        buckets.create_indexes(messageBucketIndexes)
+    totals = {"chats": 0, "messages": 0, "skipped": 0}
+
+    for collectionName in _chatCollections(db):
+        collection = db[collectionName]
+        cursor = collection.find(
+            {"chatId": {"$exists": True}, "messages": {"$exists": True}},
+            {"chatId": 1, "userId": 1, "messages": 1},
+            batch_size=batchSize
+        )
+        for chat in cursor:
+            messages = chat.get("messages") or []
+            bucketDocs: Dict[int, Dict[str, Any]] = {}
+            for seq, message in enumerate(messages):
+                message = {**message, "seq": seq}
+                message.setdefault("tokens", countTokens(message.get("content", "")))
+                bucket = bucketDocs.setdefault(seq // bucketSize, {
+                    "userId": chat.get("userId", collectionName),
+                    "chatId": chat["chatId"],
+                    "bucket": seq // bucketSize,
+                    "count": 0,
+                    "tokens": 0,
+                    "messages": []
+                })
+                bucket["messages"].append(message)
+                bucket["count"] += 1
+                bucket["tokens"] += message["tokens"]
+
+            if dryRun:
+                totals["chats"] += 1
+                totals["messages"] += len(messages)
+                continue
+
+            if bucketDocs:
+                buckets.bulk_write([
+                    ReplaceOne({"userId": doc["userId"], "chatId": doc["chatId"], "bucket": doc["bucket"]}, doc, upsert=True)
+                    for doc in bucketDocs.values()
+                ], ordered=False)
+            result = collection.update_one(
+                {"_id": chat["_id"], "messages": {"$size": len(messages)}},
+                {"$set": {"messageCount": len(messages)}, "$unset": {"messages": ""}}
+            )
+            if result.modified_count:
+                totals["chats"] += 1
+                totals["messages"] += len(messages)
+            else:
+                totals["skipped"] += 1
+                logger.warning(f"Chat {chat['chatId']} of {collectionName} changed during migration; re-run to move it")
+
+    logger.info(f"Bucket migration {'(dry run) ' if dryRun else ''}moved {totals['messages']} messages in {totals['chats']} chats, skipped {totals['skipped']}")
+    return totals
+
+def migrateChatsToSharedCollection(batchSize: int = 500, dryRun: bool = False) -> Dict[str, int]:
+    """
+    Copies the per-user chat collections into the shared `chats` collection used when
+    CHAT_STORAGE_MODE=shared, adding `userId` to every chat.
+
+    Runs online: chats are copied in batches while the API keeps serving from the per-user
+    collections, and a chat already in the shared collection is only replaced when its source has a
+    newer `lastUpdated`. Run it once, switch CHAT_STORAGE_MODE to shared, then run it again to pick
+    up chats written before the switch; the per-user collections are left in place. Pin and archive
+    changes do not touch `lastUpdated`, so ones made between the two runs are not re-copied.
+
+    Args:
+        batchSize (int): Chats copied per bulk write.
+        dryRun (bool): Count the chats that would be copied without writing.
+
+    Returns:
+        Dict[str, int]: Collections read, and chats copied or already up to date.
+    """
+    db = _chatDatabase()
+    shared = db[sharedChatsCollection]
+    if not dryRun:
+        shared.create_indexes(sharedChatIndexes)
+    totals = {"collections": 0, "copied": 0, "upToDate": 0}
+
+    def copyBatch(userId: str, chats: List[Dict[str, Any]]) -> None:
+        existing = {
+            chat["chatId"]: chat.get("lastUpdated")
+            for chat in shared.find({"userId": userId, "chatId": {"$in": [chat["chatId"] for chat in chats]}}, {"chatId": 1, "lastUpdated": 1})
+        }
+        writes = []
+        for chat in chats:
+            if chat["chatId"] in existing:
+                source, target = chat.get("lastUpdated"), existing[chat["chatId"]]
+                if source is None or (target is not None and source <= target):
+                    totals["upToDate"] += 1
+                    continue
+            document = {key: value for key, value in chat.items() if key != "_id"}
+            document["userId"] = userId
+            writes.append(ReplaceOne({"userId": userId, "chatId": chat["chatId"]}, document, upsert=True))
+        totals["copied"] += len(writes)
+        if writes and not dryRun:
+            shared.bulk_write(writes, ordered=False)
+
+    for collectionName in _chatCollections(db, includeShared=False):
+        totals["collections"] += 1
+        batch: List[Dict[str, Any]] = []
+        for chat in db[collectionName].find({"chatId": {"$exists": True}}, batch_size=batchSize).sort("_id", 1):
+            batch.append(chat)
+            if len(batch) >= batchSize:
+                copyBatch(collectionName, batch)
+                batch = []
+        if batch:
+            copyBatch(collectionName, batch)
+
+    logger.info(f"Shared collection migration {'(dry run) ' if dryRun else ''}copied {totals['copied']} chats from {totals['collections']} collections, {totals['upToDate']} already up to date")
+    return totals
+
+def indexChatSearch(batchSize: int = 500, dryRun: bool = False) -> Dict[str, int]:
+    """
+    (Re)builds the CHAT_SEARCH_ENGINE index from the stored chats, embedded or bucketed.
+
+    Each chat is re-indexed as a whole, so the migration is safe to re-run, e.g. after the index file
+    was lost or an incremental update failed.
+
+    Args:
+        batchSize (int): Chats read per batch from each collection.
+        dryRun (bool): Count the chats and messages that would be indexed without writing.
+
+    Returns:
+        Dict[str, int]: Chats and messages indexed.
+    """
+    engine = getChatSearchEngine()
+    if engine is None:
+        raise RuntimeError("CHAT_SEARCH_ENGINE is not set to an indexing engine")
+    db = _chatDatabase()
+    buckets = db[messageBucketsCollection]
+    totals = {"chats": 0, "messages": 0}
+
+    for collectionName in _chatCollections(db):
+        for chat in db[collectionName].find({"chatId": {"$exists": True}}, {"chatId": 1, "userId": 1, "messages": 1}, batch_size=batchSize):
+            userId = chat.get("userId", collectionName)
+            if "messages" in chat:
+                messages = chat["messages"]
+            else:
+                messages = [
+                    message
+                    for bucket in buckets.find({"userId": userId, "chatId": chat["chatId"]}, {"messages": 1}).sort("bucket", 1)
+                    for message in bucket["messages"]
+                ]
+            totals["chats"] += 1
+            totals["messages"] += len(messages)
+            if not dryRun:
+                engine.replaceChatSync(userId, chat["chatId"], messages)
+
+    logger.info(f"Search index {'(dry run) ' if dryRun else ''}built for {totals['messages']} messages in {totals['chats']} chats")
+    return totals
+
+def _flush(collection, pending: List[UpdateOne], dryRun: bool) -> None:
+    if pending and not dryRun:
+        collection.bulk_write(pending, ordered=False)
+    pending.clear()
+
+migrations = {
+    "backfill-tokens": backfillMessageTokens,
+    "migrate-buckets": migrateMessagesToBuckets,
+    "migrate-shared": migrateChatsToSharedCollection,
+    "index-search": indexChatSearch,
+}
+
+def main(argv: Any = None) -> None:
+    parser = argparse.ArgumentParser(description="Chat history data migrations")
+    parser.add_argument("migration", choices=sorted(migrations))
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        result = migrations[args.migration](batchSize=args.batch_size, dryRun=args.dry_run)
+        print(result)
+    finally:
+        closeMongoClient()
+        closeChatSearchEngine()
+
+if __name__ == "__main__":
+    main()
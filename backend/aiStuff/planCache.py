@@ -0,0 +1,360 @@
+## planCache.py
+## Question -> SQL plan cache. Hit-rate report over the request log (from /backend):
+##   python -m aiStuff.planCache report [--log PATH] [--top N]
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, FrozenSet, Iterator, List, Optional, Tuple, TypedDict
+
+import sqlparse
+from sqlparse.tokens import Number, String
+
+from .caches import TTLCache, normalizeQuestion
+from .sqlAnalysis import quoteLiteral, unquoteLiteral
+from .valueIndex import ValueIndex
+
+logger = logging.getLogger(__name__)
+
+## Type aliases
+## One entity of a question: an indexed stored value or a number
+PlanParameter = TypedDict('PlanParameter', {
+    'start': int,
+    'end': int,
+    'kind': str,
+    'label': str,
+    'value': str
+})
+
+CachedPlan = TypedDict('CachedPlan', {
+    'template': str,
+    'sql': str,
+    'parameters': List[Dict[str, str]]
+})
+
+defaultLogPath = os.path.join(os.path.dirname(__file__), '../data/planCacheRequests.jsonl')
+
+## Marker substituted for a bound literal in a stored SQL template
+_markerPattern = re.compile(r'__plan_param_(\d+)__')
+## Questions with more entities than this are only looked up fully templated
+maxSubsetParameters = 6
+
+## The parameter labels of a template in order, e.g. ("divisions.name", "number")
+Signature = Tuple[str, ...]
+
+def _marker(index: int) -> str:
+    return f"__plan_param_{index}__"
+
+class PlanCache:
+    """
+    Caches validated SQL plans under a canonical question template so a repeated intent with
+    different entities ("who won Bennelong in 2022" / "who won Kooyong in 2019") reuses the SQL
+    with the literals re-bound instead of calling `SqlExpert`.
+
+    Entities are the value-index values mentioned in the question (seats, parties, ...) and the
+    numbers in it (years, counts). A plan is stored after its SQL ran successfully: each SQL
+    literal equal to a question entity becomes a parameter, and the template is the normalised
+    question with those entities replaced by their column (or `{number}`). Entities that did not
+    end up in the SQL stay literal words of the template. Plans whose other entity literals appear
+    in the chat history are not stored, since the SQL then depends on earlier messages.
+
+    Plans are kept in the "plans" namespace of the cache backend, so a shared backend lets every
+    worker reuse them. Next to them, one entry per schema lists the signatures (parameter labels in
+    order) of the stored templates, so a lookup reads that entry and only tries the entity subsets
+    that match a stored signature: usually one or two backend reads instead of one per subset.
+    Every lookup and store is appended to a JSONL request log (`PLAN_CACHE_LOG_PATH`) that
+    `python -m aiStuff.planCache report` summarises.
+
+    Attributes:
+        schemaVersion (Optional[str]): The schema the plans were written against; changing it
+            drops the plans of the previous schema.
+    """
+    def __init__(
+        self,
+        valueIndex: ValueIndex,
+        ttlSeconds: float = 7 * 86400,
+        maxEntries: int = 4096,
+        logPath: Optional[str] = None
+    ):
+        self.valueIndex = valueIndex
+        self.schemaVersion: Optional[str] = None
+        self.logPath = logPath
+        self._plans = TTLCache("plans", maxEntries=maxEntries, ttlSeconds=ttlSeconds)
+        self._signatureIndex = TTLCache("planSignatures", maxEntries=64, ttlSeconds=ttlSeconds)
+        ## Signatures stored by this process, merged into the shared entry in case a concurrent store overwrote it
+        self._storedSignatures: set = set()
+        self._signatureLock = threading.Lock()
+        self._logLock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.uncacheable = 0
+        self.fallbacks = 0
+
+    def setSchemaVersion(self, version: str) -> bool:
+        """Records the current schema version; returns True (and drops the plans of the previous one) if it changed."""
+        if version == self.schemaVersion:
+            return False
+        previous = self.schemaVersion
+        self.schemaVersion = version
+        with self._signatureLock:
+            self._storedSignatures.clear()
+        if previous is None:
+            return False
+        self._plans.deletePrefix((previous,))
+        self._signatureIndex.deletePrefix((previous,))
+        return True
+
+    def parameters(self, question: str) -> Tuple[str, List[PlanParameter]]:
+        """Returns the normalised question and its entities (indexed values and numbers) in order."""
+        normalised = normalizeQuestion(question)
+        parameters: List[PlanParameter] = [
+            {
+                'start': mention['start'],
+                'end': mention['end'],
+                'kind': 'value',
+                'label': "|".join(f"{table}.{column}" for table, column in mention['columns']),
+                'value': mention['value']
+            }
+            for mention in (self.valueIndex.findMentions(normalised) if self.valueIndex.ready else [])
+        ]
+        taken = [(parameter['start'], parameter['end']) for parameter in parameters]
+        for match in re.finditer(r'\b\d+\b', normalised):
+            if not any(start <= match.start() < end for start, end in taken):
+                parameters.append({
+                    'start': match.start(),
+                    'end': match.end(),
+                    'kind': 'number',
+                    'label': 'number',
+                    'value': match.group()
+                })
+        return normalised, sorted(parameters, key=lambda parameter: parameter['start'])
+
+    @staticmethod
+    def template(normalised: str, parameters: List[PlanParameter]) -> str:
+        """Replaces `parameters` in the normalised question with their labels."""
+        template, position = "", 0
+        for parameter in parameters:
+            template += normalised[position:parameter['start']] + "{" + parameter['label'] + "}"
+            position = parameter['end']
+        return template + normalised[position:]
+
+    def _signatures(self) -> FrozenSet[Signature]:
+        """The signatures of the templates stored under the current schema, by any worker."""
+        shared = self._signatureIndex.get((self.schemaVersion, "signatures")) or []
+        with self._signatureLock:
+            return frozenset(tuple(signature) for signature in shared) | frozenset(self._storedSignatures)
+
+    def _addSignature(self, signature: Signature) -> None:
+        """Records `signature` in the shared entry (rewritten on every store, which also renews its TTL)."""
+        key = (self.schemaVersion, "signatures")
+        with self._signatureLock:
+            self._storedSignatures.add(signature)
+            ## Stored as a JSON list of label lists
+            stored = frozenset(tuple(signature) for signature in self._signatureIndex.get(key) or [])
+            self._signatureIndex.set(key, sorted(stored | self._storedSignatures))
+
+    def _candidates(self, normalised: str, parameters: List[PlanParameter]) -> Iterator[Tuple[str, List[PlanParameter]]]:
+        """
+        Yields the templates a stored plan for the question could be under, with their parameters,
+        skipping the entity subsets whose signature no stored template has.
+
+        Templates with the most parameters come first, since entities that were not SQL literals
+        when the plan was stored stay words of its template.
+        """
+        signatures = self._signatures()
+        if not signatures:
+            return
+        if len(parameters) > maxSubsetParameters:
+            subsets = [tuple(parameters)]
+        else:
+            subsets = [
+                subset for size in range(len(parameters), 0, -1)
+                for subset in itertools.combinations(parameters, size)
+            ]
+        for subset in subsets:
+            if tuple(parameter['label'] for parameter in subset) in signatures:
+                yield self.template(normalised, list(subset)), list(subset)
+
+    def _find(self, normalised: str, parameters: List[PlanParameter]) -> Optional[Tuple[str, List[PlanParameter], CachedPlan]]:
+        """The first stored plan among the candidates, with its template and bound parameters."""
+        for template, subset in self._candidates(normalised, parameters):
+            plan = self._plans.get((self.schemaVersion, template))
+            if plan is not None:
+                return template, subset, plan
+        return None
+
+    def lookup(self, question: str) -> Optional[str]:
+        """Returns cached SQL for `question` with its entities bound, or None."""
+        normalised, parameters = self.parameters(question)
+        found = self._find(normalised, parameters)
+        if found is None:
+            self.misses += 1
+            self._log("miss", question, self.template(normalised, parameters))
+            return None
+        template, subset, plan = found
+        self.hits += 1
+        self._log("hit", question, template)
+        return self._bind(plan, subset)
+
+    @staticmethod
+    def _bind(plan: CachedPlan, parameters: List[PlanParameter]) -> str:
+        def replace(match: "re.Match[str]") -> str:
+            slot = plan['parameters'][int(match.group(1))]
+            value = parameters[slot['position']]['value']
+            return value if slot['type'] == 'number' else quoteLiteral(value)
+        return _markerPattern.sub(replace, plan['sql'])
+
+    def store(self, question: str, sqlQuery: str, chatHistory: str = '') -> bool:
+        """
+        Stores `sqlQuery` (already grounded and successfully executed) as the plan for `question`.
+
+        Returns:
+            bool: Whether a plan was stored.
+        """
+        parsed = sqlparse.parse(sqlQuery)
+        if len(parsed) != 1 or _markerPattern.search(sqlQuery):
+            return self._uncacheable(question, "notSingleStatement")
+        normalised, parameters = self.parameters(question)
+        history = normalizeQuestion(chatHistory)
+
+        slots: List[Dict[str, Any]] = []
+        used = set()
+        for token in parsed[0].flatten():
+            if token.ttype in String.Single:
+                literal = unquoteLiteral(token.value)
+                slotType = 'string'
+            elif token.ttype in Number.Integer:
+                literal = token.value
+                slotType = 'number'
+            else:
+                continue
+            folded = normalizeQuestion(literal)
+            position = next((
+                index for index, parameter in enumerate(parameters)
+                if folded and folded == normalizeQuestion(parameter['value'])
+            ), None)
+            if position is None:
+                ## A literal the question does not contain but the chat history does came from context
+                if history and folded and re.search(r'(?<!\w)' + re.escape(folded) + r'(?!\w)', history):
+                    return self._uncacheable(question, "literalFromHistory", literal)
+                continue
+            token.value = _marker(len(slots))
+            slots.append({'position': position, 'type': slotType})
+            used.add(position)
+
+        if not slots:
+            return self._uncacheable(question, "noEntityInSql")
+        boundParameters = [parameter for index, parameter in enumerate(parameters) if index in used]
+        positions = {id(parameter): index for index, parameter in enumerate(boundParameters)}
+        plan: CachedPlan = {
+            'template': self.template(normalised, boundParameters),
+            'sql': str(parsed[0]),
+            'parameters': [
+                {'position': positions[id(parameters[slot['position']])], 'type': slot['type']}
+                for slot in slots
+            ]
+        }
+        self._plans.set((self.schemaVersion, plan['template']), plan)
+        self._addSignature(tuple(parameter['label'] for parameter in boundParameters))
+        self.stored += 1
+        self._log("stored", question, plan['template'])
+        return True
+
+    def invalidate(self, question: str) -> None:
+        """Drops the plan a failed lookup came from, so the next request regenerates it."""
+        self.fallbacks += 1
+        found = self._find(*self.parameters(question))
+        if found is not None:
+            self._plans.delete((self.schemaVersion, found[0]))
+            self._log("fallback", question, found[0])
+
+    def _uncacheable(self, question: str, reason: str, detail: Optional[str] = None) -> bool:
+        self.uncacheable += 1
+        self._log("uncacheable", question, None, reason=reason, detail=detail)
+        return False
+
+    def _log(self, outcome: str, question: str, template: Optional[str], **extra: Any) -> None:
+        if not self.logPath:
+            return
+        record = {"ts": time.time(), "outcome": outcome, "question": question, "template": template, **extra}
+        try:
+            with self._logLock:
+                os.makedirs(os.path.dirname(os.path.abspath(self.logPath)), exist_ok=True)
+                with open(self.logPath, 'a', encoding='utf-8') as logFile:
+                    logFile.write(json.dumps(record) + "\n")
+        except OSError as e:
+            logger.warning(f"Could not write the plan cache request log: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": self._plans.stats()["entries"],
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": self.hits / lookups if lookups else 0.0,
+            "stored": self.stored,
+            "uncacheable": self.uncacheable,
+            "fallbacks": self.fallbacks,
+            "schemaVersion": self.schemaVersion,
+        }
+
+def report(logPath: str, top: int = 10) -> Dict[str, Any]:
+    """
+    Summarises a plan cache request log: overall and per-day hit rate, and the templates with the
+    most hits and misses.
+    """
+    outcomes: Counter = Counter()
+    days: Dict[str, Counter] = {}
+    hitTemplates: Counter = Counter()
+    missTemplates: Counter = Counter()
+    uncacheableReasons: Counter = Counter()
+    with open(logPath, encoding='utf-8') as logFile:
+        for line in logFile:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            outcome = record.get("outcome")
+            outcomes[outcome] += 1
+            days.setdefault(time.strftime("%Y-%m-%d", time.localtime(record.get("ts", 0))), Counter())[outcome] += 1
+            if outcome == "hit":
+                hitTemplates[record.get("template")] += 1
+            elif outcome == "miss":
+                missTemplates[record.get("template")] += 1
+            elif outcome == "uncacheable":
+                uncacheableReasons[record.get("reason")] += 1
+
+    def hitRate(counts: Counter) -> float:
+        lookups = counts["hit"] + counts["miss"]
+        return counts["hit"] / lookups if lookups else 0.0
+
+    return {
+        "lookups": outcomes["hit"] + outcomes["miss"],
+        "hits": outcomes["hit"],
+        "hitRate": hitRate(outcomes),
+        "stored": outcomes["stored"],
+        "uncacheable": outcomes["uncacheable"],
+        "fallbacks": outcomes["fallback"],
+        "byDay": {day: {"lookups": counts["hit"] + counts["miss"], "hitRate": hitRate(counts)} for day, counts in sorted(days.items())},
+        "topHitTemplates": hitTemplates.most_common(top),
+        "topMissTemplates": missTemplates.most_common(top),
+        "uncacheableReasons": uncacheableReasons.most_common(top),
+    }
+
+def main(argv: Any = None) -> None:
+    parser = argparse.ArgumentParser(description="Plan cache tools")
+    parser.add_argument("command", choices=["report"])
+    parser.add_argument("--log", default=os.getenv("PLAN_CACHE_LOG_PATH") or defaultLogPath)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args(argv)
+    print(json.dumps(report(args.log, args.top), indent=2))
+
+if __name__ == "__main__":
+    main()
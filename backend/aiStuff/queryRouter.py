@@ -0,0 +1,362 @@
+## queryRouter.py
+## Local CHAT / DATABASE router in front of RouterAgent. Training and evaluation over the routing log
+## (from /backend):
+##   python -m aiStuff.queryRouter train [--log PATH] [--model PATH]
+##   python -m aiStuff.queryRouter evaluate [--log PATH] [--model PATH]
+
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Set, Tuple, TypedDict
+
+import numpy as np
+
+from .valueIndex import ValueIndex
+
+logger = logging.getLogger(__name__)
+
+recourcesPath = os.path.join(os.path.dirname(__file__), '../resources')
+defaultModelPath = os.path.join(os.path.dirname(__file__), '../data/routerModel.json')
+defaultLogPath = os.path.join(os.path.dirname(__file__), '../data/routerRequests.jsonl')
+
+## Type aliases
+RouteDecision = TypedDict('RouteDecision', {
+    'queryType': str,
+    'source': str,
+    'probability': float
+})
+
+queryTypes = ("CHAT", "DATABASE")
+
+## Whole messages that never need data
+pleasantryPattern = re.compile(
+    r"^(hi|hello|hey|thanks|thank you|thank you so much|thanks a lot|thx|ta|cheers|ok|okay|great|cool|nice|"
+    r"awesome|perfect|got it|bye|goodbye|see you|good (morning|afternoon|evening)|how are you)"
+    r"( (there|again|mate|all|very much))?[\s!.,:)]*$"
+)
+## Words that ask for figures rather than explanations
+dataKeywords = {
+    'votes', 'vote', 'won', 'win', 'winner', 'result', 'results', 'swing', 'margin', 'turnout', 'enrolment',
+    'enrolled', 'preference', 'preferences', 'preferred', 'primary', 'candidate', 'candidates', 'booth',
+    'booths', 'count', 'seat', 'seats', 'percentage', 'percent', 'share', 'elected', 'population', 'median',
+    'highest', 'lowest', 'most', 'least', 'top', 'compare', 'list', 'show', 'many', 'much', 'total', 'average'
+}
+explanationWords = {'what', 'why', 'explain', 'meaning', 'mean', 'define', 'definition', 'difference', 'who', 'how'}
+
+## Indicator features sit after the hashed n-gram features
+hashedFeatures = 1 << 12
+indicatorNames = (
+    'bias', 'hasHistory', 'shortMessage', 'hasNumber', 'hasYear', 'regionMention', 'valueMention',
+    'schemaTerm', 'dataKeyword', 'explanationWord', 'pleasantry', 'questionMark'
+)
+featureCount = hashedFeatures + len(indicatorNames)
+
+def _tokens(text: str) -> List[str]:
+    return re.findall(r"\w+", text.casefold())
+
+def _hashed(feature: str) -> int:
+    ## crc32 rather than hash() so feature indices are stable across processes
+    return zlib.crc32(feature.encode()) % hashedFeatures
+
+def loadRegionNames(path: Optional[str] = None) -> Set[str]:
+    """Reads the region names ("Bennelong", ...) from metadataRegions.json, case-folded."""
+    path = path or os.path.join(recourcesPath, 'metadataRegions.json')
+    try:
+        with open(path, 'r') as file:
+            regions = json.load(file)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not load region names for the local router: {str(e)}")
+        return set()
+    return {" ".join(description.split(" - Located in")[0].casefold().split()) for description in regions.values()}
+
+class LocalRouter:
+    """
+    Decides CHAT vs DATABASE without a model call when it can.
+
+    Keyword rules run first: pleasantries ("thanks!") are CHAT, and a message naming a region or
+    stored value together with a year or data word ("votes in Bennelong 2022") is DATABASE. Other
+    messages are scored by a logistic regression over hashed word and bigram features plus
+    schema-vocabulary indicators (region names, value-index values, table and column names). The
+    decision is returned only when the probability clears `confidence` either way; otherwise the
+    caller falls back to `RouterAgent`.
+
+    Every decision is appended to a JSONL routing log; LLM decisions in that log are the labels
+    `python -m aiStuff.queryRouter train` learns from.
+
+    Attributes:
+        weights (Optional[np.ndarray]): The trained model, or None when only the rules are used.
+        decisions (Dict[str, int]): Decisions made per source (rules, model, llm).
+    """
+    def __init__(
+        self,
+        valueIndex: Optional[ValueIndex] = None,
+        modelPath: Optional[str] = None,
+        confidence: float = 0.9,
+        logPath: Optional[str] = None,
+        regionNames: Optional[Set[str]] = None
+    ):
+        self.valueIndex = valueIndex
+        self.confidence = confidence
+        self.logPath = logPath
+        self.regionNames = loadRegionNames() if regionNames is None else regionNames
+        self._maxRegionWords = max((len(name.split()) for name in self.regionNames), default=1)
+        self.weights: Optional[np.ndarray] = None
+        if modelPath and os.path.exists(modelPath):
+            self.weights = loadModel(modelPath)
+        self._schemaTermsCache: Set[str] = set()
+        self._schemaTermsBuiltAt: Optional[float] = None
+        self._logLock = threading.Lock()
+        self.decisions = {"rules": 0, "model": 0, "llm": 0}
+
+    def _schemaTerms(self) -> Set[str]:
+        """Words of the table and column names, recomputed when the value index is rebuilt."""
+        if self.valueIndex is None or not self.valueIndex.ready:
+            return set()
+        if self._schemaTermsBuiltAt != self.valueIndex.builtAt:
+            terms = set()
+            for table, column in self.valueIndex.schemaNames():
+                terms.update(word for word in re.split(r'[_\W]+', f"{table} {column}") if len(word) > 3)
+            self._schemaTermsCache, self._schemaTermsBuiltAt = terms, self.valueIndex.builtAt
+        return self._schemaTermsCache
+
+    def _hasRegion(self, tokens: List[str]) -> bool:
+        for size in range(1, self._maxRegionWords + 1):
+            for first in range(len(tokens) - size + 1):
+                if " ".join(tokens[first:first + size]) in self.regionNames:
+                    return True
+        return False
+
+    def indicators(self, message: str, hasHistory: bool) -> Dict[str, float]:
+        """The schema-vocabulary and shape indicators of a message."""
+        normalised = " ".join(message.casefold().split())
+        tokens = _tokens(message)
+        hasValue = bool(
+            self.valueIndex is not None and self.valueIndex.ready and self.valueIndex.findMentions(normalised)
+        )
+        return {
+            'bias': 1.0,
+            'hasHistory': float(hasHistory),
+            'shortMessage': float(len(tokens) <= 3),
+            'hasNumber': float(any(token.isdigit() for token in tokens)),
+            'hasYear': float(any(re.fullmatch(r'(19|20)\d\d', token) for token in tokens)),
+            'regionMention': float(self._hasRegion(tokens)),
+            'valueMention': float(hasValue),
+            'schemaTerm': float(bool(self._schemaTerms().intersection(tokens))),
+            'dataKeyword': float(bool(dataKeywords.intersection(tokens))),
+            'explanationWord': float(bool(explanationWords.intersection(tokens))),
+            'pleasantry': float(bool(pleasantryPattern.match(normalised))),
+            'questionMark': float('?' in message),
+        }
+
+    def features(self, message: str, hasHistory: bool, indicators: Optional[Dict[str, float]] = None) -> Dict[int, float]:
+        """Sparse feature vector: hashed unigrams and bigrams followed by the indicators."""
+        tokens = _tokens(message)
+        vector: Dict[int, float] = {}
+        for feature in tokens + [f"{first} {second}" for first, second in zip(tokens, tokens[1:])]:
+            index = _hashed(feature)
+            vector[index] = vector.get(index, 0.0) + 1.0
+        indicators = indicators or self.indicators(message, hasHistory)
+        for offset, name in enumerate(indicatorNames):
+            if indicators[name]:
+                vector[hashedFeatures + offset] = indicators[name]
+        return vector
+
+    def _rules(self, indicators: Dict[str, float]) -> Optional[str]:
+        if indicators['pleasantry'] and not (indicators['hasNumber'] or indicators['regionMention'] or indicators['valueMention']):
+            return "CHAT"
+        if (indicators['regionMention'] or indicators['valueMention']) and (indicators['hasYear'] or indicators['dataKeyword']):
+            return "DATABASE"
+        return None
+
+    def probability(self, message: str, hasHistory: bool, indicators: Optional[Dict[str, float]] = None) -> Optional[float]:
+        """Model probability that `message` needs the database, or None without a trained model."""
+        if self.weights is None:
+            return None
+        vector = self.features(message, hasHistory, indicators)
+        score = sum(self.weights[index] * value for index, value in vector.items())
+        return float(1.0 / (1.0 + np.exp(-score)))
+
+    def route(self, message: str, chatHistory: str = '', indicators: Optional[Dict[str, float]] = None) -> Tuple[Optional[RouteDecision], Dict[str, float]]:
+        """
+        Decides `message` locally when confident.
+
+        Returns:
+            Tuple[Optional[RouteDecision], Dict[str, float]]: The decision, or None when `RouterAgent`
+            should decide, and the message indicators to pass to `record` with the LLM decision.
+        """
+        hasHistory = bool(chatHistory and chatHistory.strip()) if indicators is None else indicators['hasHistory'] > 0
+        indicators = indicators or self.indicators(message, hasHistory)
+        ruled = self._rules(indicators)
+        if ruled is not None:
+            decision: RouteDecision = {'queryType': ruled, 'source': 'rules', 'probability': 1.0 if ruled == "DATABASE" else 0.0}
+        else:
+            probability = self.probability(message, hasHistory, indicators)
+            if probability is None or (1 - self.confidence) < probability < self.confidence:
+                return None, indicators
+            decision = {'queryType': "DATABASE" if probability >= self.confidence else "CHAT", 'source': 'model', 'probability': probability}
+        self.record(message, indicators, decision)
+        return decision, indicators
+
+    def record(self, message: str, indicators: Dict[str, float], decision: RouteDecision) -> None:
+        """
+        Counts a decision and appends it to the routing log. The indicators are logged with it so
+        training sees the schema vocabulary of the time without a database connection.
+        """
+        self.decisions[decision['source']] = self.decisions.get(decision['source'], 0) + 1
+        if not self.logPath:
+            return
+        entry = {"ts": time.time(), "message": message, "indicators": indicators, **decision}
+        try:
+            with self._logLock:
+                os.makedirs(os.path.dirname(os.path.abspath(self.logPath)), exist_ok=True)
+                with open(self.logPath, 'a', encoding='utf-8') as logFile:
+                    logFile.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            logger.warning(f"Could not write the routing log: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        total = sum(self.decisions.values())
+        return {
+            "decisions": dict(self.decisions),
+            "localRatio": (total - self.decisions.get("llm", 0)) / total if total else 0.0,
+            "modelLoaded": self.weights is not None,
+            "confidence": self.confidence,
+        }
+
+## Model persistence
+def loadModel(path: str) -> np.ndarray:
+    with open(path, 'r') as file:
+        model = json.load(file)
+    if model.get("featureCount") != featureCount:
+        raise ValueError(f"Router model {path} has {model.get('featureCount')} features, expected {featureCount}")
+    weights = np.zeros(featureCount)
+    for index, weight in model["weights"].items():
+        weights[int(index)] = weight
+    return weights
+
+def saveModel(weights: np.ndarray, path: str, metadata: Dict[str, Any]) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump({
+            "featureCount": featureCount,
+            "weights": {str(index): float(weights[index]) for index in np.flatnonzero(weights)},
+            **metadata
+        }, file)
+
+## Training and evaluation
+## (message, logged indicators, label index into queryTypes)
+Example = Tuple[str, Dict[str, float], int]
+
+def labelledExamples(logPath: str, includeLocal: bool = False) -> List[Example]:
+    """
+    Reads the distinct (message, indicators, label) examples of the routing log. LLM decisions and entries with an
+    explicit `label` (hand corrections) are labels; local decisions are skipped unless
+    `includeLocal`, so the model does not learn from its own output.
+    """
+    examples: Dict[Tuple[str, Tuple[float, ...]], Example] = {}
+    with open(logPath, encoding='utf-8') as logFile:
+        for line in logFile:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            label = entry.get("label") or (entry.get("queryType") if includeLocal or entry.get("source") == "llm" else None)
+            indicators = entry.get("indicators")
+            if label in queryTypes and entry.get("message") and isinstance(indicators, dict):
+                indicators = {name: float(indicators.get(name, 0.0)) for name in indicatorNames}
+                key = (entry["message"], tuple(indicators.values()))
+                examples[key] = (entry["message"], indicators, queryTypes.index(label))
+    return list(examples.values())
+
+def isHoldout(message: str) -> bool:
+    ## Deterministic 20% evaluation split, so repeated runs compare like with like
+    return zlib.crc32(message.casefold().encode()) % 5 == 0
+
+def trainWeights(vectors: List[Dict[int, float]], labels: List[int], epochs: int = 30, learningRate: float = 0.5, l2: float = 1e-4, batchSize: int = 256) -> np.ndarray:
+    """Mini-batch gradient descent for L2-regularised logistic regression on sparse vectors."""
+    weights = np.zeros(featureCount)
+    target = np.asarray(labels, dtype=float)
+    rng = np.random.default_rng(0)
+    for epoch in range(epochs):
+        order = rng.permutation(len(vectors))
+        for start in range(0, len(order), batchSize):
+            batch = order[start:start + batchSize]
+            dense = np.zeros((len(batch), featureCount))
+            for row, index in enumerate(batch):
+                for feature, value in vectors[index].items():
+                    dense[row, feature] = value
+            predictions = 1.0 / (1.0 + np.exp(-(dense @ weights)))
+            gradient = dense.T @ (predictions - target[batch]) / len(batch) + l2 * weights
+            weights -= learningRate * gradient
+    return weights
+
+def evaluate(router: LocalRouter, examples: List[Example]) -> Dict[str, Any]:
+    """
+    Routes every example locally and reports the confusion matrix of local decisions (with a
+    DEFER column for messages left to the LLM), coverage, accuracy and per-decision latency.
+    """
+    matrix = {actual: {"CHAT": 0, "DATABASE": 0, "DEFER": 0} for actual in queryTypes}
+    logPath, router.logPath = router.logPath, None
+    startedAt = time.perf_counter()
+    for message, indicators, label in examples:
+        decision, _ = router.route(message, indicators=indicators)
+        matrix[queryTypes[label]][decision['queryType'] if decision else "DEFER"] += 1
+    elapsed = time.perf_counter() - startedAt
+    router.logPath = logPath
+
+    decided = sum(row["CHAT"] + row["DATABASE"] for row in matrix.values())
+    correct = matrix["CHAT"]["CHAT"] + matrix["DATABASE"]["DATABASE"]
+    return {
+        "examples": len(examples),
+        "confusion": matrix,
+        "coverage": decided / len(examples) if examples else 0.0,
+        "accuracyWhenDecided": correct / decided if decided else 0.0,
+        "microsecondsPerMessage": elapsed / len(examples) * 1e6 if examples else 0.0,
+    }
+
+def formatConfusion(report: Dict[str, Any]) -> str:
+    lines = [f"{'actual / routed':>16} {'CHAT':>8} {'DATABASE':>9} {'DEFER':>7}"]
+    for actual, row in report["confusion"].items():
+        lines.append(f"{actual:>16} {row['CHAT']:>8} {row['DATABASE']:>9} {row['DEFER']:>7}")
+    lines.append(
+        f"coverage {report['coverage']:.1%}, accuracy when decided {report['accuracyWhenDecided']:.1%}, "
+        f"{report['microsecondsPerMessage']:.0f} us/message over {report['examples']} messages"
+    )
+    return "\n".join(lines)
+
+def main(argv: Any = None) -> None:
+    parser = argparse.ArgumentParser(description="Local query router training and evaluation")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--log", default=os.getenv("ROUTER_LOG_PATH") or defaultLogPath)
+    parser.add_argument("--model", default=os.getenv("ROUTER_MODEL_PATH") or defaultModelPath)
+    parser.add_argument("--confidence", type=float, default=float(os.getenv("ROUTER_CONFIDENCE", 0.9)))
+    parser.add_argument("--epochs", type=int, default=30)
+    parser.add_argument("--include-local", action="store_true", help="Also learn from rule/model decisions")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    examples = labelledExamples(args.log, args.include_local)
+    if not examples:
+        raise SystemExit(f"No labelled routing decisions in {args.log}")
+
+    if args.command == "train":
+        router = LocalRouter(confidence=args.confidence)
+        train = [example for example in examples if not isHoldout(example[0])]
+        holdout = [example for example in examples if isHoldout(example[0])]
+        vectors = [router.features(message, indicators['hasHistory'] > 0, indicators) for message, indicators, _ in train]
+        router.weights = trainWeights(vectors, [label for _, _, label in train], epochs=args.epochs)
+        saveModel(router.weights, args.model, {"trainedAt": time.time(), "examples": len(train)})
+        print(f"Trained on {len(train)} messages, saved to {args.model}")
+        print("Held-out evaluation:")
+        print(formatConfusion(evaluate(router, holdout or train)))
+    else:
+        router = LocalRouter(modelPath=args.model, confidence=args.confidence)
+        print(formatConfusion(evaluate(router, examples)))
+
+if __name__ == "__main__":
+    main()
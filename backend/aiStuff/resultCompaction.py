@@ -0,0 +1,169 @@
+## resultCompaction.py
+
+import math
+from typing import Callable, List, Optional, Tuple, TypedDict
+
+import numpy as np
+import pandas as pd
+
+## Type aliases
+CompactResult = TypedDict('CompactResult', {
+    'text': str,
+    'compacted': bool,
+    'rowCount': int,
+    'rowsShown': int,
+    'tokens': int
+})
+
+## Rendered to estimate the tokens per row before deciding whether the whole frame fits
+estimateRows = 50
+## Numeric columns ranked for the top/bottom rows; id-like columns are skipped
+maxRankedColumns = 3
+## Categorical columns with at most this many distinct values can stratify the sample
+maxStrata = 50
+## Most frequent values listed per text column
+topValues = 5
+## (top/bottom N, sample rows) tried in order until the compact text fits the budget
+detailLevels = [(5, 20), (3, 10), (2, 5), (1, 3), (0, 0)]
+
+def _uniqueColumns(data: pd.DataFrame) -> pd.DataFrame:
+    """Returns `data` with duplicate column names suffixed (name, name_2, ...), as SQL results may repeat them."""
+    if data.columns.is_unique:
+        return data
+    seen: dict = {}
+    columns = []
+    for column in map(str, data.columns):
+        seen[column] = seen.get(column, 0) + 1
+        columns.append(column if seen[column] == 1 else f"{column}_{seen[column]}")
+    renamed = data.copy(deep=False)
+    renamed.columns = columns
+    return renamed
+
+def _isIdColumn(column: str) -> bool:
+    return column.lower() == 'id' or column.lower().endswith('_id') or column.endswith('Id')
+
+def _numericColumns(data: pd.DataFrame) -> List[str]:
+    return [column for column in data.select_dtypes(include='number').columns if data[column].dtype != bool]
+
+def _stratifiedSample(data: pd.DataFrame, rows: int, categorical: List[str]) -> Tuple[pd.DataFrame, Optional[str]]:
+    """
+    Up to `rows` rows spread over the groups of the lowest-cardinality categorical column (each
+    group gets a share proportional to its size, at least one row), or evenly spaced rows when no
+    column has a usable number of groups. Deterministic, so repeated questions get the same sample.
+    """
+    if rows <= 0 or data.empty:
+        return data.iloc[:0], None
+    if len(data) <= rows:
+        return data, None
+    cardinalities = data[categorical].nunique(dropna=True) if categorical else pd.Series(dtype=int)
+    strata = cardinalities[(cardinalities > 1) & (cardinalities <= min(maxStrata, rows))]
+    if strata.empty:
+        positions = np.unique(np.linspace(0, len(data) - 1, rows).round().astype(int))
+        return data.iloc[positions], None
+    column = strata.idxmin()
+    groups = data.groupby(column, sort=False, dropna=False)
+    ## Every row's position within its group, and the rows its group may contribute
+    order = groups.cumcount()
+    sizes = groups[column].transform('size')
+    quota = np.maximum(1, np.floor(sizes * rows / len(data))).astype(int)
+    ## Rows spread evenly through each group rather than its first ones
+    step = np.maximum(1, sizes // quota)
+    mask = (order % step == 0) & (order // step < quota)
+    return data[mask.to_numpy()].head(rows), column
+
+def _section(title: str, body: str) -> str:
+    return f"{title}:\n{body}\n"
+
+def _render(data: pd.DataFrame, topN: int, sampleRows: int) -> Tuple[str, int]:
+    """Builds the compact text at one level of detail; returns it with the number of rows it shows."""
+    numeric = _numericColumns(data)
+    categorical = [column for column in data.columns if column not in numeric]
+    sections = [
+        f"NOTE: The query returned {len(data)} rows and {len(data.columns)} columns, too many to show in full. "
+        "Below are column statistics, the extreme rows and a representative sample. "
+        "Base the answer on these and state that it summarises a large result.\n"
+    ]
+
+    schema = pd.DataFrame({
+        'type': data.dtypes.astype(str),
+        'nonNull': data.notna().sum(),
+        'distinct': data.nunique(dropna=True)
+    })
+    sections.append(_section("Columns", schema.to_string()))
+
+    if numeric:
+        stats = data[numeric].agg(['sum', 'mean', 'min', 'median', 'max', 'std']).T
+        sections.append(_section("Numeric column statistics", stats.to_string(float_format=lambda value: f"{value:.6g}")))
+    for column in categorical:
+        counts = data[column].astype(str).value_counts().head(topValues)
+        if data[column].nunique(dropna=True) < len(data):
+            sections.append(_section(f"Most frequent values of {column}", counts.to_string()))
+
+    shown = set()
+    ranked = [column for column in numeric if not _isIdColumn(column)][:maxRankedColumns]
+    if topN > 0:
+        for column in ranked:
+            top = data.nlargest(topN, column)
+            bottom = data.nsmallest(topN, column)
+            shown.update(top.index)
+            shown.update(bottom.index)
+            sections.append(_section(f"Top {topN} rows by {column}", top.to_string(index=False)))
+            sections.append(_section(f"Bottom {topN} rows by {column}", bottom.to_string(index=False)))
+
+    sample, stratum = _stratifiedSample(data, sampleRows, categorical)
+    if not sample.empty:
+        shown.update(sample.index)
+        title = f"Sample of {len(sample)} rows" + (f" across {stratum}" if stratum else "")
+        sections.append(_section(title, sample.to_string(index=False)))
+    return "\n".join(sections), len(shown)
+
+def compactResult(
+    data: pd.DataFrame,
+    tokenBudget: int,
+    countTokens: Callable[[str], int],
+    enabled: bool = True
+) -> CompactResult:
+    """
+    Renders a query result for the summarizer within `tokenBudget` tokens.
+
+    Results that fit are rendered in full (`DataFrame.to_string`). Larger ones are replaced by a
+    compact, faithful description: the columns with their types and null/distinct counts, numeric
+    statistics (sum, mean, min, median, max, std), the most frequent values of text columns, the
+    top and bottom rows by the main numeric columns and a sample stratified over a low-cardinality
+    column. Everything is computed with vectorised pandas operations; the level of detail is
+    lowered until the text fits, and cut as a last resort.
+
+    Args:
+        data (pd.DataFrame): The query result.
+        tokenBudget (int): Maximum tokens of the returned text.
+        countTokens (Callable[[str], int]): Token counter of the summarizer's model.
+        enabled (bool): With False the full result is always returned.
+
+    Returns:
+        CompactResult: The text, whether it was compacted, the total and shown row counts and its tokens.
+    """
+    rowCount = len(data)
+    if not enabled or rowCount <= estimateRows:
+        text = data.to_string()
+        tokens = countTokens(text)
+        if not enabled or tokens <= tokenBudget:
+            return {'text': text, 'compacted': False, 'rowCount': rowCount, 'rowsShown': rowCount, 'tokens': tokens}
+    else:
+        ## Only render everything when the first rows suggest it could fit
+        estimate = countTokens(data.head(estimateRows).to_string()) * rowCount / estimateRows
+        if estimate <= tokenBudget * 1.2:
+            text = data.to_string()
+            tokens = countTokens(text)
+            if tokens <= tokenBudget:
+                return {'text': text, 'compacted': False, 'rowCount': rowCount, 'rowsShown': rowCount, 'tokens': tokens}
+
+    frame = _uniqueColumns(data)
+    for topN, sampleRows in detailLevels:
+        text, rowsShown = _render(frame, topN, sampleRows)
+        tokens = countTokens(text)
+        if tokens <= tokenBudget:
+            return {'text': text, 'compacted': True, 'rowCount': rowCount, 'rowsShown': rowsShown, 'tokens': tokens}
+    ## Even the statistics alone are over budget (very wide results): keep the leading part
+    ratio = tokenBudget / max(tokens, 1)
+    text = text[:math.floor(len(text) * ratio * 0.95)] + "\n[truncated]"
+    return {'text': text, 'compacted': True, 'rowCount': rowCount, 'rowsShown': 0, 'tokens': countTokens(text)}
@@ -0,0 +1,379 @@
+## schemaIndex.py
+## Per-question schema pruning for SqlExpert prompts. Offline recall evaluation (from /backend):
+##   python -m aiStuff.schemaIndex evaluate [--examples PATH] [--table-info PATH] [--top-k N]
+
+import argparse
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Set, TypedDict
+
+import sqlparse
+
+from .caches import normalizeQuestion
+from .sqlAnalysis import tableAliases
+from .valueIndex import ValueIndex
+
+logger = logging.getLogger(__name__)
+
+recourcesPath = os.path.join(os.path.dirname(__file__), '../resources')
+defaultExamplesPath = os.path.join(recourcesPath, 'schemaPruningExamples.jsonl')
+defaultTableInfoPath = os.path.join(recourcesPath, '_archive_elecdataUsableTableInfos.txt')
+defaultDescriptionsPath = os.path.join(recourcesPath, 'schemaDescriptions.json')
+defaultLogPath = os.path.join(os.path.dirname(__file__), '../data/schemaPruning.jsonl')
+
+## Type aliases
+SchemaSelection = TypedDict('SchemaSelection', {
+    'tables': List[str],
+    'tableInfo': str,
+    'pruned': bool
+})
+
+## One table of `SQLDatabase.get_table_info` output, with the optional "Table Name:" header of the archived dumps
+tableBlockPattern = re.compile(r'^(?:Table Name: [^\n]*\n(?:Table Definition:\n)?)?CREATE TABLE "?(\w+)"? \(', re.M)
+referencePattern = re.compile(r'REFERENCES "?(\w+)"?', re.I)
+sampleRowsPattern = re.compile(r'/\*\n\d+ rows from \w+ table:\n[^\n]*\n(.*?)\*/', re.S)
+columnPattern = re.compile(r'^\s+"?(\w+)"? [A-Z]', re.M)
+
+## Field weights: a question word naming the table counts more than one in its sample rows
+nameWeight = 3.0
+columnWeight = 1.5
+commentWeight = 1.0
+sampleWeight = 0.5
+mentionWeight = 2.0
+## Question words shorter than this do not match inside compound table names ("housecandidate")
+minSubstringLength = 4
+## BM25 parameters
+k1 = 1.2
+b = 0.75
+
+stopWords = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'did', 'do', 'does', 'for', 'from', 'get', 'give',
+    'had', 'has', 'have', 'how', 'i', 'in', 'is', 'it', 'me', 'of', 'on', 'or', 'show', 'tell', 'than', 'that',
+    'the', 'their', 'them', 'there', 'these', 'this', 'to', 'was', 'were', 'what', 'when', 'where', 'which',
+    'who', 'whom', 'why', 'with', 'list', 'many', 'much', 'all', 'each', 'per', 'id', 'created', 'none'
+}
+
+## Irregular forms the suffix stemming does not fold
+wordForms = {
+    'won': 'win', 'winner': 'win', 'winning': 'win', 'wins': 'win',
+    'elected': 'elect', 'electing': 'elect',
+    'contested': 'contest', 'contesting': 'contest',
+    'ran': 'run', 'running': 'run',
+    'enrolled': 'enrolment', 'enrollment': 'enrolment',
+    'electorate': 'seat', 'division': 'seat',
+}
+
+def _stem(word: str) -> str:
+    if word in wordForms:
+        return wordForms[word]
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+def terms(text: str) -> List[str]:
+    """Lower-cased, lightly stemmed words of `text`; identifiers are split on underscores."""
+    return [
+        _stem(word) for word in re.findall(r'[a-z0-9]+', text.casefold().replace('_', ' '))
+        if word not in stopWords and not word.isdigit()
+    ]
+
+def loadDescriptions(path: Optional[str] = None) -> Dict[str, List[str]]:
+    """Reads the curated table descriptions (table -> text) indexed alongside the database comments."""
+    path = path or os.getenv("SCHEMA_PRUNING_DESCRIPTIONS_PATH") or defaultDescriptionsPath
+    try:
+        with open(path, encoding='utf-8') as descriptionsFile:
+            descriptions = json.load(descriptionsFile)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read the schema descriptions: {str(e)}")
+        return {}
+    return {table.lower(): [description] for table, description in descriptions.items()}
+
+def parseTableInfo(tableInfo: str) -> Dict[str, str]:
+    """Splits `SQLDatabase.get_table_info` output into one block (DDL and sample rows) per table."""
+    matches = list(tableBlockPattern.finditer(tableInfo))
+    return {
+        match.group(1).lower(): tableInfo[match.start():matches[index + 1].start() if index + 1 < len(matches) else len(tableInfo)].strip()
+        for index, match in enumerate(matches)
+    }
+
+class _TableEntry:
+    """The weighted terms of one table and the tables its foreign keys reference."""
+    def __init__(self, table: str, info: str, comments: Iterable[str]):
+        self.table = table
+        self.info = info
+        self.nameParts = [_stem(part) for part in table.split('_') if part]
+        definition = info.split('/*', 1)[0]
+        self.references = {reference.lower() for reference in referencePattern.findall(definition)} - {table}
+        weighted: Counter = Counter()
+        for term in self.nameParts:
+            weighted[term] += nameWeight
+        for column in columnPattern.findall(definition):
+            for term in terms(column):
+                weighted[term] += columnWeight
+        for comment in comments:
+            for term in terms(comment):
+                weighted[term] += commentWeight
+        for rows in sampleRowsPattern.findall(info):
+            for term in terms(rows):
+                weighted[term] += sampleWeight
+        self.weights = weighted
+        self.length = sum(weighted.values())
+
+    def frequency(self, term: str) -> float:
+        """Weighted frequency of `term`, counting words found inside compound name parts."""
+        frequency = self.weights.get(term, 0.0)
+        if len(term) >= minSubstringLength and term not in self.nameParts and any(term in part for part in self.nameParts):
+            frequency += nameWeight
+        return frequency
+
+class SchemaIndex:
+    """
+    Keyword index over the tables of the electoral database, used to send `SqlExpert` only the
+    part of the schema a question needs instead of every table.
+
+    Each table is indexed on its name (compound names such as `housecandidate` also match the
+    words inside them), column names, database comments, the curated descriptions in
+    `resources/schemaDescriptions.json` and sample rows. A question (plus a few trailing chat
+    history lines, at half weight) is scored against every table with BM25; values the value index
+    finds in the question ("Kooyong", "Greens") count as terms of the tables holding them. The
+    top-k tables are selected, then expanded with the tables that reference at least two of them
+    (join/bridge tables) and every table reachable through their foreign keys. Questions that
+    match no table get the full schema.
+
+    Configuration (read from the environment):
+        SCHEMA_PRUNING_ENABLED: Prune the schema per question (default true).
+        SCHEMA_PRUNING_TOP_K: Tables selected before foreign-key expansion (default 6).
+        SCHEMA_PRUNING_CONTEXT_LINES: Trailing chat history lines searched with the question (default 2).
+        SCHEMA_PRUNING_ALWAYS_INCLUDE: Comma-separated tables sent with every question.
+        SCHEMA_PRUNING_DESCRIPTIONS_PATH: Table descriptions to index (default resources/schemaDescriptions.json).
+        SCHEMA_PRUNING_LOG_PATH: JSONL log of pruned questions whose SQL ran, usable as evaluation
+            examples (default backend/data/schemaPruning.jsonl).
+
+    Attributes:
+        tableInfo (str): The full schema, sent when pruning is off or finds nothing.
+        ready (bool): Whether the index has been built.
+    """
+    def __init__(self, valueIndex: Optional[ValueIndex] = None, logPath: Optional[str] = None):
+        self.valueIndex = valueIndex
+        self.enabled = os.getenv("SCHEMA_PRUNING_ENABLED", "true").lower() == "true"
+        self.topK = int(os.getenv("SCHEMA_PRUNING_TOP_K", 6))
+        self.contextLines = int(os.getenv("SCHEMA_PRUNING_CONTEXT_LINES", 2))
+        self.alwaysInclude = {
+            table.strip().lower() for table in os.getenv("SCHEMA_PRUNING_ALWAYS_INCLUDE", "").split(",") if table.strip()
+        }
+        self.logPath = logPath
+        self.tableInfo = ""
+        self.ready = False
+        self._entries: Dict[str, _TableEntry] = {}
+        self._averageLength = 1.0
+        self._logLock = threading.Lock()
+
+    def build(self, tableInfo: str, comments: Optional[Dict[str, List[str]]] = None) -> None:
+        """
+        Indexes the tables of `tableInfo` (the output of `SQLDatabase.get_table_info`).
+
+        Args:
+            tableInfo (str): DDL and sample rows of every usable table.
+            comments (Optional[Dict[str, List[str]]]): Table and column comments, by table. The
+                curated descriptions are added to them.
+        """
+        descriptions = loadDescriptions()
+        comments = {table.lower(): values for table, values in (comments or {}).items()}
+        for table, values in descriptions.items():
+            comments[table] = comments.get(table, []) + values
+        entries = {
+            table: _TableEntry(table, info, comments.get(table, []))
+            for table, info in parseTableInfo(tableInfo).items()
+        }
+        self.tableInfo = tableInfo
+        self._entries = entries
+        self._averageLength = sum(entry.length for entry in entries.values()) / len(entries) if entries else 1.0
+        self.ready = bool(entries)
+        logger.info(f"Schema index built: {len(entries)} tables")
+
+    def tables(self) -> List[str]:
+        return list(self._entries)
+
+    def _queryTerms(self, question: str, chatHistory: str) -> Counter:
+        queryTerms: Counter = Counter()
+        for term in terms(question):
+            queryTerms[term] += 1.0
+        historyLines = [line for line in chatHistory.splitlines() if line.strip()][-self.contextLines:] if self.contextLines > 0 else []
+        for term in terms("\n".join(historyLines)):
+            queryTerms[term] += 0.5
+        return queryTerms
+
+    def _mentionedTables(self, question: str) -> List[Set[str]]:
+        """The tables holding each indexed value mentioned in `question`."""
+        if self.valueIndex is None or not self.valueIndex.ready:
+            return []
+        return [
+            {table for table, _ in mention['columns'] if table in self._entries}
+            for mention in self.valueIndex.findMentions(normalizeQuestion(question))
+        ]
+
+    def score(self, question: str, chatHistory: str = '') -> Dict[str, float]:
+        """BM25 score of every table for `question`; tables without a matching term are left out."""
+        count = len(self._entries)
+        scores: Counter = Counter()
+
+        def add(frequencies: Dict[str, float], queryWeight: float) -> None:
+            matching = len(frequencies)
+            if not matching:
+                return
+            idf = math.log(1 + (count - matching + 0.5) / (matching + 0.5))
+            for table, frequency in frequencies.items():
+                norm = frequency * (k1 + 1) / (frequency + k1 * (1 - b + b * self._entries[table].length / self._averageLength))
+                scores[table] += queryWeight * idf * norm
+
+        for term, queryWeight in self._queryTerms(question, chatHistory).items():
+            add({
+                table: frequency for table, entry in self._entries.items()
+                for frequency in (entry.frequency(term),) if frequency > 0
+            }, queryWeight)
+        for tables in self._mentionedTables(question):
+            add({table: mentionWeight for table in tables}, 1.0)
+        return dict(scores)
+
+    def _expand(self, selected: List[str]) -> List[str]:
+        """
+        Adds the tables `selected` reach through foreign keys (e.g. votetally -> housecandidate ->
+        person) and the bridge tables referencing at least two selected tables.
+        """
+        chosen = set(selected)
+        for table, entry in self._entries.items():
+            if table not in chosen and len(entry.references & set(selected)) >= 2:
+                chosen.add(table)
+        pending = list(chosen)
+        while pending:
+            for reference in self._entries[pending.pop()].references:
+                if reference in self._entries and reference not in chosen:
+                    chosen.add(reference)
+                    pending.append(reference)
+        return [table for table in self._entries if table in chosen]
+
+    def select(self, question: str, chatHistory: str = '', topK: Optional[int] = None) -> SchemaSelection:
+        """
+        Chooses the tables to send with `question`.
+
+        Returns:
+            SchemaSelection: The selected tables (in schema order), their table info and whether
+            anything was pruned. The full schema is returned when pruning is off or no table matched.
+        """
+        full: SchemaSelection = {'tables': self.tables(), 'tableInfo': self.tableInfo, 'pruned': False}
+        if not (self.enabled and self.ready):
+            return full
+        scores = self.score(question, chatHistory)
+        if not scores:
+            return full
+        ranked = sorted(scores, key=lambda table: -scores[table])[:topK or self.topK]
+        tables = self._expand(ranked + [table for table in self.alwaysInclude if table in self._entries])
+        if len(tables) >= len(self._entries):
+            return full
+        return {
+            'tables': tables,
+            'tableInfo': "\n\n".join(self._entries[table].info for table in tables),
+            'pruned': True
+        }
+
+    def record(self, question: str, sqlQuery: str, selection: SchemaSelection) -> None:
+        """Appends a question whose SQL, generated from a pruned schema, ran successfully."""
+        if not (self.logPath and selection['pruned']):
+            return
+        record = {"ts": time.time(), "question": question, "sql": sqlQuery, "tables": selection['tables']}
+        try:
+            with self._logLock:
+                os.makedirs(os.path.dirname(os.path.abspath(self.logPath)), exist_ok=True)
+                with open(self.logPath, 'a', encoding='utf-8') as logFile:
+                    logFile.write(json.dumps(record) + "\n")
+        except OSError as e:
+            logger.warning(f"Could not write the schema pruning log: {str(e)}")
+
+def requiredTables(sqlQuery: str, tables: Set[str]) -> Set[str]:
+    """The tables of `tables` that `sqlQuery` reads (CTE names and aliases are not tables)."""
+    statements = [statement for statement in sqlparse.parse(sqlQuery) if str(statement).strip()]
+    required: Set[str] = set()
+    for statement in statements:
+        required |= set(tableAliases(statement).values()) & tables
+    return required
+
+def evaluate(index: SchemaIndex, examples: List[Dict[str, Any]], topK: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Measures whether pruning keeps the tables each example's SQL reads.
+
+    Args:
+        index (SchemaIndex): A built index.
+        examples (List[Dict[str, Any]]): Records with a `question` and either the `sql` that
+            answers it or its `tables`; an optional `chatHistory` is searched as in production.
+        topK (Optional[int]): Overrides SCHEMA_PRUNING_TOP_K.
+
+    Returns:
+        Dict[str, Any]: Share of examples with every required table kept (`recall`), share of
+        required tables kept (`tableRecall`), prompt size against the full schema, and the misses.
+    """
+    known = set(index.tables())
+    evaluated, complete, requiredCount, keptCount, selectedCount, selectedChars = 0, 0, 0, 0, 0, 0
+    misses = []
+    for example in examples:
+        required = {table.lower() for table in example['tables']} & known if example.get('tables') else requiredTables(example.get('sql', ''), known)
+        if not required:
+            continue
+        selection = index.select(example['question'], example.get('chatHistory', ''), topK)
+        kept = required & set(selection['tables'])
+        evaluated += 1
+        complete += kept == required
+        requiredCount += len(required)
+        keptCount += len(kept)
+        selectedCount += len(selection['tables'])
+        selectedChars += len(selection['tableInfo'])
+        if kept != required:
+            misses.append({"question": example['question'], "missing": sorted(required - kept), "selected": selection['tables']})
+    return {
+        "examples": evaluated,
+        "recall": complete / evaluated if evaluated else 0.0,
+        "tableRecall": keptCount / requiredCount if requiredCount else 0.0,
+        "averageTables": selectedCount / evaluated if evaluated else 0.0,
+        "schemaTables": len(known),
+        ## Estimated at one token per four characters
+        "averagePromptTokens": round(selectedChars / evaluated / 4) if evaluated else 0,
+        "fullPromptTokens": round(len(index.tableInfo) / 4),
+        "misses": misses,
+    }
+
+def _readExamples(path: str) -> List[Dict[str, Any]]:
+    examples = []
+    with open(path, encoding='utf-8') as examplesFile:
+        for line in examplesFile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                examples.append(json.loads(line))
+            except ValueError:
+                continue
+    return examples
+
+def main(argv: Any = None) -> None:
+    parser = argparse.ArgumentParser(description="Schema pruning tools")
+    parser.add_argument("command", choices=["evaluate"])
+    parser.add_argument("--examples", default=defaultExamplesPath, help="JSONL of {question, sql|tables}, e.g. the SCHEMA_PRUNING_LOG_PATH log")
+    parser.add_argument("--table-info", default=defaultTableInfoPath, help="Saved SQLDatabase.get_table_info output")
+    parser.add_argument("--top-k", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    with open(args.table_info, encoding='utf-8') as tableInfoFile:
+        tableInfo = tableInfoFile.read()
+    index = SchemaIndex()
+    index.build(tableInfo)
+    print(json.dumps(evaluate(index, _readExamples(args.examples), args.top_k), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+## schemaSnapshot.py
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, TypedDict
+
+from sqlalchemy.sql import text
+
+from .agentHelpers import getPostgresEngine, loadPostgresDatabase
+from .cacheBackends import CacheNamespace
+
+logger = logging.getLogger(__name__)
+
+## Type aliases
+SchemaSnapshot = TypedDict('SchemaSnapshot', {
+    'format': int,
+    'dbName': str,
+    'fingerprint': str,
+    'dialect': str,
+    'tableInfo': str,
+    'comments': Dict[str, List[str]],
+    'createdAt': float
+})
+
+defaultSnapshotPath = os.path.join(os.path.dirname(__file__), '../data/schemaSnapshot.json')
+## Bumped when the snapshot layout changes, so older files are ignored
+snapshotFormat = 1
+
+## Hash of the column names and types of the current schema; cheap enough to run every minute
+schemaFingerprintSql = (
+    "SELECT md5(string_agg(table_name || '.' || column_name || ':' || data_type, ',' "
+    "ORDER BY table_name, ordinal_position)) FROM information_schema.columns "
+    "WHERE table_schema = current_schema()"
+)
+
+## Insert/update/delete counters of the usable tables (see `_usableTable`) of the current schema;
+## kept by the statistics collector, so they restart from zero on `pg_stat_reset` or a failover
+usableTableChangesSql = (
+    "SELECT coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0) FROM pg_stat_user_tables "
+    "WHERE schemaname = current_schema() "
+    "AND lower(relname) NOT LIKE 'auth%' AND lower(relname) NOT LIKE 'django%'"
+)
+
+def _usableTable(table: str) -> bool:
+    return not (table.lower().startswith('auth') or table.lower().startswith('django'))
+
+def readSchemaFingerprint(dbName: str) -> str:
+    with getPostgresEngine(dbName).connect() as connection:
+        fingerprint = connection.execute(text(schemaFingerprintSql)).scalar()
+        connection.rollback()
+    return fingerprint or ""
+
+def _readComments(dbName: str) -> Dict[str, List[str]]:
+    """Returns the table and column comments of the current schema, by table."""
+    with getPostgresEngine(dbName).connect() as connection:
+        rows = connection.execute(text(
+            "SELECT c.relname, d.description FROM pg_description d "
+            "JOIN pg_class c ON c.oid = d.objoid AND d.classoid = 'pg_class'::regclass "
+            "JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE n.nspname = current_schema()"
+        )).fetchall()
+        connection.rollback()
+    comments: Dict[str, List[str]] = {}
+    for table, description in rows:
+        if _usableTable(table):
+            comments.setdefault(table, []).append(description)
+    return comments
+
+def reflectSchema(dbName: str, fingerprint: Optional[str] = None) -> SchemaSnapshot:
+    """
+    Reflects the usable tables of `dbName` (DDL and sample rows, as sent to `SqlExpert`), their
+    comments and the SQL dialect.
+    """
+    fingerprint = fingerprint or readSchemaFingerprint(dbName)
+    with loadPostgresDatabase(dbName) as db:
+        tables = [table for table in db.get_usable_table_names() if _usableTable(table)]
+        tableInfo = db.get_table_info(tables)
+        dialect = db.dialect
+    try:
+        comments = _readComments(dbName)
+    except Exception as e:
+        logger.warning(f"Could not read the schema comments: {str(e)}")
+        comments = {}
+    return {
+        'format': snapshotFormat,
+        'dbName': dbName,
+        'fingerprint': fingerprint,
+        'dialect': dialect,
+        'tableInfo': tableInfo,
+        'comments': comments,
+        'createdAt': time.time()
+    }
+
+def loadSnapshot(path: str, dbName: str) -> Optional[SchemaSnapshot]:
+    """Reads the snapshot at `path`, or None if it is missing, unreadable or for another database."""
+    try:
+        with open(path, encoding='utf-8') as snapshotFile:
+            snapshot = json.load(snapshotFile)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable schema snapshot {path}: {str(e)}")
+        return None
+    return _usableSnapshot(snapshot, dbName)
+
+def _usableSnapshot(snapshot: dict, dbName: str) -> Optional[SchemaSnapshot]:
+    if snapshot.get('format') != snapshotFormat or snapshot.get('dbName') != dbName or not snapshot.get('tableInfo'):
+        return None
+    return snapshot
+
+def saveSnapshot(path: str, snapshot: SchemaSnapshot) -> None:
+    """Writes `snapshot` atomically, so a crash mid-write never leaves a truncated file."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporaryPath = f"{path}.{os.getpid()}.tmp"
+    with open(temporaryPath, 'w', encoding='utf-8') as snapshotFile:
+        json.dump(snapshot, snapshotFile)
+    os.replace(temporaryPath, path)
+
+class SchemaSnapshotStore:
+    """
+    Keeps the reflected schema of a database in a local snapshot file so startup does not wait
+    for (or fail on) Postgres.
+
+    `start` loads the snapshot, if there is one for the database, and hands it to `onChange`
+    straight away. Snapshots are also kept in the "schema" namespace of the cache backend, which is
+    read first, so with a shared backend a worker on a fresh host starts from its peers'
+    reflection. A daemon thread then revalidates it: the schema fingerprint (a hash over
+    `information_schema.columns`) is compared with the snapshot's, and only a mismatch or a
+    missing snapshot triggers a full reflection, which is saved and handed to `onChange`. Failed
+    revalidations (e.g. the database is unreachable) are retried; afterwards the fingerprint is
+    re-checked every refresh interval, or sooner when `requestRevalidation` is called.
+
+    Configuration (read from the environment):
+        SCHEMA_SNAPSHOT_PATH: Snapshot file (default backend/data/schemaSnapshot.json).
+        SCHEMA_SNAPSHOT_RETRY_SECONDS: Delay before retrying a failed revalidation (default 15).
+        SCHEMA_SNAPSHOT_REFRESH_SECONDS: Interval between fingerprint checks (default 3600).
+
+    Attributes:
+        snapshot (Optional[SchemaSnapshot]): The schema in use, once loaded or reflected.
+        ready (threading.Event): Set once a schema is available.
+        validated (bool): Whether the snapshot has been checked against the database.
+    """
+    def __init__(self, dbName: str, onChange: Callable[[SchemaSnapshot], None], path: Optional[str] = None):
+        self.dbName = dbName
+        self.onChange = onChange
+        self.path = path or os.getenv("SCHEMA_SNAPSHOT_PATH") or defaultSnapshotPath
+        self.retrySeconds = float(os.getenv("SCHEMA_SNAPSHOT_RETRY_SECONDS", 15))
+        self.refreshSeconds = float(os.getenv("SCHEMA_SNAPSHOT_REFRESH_SECONDS", 3600))
+        self.snapshot: Optional[SchemaSnapshot] = None
+        self.ready = threading.Event()
+        self.validated = False
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._cache = CacheNamespace("schema", ttlSeconds=None)
+
+    @property
+    def fingerprint(self) -> Optional[str]:
+        return self.snapshot['fingerprint'] if self.snapshot else None
+
+    def _apply(self, snapshot: SchemaSnapshot) -> None:
+        self.onChange(snapshot)
+        self.snapshot = snapshot
+        self.ready.set()
+
+    def _loadCached(self) -> Optional[SchemaSnapshot]:
+        payload = self._cache.get(self.dbName)
+        if payload is None:
+            return None
+        try:
+            return _usableSnapshot(json.loads(payload), self.dbName)
+        except ValueError:
+            return None
+
+    def load(self) -> bool:
+        """Applies the cached snapshot, or the one on disk, if any. Returns whether one was loaded."""
+        snapshot, source = self._loadCached(), f"the {self._cache.backend.name} cache"
+        if snapshot is None:
+            snapshot, source = loadSnapshot(self.path, self.dbName), self.path
+            if snapshot is None:
+                return False
+            self._cache.set(self.dbName, json.dumps(snapshot).encode())
+        self._apply(snapshot)
+        logger.info(f"Loaded schema snapshot from {source} (taken {time.ctime(snapshot['createdAt'])})")
+        return True
+
+    def revalidate(self) -> bool:
+        """
+        Re-reflects the schema if its fingerprint no longer matches the snapshot.
+
+        Returns:
+            bool: Whether the schema changed (or was reflected for the first time).
+        """
+        fingerprint = readSchemaFingerprint(self.dbName)
+        self.validated = True
+        if self.snapshot is not None and fingerprint == self.snapshot['fingerprint']:
+            return False
+        startedAt = time.perf_counter()
+        snapshot = reflectSchema(self.dbName, fingerprint)
+        self._apply(snapshot)
+        logger.info(f"Schema reflected in {time.perf_counter() - startedAt:.2f}s")
+        try:
+            saveSnapshot(self.path, snapshot)
+        except OSError as e:
+            logger.warning(f"Could not save the schema snapshot: {str(e)}")
+        self._cache.set(self.dbName, json.dumps(snapshot).encode())
+        return True
+
+    def _revalidateLoop(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.revalidate()
+                delay = self.refreshSeconds
+            except Exception as e:
+                logger.warning(f"Schema revalidation failed, retrying in {self.retrySeconds:.0f}s: {str(e)}")
+                delay = self.retrySeconds
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def start(self) -> None:
+        """Loads the snapshot on disk and starts revalidating it in a daemon thread."""
+        if self._thread is not None:
+            return
+        self.load()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._revalidateLoop, name="schema-snapshot", daemon=True)
+        self._thread.start()
+
+    def requestRevalidation(self) -> None:
+        """Wakes the revalidation thread, e.g. when another check saw the fingerprint change."""
+        self._wake.set()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._wake.set()
+        self._thread = None
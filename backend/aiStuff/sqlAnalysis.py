@@ -0,0 +1,403 @@
+## sqlAnalysis.py
+
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, TypedDict, Union
+
+import sqlparse
+from sqlparse.sql import Comparison, Identifier, IdentifierList, Parenthesis, TokenList
+from sqlparse.tokens import CTE, DML, Keyword, Name, Number, String, Whitespace, Wildcard, Comment, Operator
+
+## Type aliases
+LiteralReference = TypedDict('LiteralReference', {
+    'table': Optional[str],
+    'column': str,
+    'operator': str,
+    'literal': str,
+    'token': Any
+})
+
+## Comparisons whose right-hand literal is expected to be an exact stored value (LIKE patterns are left alone)
+equalityOperators = {'=', '<>', '!='}
+
+def unquoteLiteral(value: str) -> str:
+    """Returns the text of a single-quoted SQL string literal."""
+    return value[1:-1].replace("''", "'")
+
+def quoteLiteral(value: str) -> str:
+    """Returns `value` as a single-quoted SQL string literal."""
+    return "'" + value.replace("'", "''") + "'"
+
+def _isNoise(token) -> bool:
+    return token.is_whitespace or token.ttype in Whitespace or token.ttype in Comment
+
+def _siblings(tokenList: TokenList) -> List[Any]:
+    return [token for token in tokenList.tokens if not _isNoise(token)]
+
+def _isStringLiteral(token) -> bool:
+    return token.ttype in String.Single
+
+def _containsDml(token) -> bool:
+    return token.is_group and any(leaf.ttype in DML for leaf in token.flatten())
+
+def tableAliases(statement: TokenList) -> Dict[str, str]:
+    """
+    Maps every table name and alias in the FROM/JOIN clauses of `statement` to the real table name.
+
+    Subqueries in FROM are skipped. Names are lower-cased.
+    """
+    aliases: Dict[str, str] = {}
+
+    def addIdentifier(identifier: Identifier) -> None:
+        if _containsDml(identifier):
+            return
+        realName = identifier.get_real_name()
+        if not realName:
+            return
+        aliases[realName.lower()] = realName.lower()
+        alias = identifier.get_alias()
+        if alias:
+            aliases[alias.lower()] = realName.lower()
+
+    def visit(tokenList: TokenList) -> None:
+        expectTable = False
+        for token in _siblings(tokenList):
+            if token.ttype in Keyword and (token.normalized == 'FROM' or token.normalized.endswith('JOIN')):
+                expectTable = True
+                continue
+            if expectTable:
+                if isinstance(token, Identifier):
+                    addIdentifier(token)
+                elif isinstance(token, IdentifierList):
+                    for item in token.get_identifiers():
+                        if isinstance(item, Identifier):
+                            addIdentifier(item)
+                expectTable = False
+            if token.is_group:
+                visit(token)
+
+    visit(statement)
+    return aliases
+
+ColumnReference = TypedDict('ColumnReference', {
+    'table': str,
+    'column': str
+})
+
+## Operators whose right-hand literal names stored values, and so benefit from DISTINCT-value grounding
+filterOperators = equalityOperators | {'LIKE', 'ILIKE', 'NOT LIKE', 'NOT ILIKE', 'IN', 'NOT IN'}
+setOperators = {'UNION', 'UNION ALL', 'INTERSECT', 'EXCEPT'}
+
+class _Scope:
+    """
+    One SELECT: its FROM sources (alias -> base table name or the `_Scope` of a CTE/derived table),
+    its output columns (name -> select-list item) and the CTEs visible to it.
+    """
+    def __init__(self, parent: Optional['_Scope'], ctes: Dict[str, '_Scope']):
+        self.parent = parent
+        self.ctes = dict(ctes)
+        self.sources: Dict[str, Union[str, '_Scope']] = {}
+        self.outputs: Dict[str, Any] = {}
+        self.wildcard = False
+
+## A literal comparison found while walking: (scope, column identifier, operator, literal token)
+_Comparison = Tuple[_Scope, Identifier, str, Any]
+
+def _plainColumn(token) -> bool:
+    """Whether an identifier is a bare or qualified column name rather than an expression."""
+    return isinstance(token, Identifier) and bool(token.tokens) and token.tokens[0].ttype in (Name, String.Symbol) and not _containsDml(token)
+
+def _parenthesisOf(identifier) -> Optional[Parenthesis]:
+    return next((token for token in identifier.tokens if isinstance(token, Parenthesis)), None)
+
+def _identifiers(token) -> List[Any]:
+    if isinstance(token, IdentifierList):
+        return [item for item in token.get_identifiers() if isinstance(item, Identifier)]
+    return [token] if isinstance(token, Identifier) else []
+
+def _isLiteral(token) -> bool:
+    return token.ttype in String.Single or token.ttype in Number
+
+def _addSource(scope: _Scope, identifier: Identifier, comparisons: List[_Comparison]) -> None:
+    subquery = _parenthesisOf(identifier)
+    if subquery is not None and _containsDml(subquery):
+        alias = identifier.get_alias() or identifier.get_name()
+        if alias:
+            scope.sources[alias.lower()] = _analyse(subquery, None, scope.ctes, comparisons)
+        return
+    realName = identifier.get_real_name()
+    if not realName:
+        return
+    alias = (identifier.get_alias() or realName).lower()
+    scope.sources[alias] = scope.ctes.get(realName.lower(), realName.lower())
+
+def _addOutputs(scope: _Scope, token) -> None:
+    items = _identifiers(token) if isinstance(token, (Identifier, IdentifierList)) else []
+    if token.ttype in Wildcard or (isinstance(token, IdentifierList) and any(item.ttype in Wildcard for item in token.tokens)):
+        scope.wildcard = True
+    for item in items:
+        if item.is_wildcard():
+            scope.wildcard = True
+            continue
+        name = item.get_alias() or (item.get_real_name() if _plainColumn(item) else None)
+        if name:
+            scope.outputs[name.lower()] = item
+
+def _collect(tokenList: TokenList, scope: _Scope, comparisons: List[_Comparison]) -> None:
+    """Finds literal comparisons (and subqueries, analysed as child scopes) below `tokenList`."""
+    _collectSiblings(_siblings(tokenList), scope, comparisons)
+
+def _collectSiblings(siblings: List[Any], scope: _Scope, comparisons: List[_Comparison]) -> None:
+    for index, token in enumerate(siblings):
+        if isinstance(token, Parenthesis) and _containsDml(token):
+            _analyse(token, scope, scope.ctes, comparisons)
+            continue
+        if isinstance(token, Comparison):
+            parts = _siblings(token)
+            if len(parts) == 3 and parts[1].ttype in Operator.Comparison:
+                left, operator, right = parts
+                operatorName = " ".join(operator.normalized.upper().split())
+                if isinstance(left, Identifier) and _isLiteral(right):
+                    comparisons.append((scope, left, operatorName, right))
+                elif isinstance(right, Identifier) and _isLiteral(left):
+                    comparisons.append((scope, right, operatorName, left))
+            _collect(token, scope, comparisons)
+            continue
+        if token.ttype in Keyword and token.normalized == 'IN' and 0 < index < len(siblings) - 1:
+            negated = siblings[index - 1].ttype in Keyword and siblings[index - 1].normalized == 'NOT'
+            column = siblings[index - 2] if negated and index > 1 else siblings[index - 1]
+            values = siblings[index + 1]
+            if isinstance(column, Identifier) and isinstance(values, Parenthesis) and not _containsDml(values):
+                for leaf in values.flatten():
+                    if _isLiteral(leaf):
+                        comparisons.append((scope, column, 'NOT IN' if negated else 'IN', leaf))
+                continue
+        if token.is_group:
+            _collect(token, scope, comparisons)
+
+def _analyse(tokenList: TokenList, parent: Optional[_Scope], ctes: Dict[str, _Scope], comparisons: List[_Comparison]) -> _Scope:
+    """
+    Walks one (possibly parenthesised) query: its CTEs, FROM/JOIN sources, select list and
+    conditions. Returns the scope of its first SELECT, whose outputs describe the query's columns.
+    """
+    scope = first = _Scope(parent, ctes)
+    clause = None
+    ## Condition tokens (WHERE groups, ON/HAVING comparisons, IN lists) are walked per SELECT
+    ## once its sources are known
+    conditions: List[Tuple[_Scope, List[Any]]] = [(scope, [])]
+    for token in _siblings(tokenList):
+        if token.ttype in CTE:
+            clause = 'WITH'
+            continue
+        if clause == 'WITH' and isinstance(token, (Identifier, IdentifierList)):
+            for identifier in _identifiers(token):
+                body = _parenthesisOf(identifier)
+                if body is not None and identifier.get_name():
+                    scope.ctes[identifier.get_name().lower()] = _analyse(body, None, scope.ctes, comparisons)
+            clause = None
+            continue
+        if token.ttype in DML:
+            clause = 'SELECT'
+            continue
+        if token.ttype in Keyword:
+            normalized = " ".join(token.normalized.split())
+            if normalized in setOperators:
+                scope = _Scope(parent, scope.ctes)
+                conditions.append((scope, []))
+                clause = None
+            elif normalized == 'FROM' or normalized.endswith('JOIN'):
+                clause = 'FROM'
+            else:
+                clause = normalized
+            continue
+        if clause == 'SELECT' and (isinstance(token, (Identifier, IdentifierList)) or token.ttype in Wildcard):
+            _addOutputs(scope, token)
+        elif clause == 'FROM' and isinstance(token, (Identifier, IdentifierList)):
+            for identifier in _identifiers(token):
+                _addSource(scope, identifier, comparisons)
+            continue
+        conditions[-1][1].append(token)
+    for conditionScope, tokens in conditions:
+        _collectSiblings(tokens, conditionScope, comparisons)
+    return first
+
+def _provides(source: Union[str, _Scope], column: str, schema: Optional[Set[Tuple[str, str]]]) -> Optional[bool]:
+    """Whether `source` has `column`; None when it cannot be known (a base table without a schema)."""
+    if isinstance(source, str):
+        return None if schema is None else (source, column) in schema
+    if column in source.outputs:
+        return True
+    return None if source.wildcard else False
+
+def _fromSource(source: Union[str, _Scope], column: str, schema: Optional[Set[Tuple[str, str]]], depth: int) -> Optional[Tuple[str, str]]:
+    if isinstance(source, str):
+        return source, column
+    output = source.outputs.get(column)
+    if output is not None:
+        if not _plainColumn(output):
+            return None
+        return _resolve(source, output.get_parent_name(), output.get_real_name().lower(), schema, depth + 1)
+    if source.wildcard:
+        return _resolve(source, None, column, schema, depth + 1)
+    return None
+
+def _resolve(scope: _Scope, qualifier: Optional[str], column: str, schema: Optional[Set[Tuple[str, str]]], depth: int = 0) -> Optional[Tuple[str, str]]:
+    """
+    Resolves a column reference to its base (table, column), following aliases, CTEs and derived
+    tables, and enclosing scopes for correlated subqueries. Returns None when ambiguous or when the
+    column is computed rather than read from a table.
+    """
+    if depth > 32:
+        return None
+    current = scope
+    while current is not None:
+        if qualifier:
+            source = current.sources.get(qualifier.lower())
+            if source is not None:
+                return _fromSource(source, column, schema, depth)
+        else:
+            sources = list({id(source): source for source in current.sources.values()}.values())
+            known = [source for source in sources if _provides(source, column, schema)]
+            if len(known) == 1:
+                return _fromSource(known[0], column, schema, depth)
+            if len(known) > 1:
+                return None
+            unknown = [source for source in sources if _provides(source, column, schema) is None]
+            if len(unknown) == 1 and len(sources) == 1:
+                return _fromSource(unknown[0], column, schema, depth)
+            if unknown:
+                return None
+        current = current.parent
+    return None
+
+def analyseLiteralComparisons(statement: TokenList, schema: Optional[Set[Tuple[str, str]]] = None) -> List[Dict[str, Any]]:
+    """
+    Finds every column compared against a literal in `statement`, including inside CTEs, derived
+    tables and nested subqueries, and resolves it to its base table.
+
+    Args:
+        statement (TokenList): A parsed sqlparse statement.
+        schema (Optional[Set[Tuple[str, str]]]): Known lower-case (table, column) pairs, used to
+            place unqualified columns when several tables are in scope.
+
+    Returns:
+        List[Dict[str, Any]]: {'table', 'column', 'qualifier', 'operator', 'literal', 'token'} per
+        literal; `table` is None when the column could not be resolved to a base table.
+    """
+    comparisons: List[_Comparison] = []
+    _analyse(statement, None, {}, comparisons)
+    results = []
+    for scope, identifier, operator, literalToken in comparisons:
+        column = identifier.get_real_name()
+        if not column or not _plainColumn(identifier):
+            continue
+        qualifier = identifier.get_parent_name()
+        resolved = _resolve(scope, qualifier, column.lower(), schema)
+        results.append({
+            'table': resolved[0] if resolved else None,
+            'column': resolved[1] if resolved else column.lower(),
+            'qualifier': qualifier.lower() if qualifier else None,
+            'operator': operator,
+            'literal': unquoteLiteral(literalToken.value) if literalToken.ttype in String.Single else literalToken.value,
+            'token': literalToken
+        })
+    return results
+
+def findLiteralComparisons(statement: TokenList, schema: Optional[Set[Tuple[str, str]]] = None) -> List[LiteralReference]:
+    """
+    Finds string literals compared against a column with =, <>, != or [NOT] IN (...).
+
+    Args:
+        statement (TokenList): A parsed sqlparse statement.
+        schema (Optional[Set[Tuple[str, str]]]): Known (table, column) pairs; see `analyseLiteralComparisons`.
+
+    Returns:
+        List[LiteralReference]: One entry per literal. `table` is the base table the column resolves
+        to (through aliases, CTEs and derived tables); for unresolvable columns it is the qualifier
+        when there is one, otherwise None. `token` is the sqlparse leaf holding the literal.
+    """
+    return [
+        {
+            'table': comparison['table'] or comparison['qualifier'],
+            'column': comparison['column'],
+            'operator': comparison['operator'],
+            'literal': comparison['literal'],
+            'token': comparison['token']
+        }
+        for comparison in analyseLiteralComparisons(statement, schema)
+        if comparison['token'].ttype in String.Single and comparison['operator'] in equalityOperators | {'IN', 'NOT IN'}
+    ]
+
+def whereColumns(sqlQuery: str, schema: Optional[Set[Tuple[str, str]]] = None) -> List[ColumnReference]:
+    """
+    The base-table columns filtered against string literals in `sqlQuery` (=, <>, !=, [NOT] LIKE,
+    [NOT] ILIKE, [NOT] IN), in WHERE, JOIN ... ON and HAVING conditions at any nesting level.
+
+    Args:
+        sqlQuery (str): A single SQL statement.
+        schema (Optional[Set[Tuple[str, str]]]): Known (table, column) pairs; see `analyseLiteralComparisons`.
+
+    Returns:
+        List[ColumnReference]: Distinct {'table', 'column'} pairs, in query order. Columns that
+        cannot be resolved to a base table are left out.
+    """
+    parsed = sqlparse.parse(sqlQuery)
+    if len(parsed) != 1:
+        return []
+    columns: Dict[Tuple[str, str], ColumnReference] = {}
+    for comparison in analyseLiteralComparisons(parsed[0], schema):
+        if comparison['table'] and comparison['token'].ttype in String.Single and comparison['operator'] in filterOperators:
+            columns.setdefault((comparison['table'], comparison['column']), {'table': comparison['table'], 'column': comparison['column']})
+    return list(columns.values())
+
+def rewriteLiterals(sqlQuery: str, resolve: Callable[[LiteralReference, List[str]], Optional[str]], schema: Optional[Set[Tuple[str, str]]] = None) -> Dict[str, Any]:
+    """
+    Rewrites the string literals of `sqlQuery` that `resolve` maps to a different stored value.
+
+    Args:
+        sqlQuery (str): A single SQL statement.
+        resolve (Callable): Called with each literal reference and the tables in scope; returns the
+            stored value to use, or None when the literal cannot be resolved.
+        schema (Optional[Set[Tuple[str, str]]]): Known (table, column) pairs; see `analyseLiteralComparisons`.
+
+    Returns:
+        Dict[str, Any]: {'sql': rewritten query, 'replaced': [(column, old, new), ...],
+        'unresolved': [LiteralReference without token, ...]}
+    """
+    parsed = sqlparse.parse(sqlQuery)
+    if len(parsed) != 1:
+        return {'sql': sqlQuery, 'replaced': [], 'unresolved': []}
+    statement = parsed[0]
+    tables = sorted(set(tableAliases(statement).values()))
+
+    replaced, unresolved = [], []
+    for reference in findLiteralComparisons(statement, schema):
+        value = resolve(reference, tables)
+        if value is None:
+            unresolved.append({key: item for key, item in reference.items() if key != 'token'})
+        elif value != reference['literal']:
+            reference['token'].value = quoteLiteral(value)
+            reference['token'].normalized = reference['token'].value
+            replaced.append((reference['column'], reference['literal'], value))
+    return {'sql': str(statement), 'replaced': replaced, 'unresolved': unresolved}
+
+def canonicalSql(sqlQuery: str) -> str:
+    """
+    A canonical form of `sqlQuery` for use as a cache key: comments dropped, keywords upper-cased,
+    unquoted identifiers lower-cased (as Postgres folds them), tokens separated by single spaces and
+    the trailing semicolon removed. String literals and quoted identifiers are kept verbatim, so two
+    queries share a canonical form only if they differ in layout or case alone.
+    """
+    tokens = []
+    for statement in sqlparse.parse(sqlQuery):
+        for token in statement.flatten():
+            if token.is_whitespace or token.ttype in Whitespace or token.ttype in Comment:
+                continue
+            if token.ttype in Keyword:
+                ## Multi-word keywords (ORDER BY, LEFT JOIN) keep their inner whitespace
+                tokens.append(" ".join(token.value.upper().split()))
+            elif token.ttype in Name:
+                tokens.append(token.value.lower())
+            else:
+                tokens.append(token.value)
+    while tokens and tokens[-1] == ';':
+        tokens.pop()
+    return " ".join(tokens)
@@ -0,0 +1,272 @@
+## telemetry.py
+## Per-stage spans for the query pipeline, exported as Prometheus histograms and (optionally) OpenTelemetry traces.
+
+import bisect
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
+
+from dotenv import load_dotenv
+
+try:
+    from opentelemetry import trace as otelTrace
+except ImportError:
+    otelTrace = None
+
+logger = logging.getLogger(__name__)
+
+load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '../resources/.ENV'))
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+## Read once at import: with telemetry off the decorators return the functions unchanged and
+## `span` hands out a shared no-op, so the instrumented code pays one attribute check per stage
+enabled = os.getenv("TELEMETRY_ENABLED", "false").lower() == "true"
+otelEnabled = enabled and otelTrace is not None and os.getenv("TELEMETRY_OTEL_ENABLED", "true").lower() == "true"
+## A proxy until a provider is installed, after which it delegates to the provider's tracer
+_tracer = otelTrace.get_tracer("elecdata") if otelEnabled else None
+
+## Seconds; model calls dominate the upper buckets, cache lookups the lower ones
+defaultBuckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escapeLabel(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Histogram:
+    """
+    A labelled Prometheus histogram, rendered in the text exposition format (version 0.0.4).
+
+    Thread-safe; values are kept per process, so with several workers each one is scraped on its own.
+    """
+    def __init__(self, name: str, documentation: str, labelNames: Sequence[str], buckets: Sequence[float] = defaultBuckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        self.buckets = tuple(sorted(buckets))
+        ## labels -> [count per bucket (non-cumulative, last one is +Inf), sum]
+        self._series: Dict[Tuple[str, ...], List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelValues: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelValues)
+            if series is None:
+                series = self._series[labelValues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in sorted(self._series.items())]
+        for labelValues, counts, total in series:
+            labels = ",".join(f'{name}="{_escapeLabel(value)}"' for name, value in zip(self.labelNames, labelValues))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total!r}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+    def reset(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+stageDuration = Histogram(
+    "elecdata_stage_duration_seconds",
+    "Duration of query pipeline stages, chat history and SQL calls.",
+    ("stage", "outcome")
+)
+requestDuration = Histogram(
+    "elecdata_http_request_duration_seconds",
+    "Duration of HTTP requests by route template, including streamed bodies.",
+    ("method", "route", "status")
+)
+metrics = [stageDuration, requestDuration]
+
+def renderMetrics() -> str:
+    """Every metric in the Prometheus text exposition format."""
+    return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+class _NoopSpan:
+    """Shared stand-in returned by `span` while telemetry is disabled."""
+    def __enter__(self) -> '_NoopSpan':
+        return self
+
+    def __exit__(self, *exc: Any) -> bool:
+        return False
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    def setOutcome(self, outcome: str) -> None:
+        pass
+
+_noopSpan = _NoopSpan()
+
+class Span:
+    """
+    Times one stage: the duration is observed in `elecdata_stage_duration_seconds` under the
+    stage name and its outcome, and, with OpenTelemetry available, recorded as a span that is a
+    child of the current one.
+
+    The outcome is `ok`, `error` when an exception escapes, `cancelled` when the task is
+    cancelled, or whatever `setOutcome` set (e.g. `cached`).
+    """
+    def __init__(self, name: str, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.attributes = attributes or {}
+        self.outcome = "ok"
+        self._startedAt = 0.0
+        self._otelScope = None
+        self._otelSpan = None
+
+    def __enter__(self) -> 'Span':
+        if _tracer is not None:
+            self._otelScope = _tracer.start_as_current_span(self.name, attributes=self.attributes)
+            self._otelSpan = self._otelScope.__enter__()
+        self._startedAt = time.perf_counter()
+        return self
+
+    def __exit__(self, excType: Any, excValue: Any, traceback: Any) -> bool:
+        elapsed = time.perf_counter() - self._startedAt
+        if excType is not None:
+            self.outcome = "cancelled" if excType.__name__ in ("CancelledError", "GeneratorExit") else "error"
+        stageDuration.observe(elapsed, self.name, self.outcome)
+        if self._otelScope is not None:
+            self._otelSpan.set_attribute("outcome", self.outcome)
+            try:
+                self._otelScope.__exit__(excType, excValue, traceback)
+            except BaseException as e:
+                ## The span records the exception and re-raises it; it propagates from the `with` anyway
+                if e is not excValue:
+                    raise
+        return False
+
+    def set(self, key: str, value: Any) -> None:
+        """Adds an attribute to the trace span (not a metric label, so any value is fine)."""
+        if self._otelSpan is not None:
+            self._otelSpan.set_attribute(key, value)
+
+    def setOutcome(self, outcome: str) -> None:
+        self.outcome = outcome
+        self.set("outcome", outcome)
+
+def span(name: str, **attributes: Any):
+    """
+    Context manager timing a stage named `name` (a fixed string, as it becomes a metric label);
+    `attributes` go on the trace span only. A shared no-op when telemetry is disabled.
+    """
+    if not enabled:
+        return _noopSpan
+    return Span(name, attributes)
+
+def traced(name: str) -> Callable[[F], F]:
+    """Decorator wrapping every call of a function or coroutine function in `span(name)`; a no-op when disabled."""
+    def decorate(function: F) -> F:
+        if not enabled:
+            return function
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def asyncWrapper(*args: Any, **kwargs: Any) -> Any:
+                with Span(name):
+                    return await function(*args, **kwargs)
+            return asyncWrapper
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def traceMethods(prefix: str) -> Callable[[type], type]:
+    """Class decorator applying `traced("<prefix>.<method>")` to every public method defined on the class."""
+    def decorate(cls: type) -> type:
+        if not enabled:
+            return cls
+        for name, member in list(vars(cls).items()):
+            if not name.startswith('_') and inspect.isfunction(member):
+                setattr(cls, name, traced(f"{prefix}.{name}")(member))
+        return cls
+    return decorate
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware observing every HTTP request in `elecdata_http_request_duration_seconds`.
+
+    Requests are labelled with the route template (`/api/chats/{chatId}/messages`, not the
+    concrete path) so the series stay bounded; paths that match no route are labelled
+    `unmatched`. The time runs until the last body chunk is sent, so streamed answers count in full.
+    """
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = ["500"]
+
+        async def sendWithStatus(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                status[0] = str(message["status"])
+            await send(message)
+
+        startedAt = time.perf_counter()
+        try:
+            await self.app(scope, receive, sendWithStatus)
+        finally:
+            route = scope.get("route")
+            requestDuration.observe(
+                time.perf_counter() - startedAt,
+                scope["method"],
+                getattr(route, "path", None) or "unmatched",
+                status[0]
+            )
+
+_tracerProvider = None
+
+def configureTracing() -> bool:
+    """
+    Installs an OpenTelemetry SDK tracer provider with an OTLP exporter when spans are enabled, the
+    SDK and exporter packages are installed and OTEL_EXPORTER_OTLP_ENDPOINT (or the traces-specific
+    variant) is set. The exporter, service name and sampler follow the standard OTEL_* variables.
+    Does nothing if the app already runs under another provider (e.g. `opentelemetry-instrument`).
+
+    Returns:
+        bool: Whether a provider was installed.
+    """
+    global _tracerProvider
+    if not otelEnabled or _tracerProvider is not None:
+        return False
+    if not (os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT") or os.getenv("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")):
+        return False
+    if type(otelTrace.get_tracer_provider()).__name__ != "ProxyTracerProvider":
+        return False
+    try:
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError as e:
+        logger.warning(f"OpenTelemetry export is not configured, install opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http: {str(e)}")
+        return False
+    provider = TracerProvider()
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    otelTrace.set_tracer_provider(provider)
+    _tracerProvider = provider
+    logger.info("Exporting OpenTelemetry traces over OTLP")
+    return True
+
+def closeTelemetry() -> None:
+    """Flushes and shuts down the tracer provider installed by `configureTracing`, if any."""
+    global _tracerProvider
+    if _tracerProvider is not None:
+        _tracerProvider.shutdown()
+        _tracerProvider = None
@@ -0,0 +1,283 @@
+## valueIndex.py
+
+import difflib
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple, TypedDict
+
+from sqlalchemy.sql import text
+
+from .agentHelpers import getPostgresEngine
+from .sqlAnalysis import LiteralReference, rewriteLiterals
+
+logger = logging.getLogger(__name__)
+
+## Type aliases
+ValueMatch = TypedDict('ValueMatch', {
+    'value': str,
+    'method': str,
+    'score': float
+})
+
+## A stored value found in a question; start/end index the normalised question
+ValueMention = TypedDict('ValueMention', {
+    'start': int,
+    'end': int,
+    'value': str,
+    'columns': List[Tuple[str, str]]
+})
+
+## Values shorter than this are too generic ("Y", "NO") to be treated as question entities
+minMentionLength = 3
+maxMentionWords = 6
+
+textTypes = ('text', 'character varying', 'character')
+
+def _normalise(value: str) -> str:
+    return " ".join(value.casefold().split())
+
+def _trigrams(value: str) -> Set[str]:
+    padded = f"  {_normalise(value)} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class ColumnValues:
+    """
+    Lookup structures for the distinct values of one column.
+
+    Attributes:
+        values (List[str]): The stored values.
+        exact (Set[str]): `values` as a set.
+        folded (Dict[str, List[str]]): Case/whitespace-normalised value -> stored values.
+        trigrams (Dict[str, Set[str]]): Trigram -> stored values containing it.
+    """
+    def __init__(self, values: List[str]):
+        self.values = values
+        self.exact = set(values)
+        self.folded: Dict[str, List[str]] = {}
+        self.trigrams: Dict[str, Set[str]] = {}
+        self._valueTrigrams: Dict[str, Set[str]] = {}
+        for value in values:
+            self.folded.setdefault(_normalise(value), []).append(value)
+            grams = _trigrams(value)
+            self._valueTrigrams[value] = grams
+            for gram in grams:
+                self.trigrams.setdefault(gram, set()).add(value)
+
+    def match(self, literal: str, trigramThreshold: float, fuzzyCutoff: float) -> Optional[ValueMatch]:
+        """
+        Matches `literal` against the column values: exact, then case-insensitive, then trigram
+        similarity, then fuzzy (difflib) similarity. Ambiguous matches return None.
+        """
+        if literal in self.exact:
+            return {'value': literal, 'method': 'exact', 'score': 1.0}
+
+        folded = self.folded.get(_normalise(literal))
+        if folded:
+            if len(folded) == 1:
+                return {'value': folded[0], 'method': 'caseInsensitive', 'score': 1.0}
+            return None
+
+        grams = _trigrams(literal)
+        candidates = set()
+        for gram in grams:
+            candidates |= self.trigrams.get(gram, set())
+        scored = sorted(
+            ((len(grams & self._valueTrigrams[value]) / len(grams | self._valueTrigrams[value]), value) for value in candidates),
+            reverse=True
+        )
+        if scored and scored[0][0] >= trigramThreshold and (len(scored) == 1 or scored[0][0] - scored[1][0] >= 0.1):
+            return {'value': scored[0][1], 'method': 'trigram', 'score': scored[0][0]}
+
+        normalised = _normalise(literal)
+        ratios = [
+            (difflib.SequenceMatcher(None, normalised, candidate).ratio(), candidate)
+            for candidate in difflib.get_close_matches(normalised, list(self.folded), n=2, cutoff=fuzzyCutoff)
+        ]
+        if ratios and (len(ratios) == 1 or ratios[0][0] > ratios[1][0]) and len(self.folded[ratios[0][1]]) == 1:
+            return {'value': self.folded[ratios[0][1]][0], 'method': 'fuzzy', 'score': ratios[0][0]}
+        return None
+
+class ValueIndex:
+    """
+    Index of the distinct values of the low-cardinality text columns of a database.
+
+    The index is built in a background thread at startup and rebuilt periodically. It resolves the
+    string literals the model writes into WHERE conditions (e.g. 'sydney') onto stored values
+    (e.g. 'Sydney') so most queries do not need an LLM round trip to ground them.
+
+    Configuration (read from the environment):
+        VALUE_INDEX_ENABLED: Build and use the index (default true).
+        VALUE_INDEX_MAX_CARDINALITY: Columns with more distinct values are not indexed (default 500).
+        VALUE_INDEX_REFRESH_SECONDS: Rebuild interval (default 3600).
+        VALUE_INDEX_TRIGRAM_THRESHOLD: Minimum trigram Jaccard similarity for a match (default 0.5).
+        VALUE_INDEX_FUZZY_CUTOFF: Minimum difflib ratio for a fuzzy match (default 0.85).
+
+    Attributes:
+        dbName (str): The database to index.
+        ready (bool): Whether the index has been built at least once.
+    """
+    def __init__(self, dbName: str):
+        self.dbName = dbName
+        self.enabled = os.getenv("VALUE_INDEX_ENABLED", "true").lower() == "true"
+        self.maxCardinality = int(os.getenv("VALUE_INDEX_MAX_CARDINALITY", 500))
+        self.refreshSeconds = float(os.getenv("VALUE_INDEX_REFRESH_SECONDS", 3600))
+        self.trigramThreshold = float(os.getenv("VALUE_INDEX_TRIGRAM_THRESHOLD", 0.5))
+        self.fuzzyCutoff = float(os.getenv("VALUE_INDEX_FUZZY_CUTOFF", 0.85))
+        self.ready = False
+        self.builtAt: Optional[float] = None
+        self._columns: Dict[Tuple[str, str], ColumnValues] = {}
+        self._columnTypes: Dict[Tuple[str, str], bool] = {}
+        self._phrases: Dict[str, Dict[Tuple[str, str], str]] = {}
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _loadColumns(self, connection) -> List[Tuple[str, str, str]]:
+        rows = connection.execute(text(
+            "SELECT table_name, column_name, data_type FROM information_schema.columns "
+            "WHERE table_schema = current_schema()"
+        )).fetchall()
+        return [
+            (table, column, dataType) for table, column, dataType in rows
+            if not (table.lower().startswith('auth') or table.lower().startswith('django'))
+        ]
+
+    def build(self) -> None:
+        """Reads the schema and the distinct values of every text column, then swaps the new index in."""
+        startedAt = time.perf_counter()
+        engine = getPostgresEngine(self.dbName)
+        preparer = engine.dialect.identifier_preparer
+        columns: Dict[Tuple[str, str], ColumnValues] = {}
+        columnTypes: Dict[Tuple[str, str], bool] = {}
+        with engine.connect() as connection:
+            for table, column, dataType in self._loadColumns(connection):
+                key = (table.lower(), column.lower())
+                isText = dataType in textTypes
+                columnTypes[key] = isText
+                if not isText:
+                    continue
+                values = connection.execute(text(
+                    f"SELECT DISTINCT {preparer.quote(column)} FROM {preparer.quote(table)} "
+                    f"WHERE {preparer.quote(column)} IS NOT NULL LIMIT {self.maxCardinality + 1}"
+                )).scalars().all()
+                if len(values) <= self.maxCardinality:
+                    columns[key] = ColumnValues([str(value) for value in values])
+            connection.rollback()
+
+        phrases: Dict[str, Dict[Tuple[str, str], str]] = {}
+        for key, columnValues in columns.items():
+            for folded, values in columnValues.folded.items():
+                if len(folded) >= minMentionLength and len(values) == 1 and any(char.isalpha() for char in folded):
+                    phrases.setdefault(folded, {})[key] = values[0]
+
+        self._columns, self._columnTypes, self._phrases = columns, columnTypes, phrases
+        self.ready = True
+        self.builtAt = time.time()
+        logger.info(f"Value index built: {len(columns)} columns, {sum(len(c.values) for c in columns.values())} values in {time.perf_counter() - startedAt:.2f}s")
+
+    def _refreshLoop(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.build()
+            except Exception as e:
+                logger.exception(f"Value index build failed: {str(e)}")
+            self._stopped.wait(self.refreshSeconds)
+
+    def start(self) -> None:
+        """Builds the index in a daemon thread and keeps refreshing it every `refreshSeconds`."""
+        if not self.enabled or self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._refreshLoop, name="value-index", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread = None
+
+    def lookup(self, table: str, column: str, literal: str) -> Optional[ValueMatch]:
+        """Matches `literal` against the indexed values of `table`.`column`."""
+        columnValues = self._columns.get((table.lower(), column.lower()))
+        if columnValues is None:
+            return None
+        return columnValues.match(literal, self.trigramThreshold, self.fuzzyCutoff)
+
+    def schemaNames(self) -> Set[Tuple[str, str]]:
+        """Returns the (table, column) pairs of the indexed schema, lower-cased."""
+        return set(self._columnTypes)
+
+    def findMentions(self, question: str) -> List[ValueMention]:
+        """
+        Finds the indexed values mentioned in `question` (e.g. a seat or party name), longest first
+        and without overlaps.
+
+        Args:
+            question (str): Text already normalised with `_normalise`.
+
+        Returns:
+            List[ValueMention]: The mentions in question order.
+        """
+        phrases = self._phrases
+        words = [(match.start(), match.end()) for match in re.finditer(r'\S+', question)]
+        mentions: List[ValueMention] = []
+        taken = [False] * len(words)
+        for size in range(min(maxMentionWords, len(words)), 0, -1):
+            for first in range(len(words) - size + 1):
+                if any(taken[first:first + size]):
+                    continue
+                start, end = words[first][0], words[first + size - 1][1]
+                ## Allow trailing punctuation after the value ("in Kooyong?")
+                candidate = question[start:end]
+                match = phrases.get(candidate) or phrases.get(candidate.rstrip("?!.,;:'\""))
+                if match is None:
+                    continue
+                if candidate not in phrases:
+                    end = start + len(candidate.rstrip("?!.,;:'\""))
+                mentions.append({
+                    'start': start,
+                    'end': end,
+                    'value': next(iter(match.values())),
+                    'columns': sorted(match)
+                })
+                taken[first:first + size] = [True] * size
+        return sorted(mentions, key=lambda mention: mention['start'])
+
+    def resolveLiteral(self, reference: LiteralReference, tables: List[str]) -> Optional[str]:
+        """
+        Resolves one literal found by `sqlAnalysis.findLiteralComparisons`.
+
+        Literals compared against non-text columns are returned unchanged. Literals on unknown or
+        high-cardinality text columns, and literals that match nothing (or different values in
+        different tables), return None.
+        """
+        column = reference['column']
+        candidateTables = [reference['table']] if reference['table'] else tables
+        keys = [(table, column) for table in candidateTables if (table, column) in self._columnTypes]
+        if not keys:
+            return None
+        if not any(self._columnTypes[key] for key in keys):
+            return reference['literal']
+
+        matches = set()
+        for table, _ in keys:
+            if not self._columnTypes[(table, column)]:
+                continue
+            match = self.lookup(table, column, reference['literal'])
+            if match is None:
+                return None
+            matches.add(match['value'])
+        return matches.pop() if len(matches) == 1 else None
+
+    def rewrite(self, sqlQuery: str) -> Dict[str, Any]:
+        """
+        Rewrites the WHERE literals of `sqlQuery` onto indexed values.
+
+        Returns:
+            Dict[str, Any]: See `sqlAnalysis.rewriteLiterals`. When the index is not ready every literal
+            is reported as unresolved.
+        """
+        if not self.ready:
+            return rewriteLiterals(sqlQuery, lambda reference, tables: None)
+        return rewriteLiterals(sqlQuery, self.resolveLiteral, set(self._columnTypes))
@@ -1,26 +1,44 @@
 ## workflows.py
 
 from .agentHelpers import (
-    loadPostgresDatabase
+    getPostgresEngine
     , cleanSqlQuery
     , cleanSummaryResponse
     , QuerySQLTool
+    , QueryCancellation
     , InvalidUserQueryException
+    , QueryTooExpensiveException
     , NoDataFoundException
     , loadLLM
     , loadFromMongo
-    , cleanWhereConditions
     , get_relevant_documents
+    , countTokens
 )
 from .customAgents import SqlExpert, ResponseSummarizer, RouterAgent, ChatAgent, DatasetRegionMatcherAgent
+from .caches import AnswerCache, CachedAnswer, DistinctValueCache, DistinctValues, ResultCache
+from .valueIndex import ValueIndex
+from .sqlAnalysis import ColumnReference, whereColumns
+from .planCache import PlanCache, defaultLogPath as defaultPlanLogPath
+from .resultCompaction import CompactResult, compactResult
+from .schemaSnapshot import SchemaSnapshot, SchemaSnapshotStore, schemaFingerprintSql, usableTableChangesSql
+from .schemaIndex import SchemaIndex, SchemaSelection, defaultLogPath as defaultSchemaLogPath
+from .queryRouter import LocalRouter, defaultLogPath as defaultRouterLogPath, defaultModelPath as defaultRouterModelPath
+from .telemetry import span, traced
 import sys
 import os
 import re
-from typing import Dict, List, Any
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, AsyncIterator, Awaitable, Callable, Optional, Tuple, TypeVar
 from dotenv import load_dotenv
 import logging
 from langchain.base_language import BaseLanguageModel
 import json
+import time
+from langchain_openai import OpenAIEmbeddings
+from sqlalchemy.sql import text
 
 sys.path.append(os.path.dirname(__file__))
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -30,6 +48,17 @@ recourcesPath = os.path.join(os.path.dirname(__file__), '../resources')
 envPath = os.path.join(recourcesPath, '.ENV')
 load_dotenv(dotenv_path=envPath)
 
+T = TypeVar('T')
+
+## Progress events emitted by ElecDataWorkflow.streamUserQuery: {"event": <name>, "data": {...}}
+PipelineEvent = Dict[str, Any]
+
+def _event(name: str, **data: Any) -> PipelineEvent:
+    return {"event": name, "data": data}
+
+## Plain or schema-qualified identifiers only; anything else is not interpolated into SQL
+identifierPattern = re.compile(r'^[A-Za-z_][A-Za-z0-9_$]*(\.[A-Za-z_][A-Za-z0-9_$]*)?$')
+
 class ElecDataWorkflow:
     """
     This class handles electoral data queries.
@@ -40,6 +69,67 @@ class ElecDataWorkflow:
         sqlCoderAgent (SqlExpert): The agent responsible for generating and refining SQL queries.
         sqlQueryTool (QuerySQLTool): The tool used for executing SQL queries.
         responseSummarizerAgent (ResponseSummarizer): The agent responsible for summarizing the results of SQL queries.
+
+    Concurrency limits (per worker process, read from the environment):
+        MAX_CONCURRENT_QUERIES: Pipelines allowed in flight at once; further requests queue (default 256).
+        LLM_MAX_CONCURRENCY: Concurrent model calls across all pipelines (default 64).
+        SQL_MAX_CONCURRENCY: Threads available for blocking SQL execution (default 16).
+
+    DISTINCT-value grounding (read from the environment):
+        DISTINCT_CACHE_TTL_SECONDS: How long a column's DISTINCT values are reused (default 3600).
+        DISTINCT_MAX_VALUES: Values kept per column and passed to the model (default 200).
+
+    Every cache below is kept in the backend selected by CACHE_BACKEND (see `cacheBackends`): the
+    in-process `memory` store (default), a `sqlite` file shared by the workers on a host, or `redis`.
+
+    Answer cache (read from the environment):
+        ANSWER_CACHE_ENABLED: Serve repeated questions from the cache (default true).
+        ANSWER_CACHE_TTL_SECONDS: How long an answer is reused (default 86400).
+        ANSWER_CACHE_MAX_ENTRIES: Answers kept before the least recently used is evicted (default 2048).
+        ANSWER_CACHE_CONTEXT_LINES: Trailing chat history lines that are part of the key (default 4).
+        ANSWER_CACHE_SEMANTIC: Also match similar questions by embedding similarity (default false).
+        ANSWER_CACHE_SIMILARITY_THRESHOLD: Minimum cosine similarity for a semantic hit (default 0.95).
+        ANSWER_CACHE_VERSION_CHECK_SECONDS: How often the schema/data version is re-read (default 60).
+        ANSWER_CACHE_DATA_VERSION: Optional label added to the version; change it to drop all answers.
+            This, or `invalidateAnswers`/`invalidateResults`, is the signal an ETL load should use:
+            the table counters in the version reset on `pg_stat_reset` or a failover.
+
+    SQL result cache (read from the environment):
+        SQL_RESULT_CACHE_ENABLED: Reuse the results of queries already run under the current data version (default true).
+        SQL_RESULT_CACHE_MAX_BYTES: Serialized result bytes kept before the least recently used are evicted (default 268435456).
+        SQL_RESULT_CACHE_MAX_ENTRY_BYTES: Largest single result that is cached (default an eighth of the total).
+        SQL_RESULT_CACHE_TTL_SECONDS: How long a result is reused (default 3600).
+
+    SQL plan cache (read from the environment):
+        PLAN_CACHE_ENABLED: Reuse the SQL of earlier questions with the same template (default true).
+        PLAN_CACHE_TTL_SECONDS: How long a plan is reused (default 604800).
+        PLAN_CACHE_MAX_ENTRIES: Plans kept before the least recently used is evicted (default 4096).
+        PLAN_CACHE_LOG_PATH: JSONL request log of lookups and stores (default backend/data/planCacheRequests.jsonl).
+
+    Local routing (read from the environment):
+        ROUTER_LOCAL_ENABLED: Decide CHAT vs DATABASE locally when confident (default true).
+        ROUTER_MODEL_PATH: Trained router model (default backend/data/routerModel.json); without it only the rules apply.
+        ROUTER_CONFIDENCE: Probability the model needs before deciding without the LLM (default 0.9).
+        ROUTER_LOG_PATH: JSONL routing log used as training data (default backend/data/routerRequests.jsonl).
+
+    Result compaction (read from the environment):
+        RESULT_COMPACTION_ENABLED: Replace results over the budget with a compact description (default true).
+        RESULT_TOKEN_BUDGET: Tokens of query result passed to the summarizer (default 6000).
+
+    Schema snapshot (read from the environment, see `SchemaSnapshotStore` for the others):
+        SCHEMA_SNAPSHOT_WAIT_SECONDS: How long a database question waits for the schema when no
+            snapshot was available at startup (default 30).
+
+    Schema pruning: see `SchemaIndex` for the SCHEMA_PRUNING_* settings. SQL generated from a pruned
+    schema that fails to run is regenerated once from the full schema.
+
+    Query cost guard: see `QuerySQLTool` for the statement timeout and plan limits.
+        SQL_COST_RETRIES: Times SQL rejected as too expensive is regenerated with a "add filters"
+            hint for `SqlExpert` before the user is asked to narrow the question (default 1).
+
+    Tracing: with TELEMETRY_ENABLED=true every stage of a question (routing, cache lookups, schema
+    pruning, SQL generation, grounding, execution, rendering, summarizing) is a span in
+    `elecdata_stage_duration_seconds` and, with OpenTelemetry installed, a trace (see `telemetry`).
     """    
     def __init__(self):
         self.dbName = os.getenv("ELECDATA_DB_NAME")
@@ -47,31 +137,110 @@ class ElecDataWorkflow:
         self.routerAgent = RouterAgent(llm=self.llm)
         self.chatAgent = ChatAgent(llm=self.llm)
         self.sqlCoderAgent = SqlExpert(llm=self.llm)
-        self.sqlQueryTool = QuerySQLTool(dbName=self.dbName)
+        self.resultCache = ResultCache(
+            maxBytes=int(os.getenv("SQL_RESULT_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+            ttlSeconds=float(os.getenv("SQL_RESULT_CACHE_TTL_SECONDS", 3600)),
+            maxEntryBytes=int(os.environ["SQL_RESULT_CACHE_MAX_ENTRY_BYTES"]) if os.getenv("SQL_RESULT_CACHE_MAX_ENTRY_BYTES") else None
+        ) if os.getenv("SQL_RESULT_CACHE_ENABLED", "true").lower() == "true" else None
+        self.sqlQueryTool = QuerySQLTool(dbName=self.dbName, resultCache=self.resultCache)
         self.responseSummarizerAgent = ResponseSummarizer(llm=self.llm)
         self.tableInfo = None
         self.dialect = None
-        self._setTableInfo()
-        self._setDialect()
-
-    def _setTableInfo(self):
-        with loadPostgresDatabase(self.dbName) as db:
-            table_list = db.get_usable_table_names()
-            table_list = [table for table in table_list if not (table.lower().startswith('auth') or table.lower().startswith('django'))]
-            self.tableInfo = db.get_table_info(table_list)
-    
-    def _setDialect(self):
-        with loadPostgresDatabase(self.dbName) as db:
-            self.dialect = db.dialect
-
-    def _generateQuery(self, userQuery: str, chatHistory: str = '') -> str:
-        
+        self._pipelineSlots = asyncio.Semaphore(int(os.getenv("MAX_CONCURRENT_QUERIES", 256)))
+        self._llmSlots = asyncio.Semaphore(int(os.getenv("LLM_MAX_CONCURRENCY", 64)))
+        self._sqlExecutor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("SQL_MAX_CONCURRENCY", 16)),
+            thread_name_prefix="elecdata-sql"
+        )
+        self.distinctValueCache = DistinctValueCache(
+            ttlSeconds=float(os.getenv("DISTINCT_CACHE_TTL_SECONDS", 3600)),
+            maxValues=int(os.getenv("DISTINCT_MAX_VALUES", 200))
+        )
+        self.valueIndex = ValueIndex(self.dbName)
+        self.answerCacheEnabled = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+        self.answerCache = AnswerCache(
+            ttlSeconds=float(os.getenv("ANSWER_CACHE_TTL_SECONDS", 86400)),
+            maxEntries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 2048)),
+            contextLines=int(os.getenv("ANSWER_CACHE_CONTEXT_LINES", 4)),
+            embed=OpenAIEmbeddings().aembed_query if os.getenv("ANSWER_CACHE_SEMANTIC", "false").lower() == "true" else None,
+            similarityThreshold=float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", 0.95)),
+            valueIndex=self.valueIndex
+        )
+        self._versionCheckSeconds = float(os.getenv("ANSWER_CACHE_VERSION_CHECK_SECONDS", 60))
+        self._versionCheckedAt = 0.0
+        self.valueIndex.start()
+        self.localRouterEnabled = os.getenv("ROUTER_LOCAL_ENABLED", "true").lower() == "true"
+        self.localRouter = LocalRouter(
+            self.valueIndex,
+            modelPath=os.getenv("ROUTER_MODEL_PATH") or defaultRouterModelPath,
+            confidence=float(os.getenv("ROUTER_CONFIDENCE", 0.9)),
+            logPath=os.getenv("ROUTER_LOG_PATH") or defaultRouterLogPath
+        )
+        self.planCacheEnabled = os.getenv("PLAN_CACHE_ENABLED", "true").lower() == "true"
+        self.planCache = PlanCache(
+            self.valueIndex,
+            ttlSeconds=float(os.getenv("PLAN_CACHE_TTL_SECONDS", 7 * 86400)),
+            maxEntries=int(os.getenv("PLAN_CACHE_MAX_ENTRIES", 4096)),
+            logPath=os.getenv("PLAN_CACHE_LOG_PATH") or defaultPlanLogPath
+        )
+        self.costRetries = int(os.getenv("SQL_COST_RETRIES", 1))
+        self.resultCompactionEnabled = os.getenv("RESULT_COMPACTION_ENABLED", "true").lower() == "true"
+        self.resultTokenBudget = int(os.getenv("RESULT_TOKEN_BUDGET", 6000))
+        self.schemaIndex = SchemaIndex(self.valueIndex, logPath=os.getenv("SCHEMA_PRUNING_LOG_PATH") or defaultSchemaLogPath)
+        self._schemaWaitSeconds = float(os.getenv("SCHEMA_SNAPSHOT_WAIT_SECONDS", 30))
+        ## Table info and dialect come from the local snapshot; reflection runs in the background
+        self.schemaSnapshot = SchemaSnapshotStore(self.dbName, onChange=self._applySchema)
+        self.schemaSnapshot.start()
+
+    def _applySchema(self, snapshot: SchemaSnapshot) -> None:
+        """Swaps in a loaded or freshly reflected schema."""
+        self.schemaIndex.build(snapshot['tableInfo'], snapshot['comments'])
+        self.tableInfo = snapshot['tableInfo']
+        self.dialect = snapshot['dialect']
+
+    @traced("schema.wait")
+    async def _waitForSchema(self) -> None:
+        """Waits for the first reflection when the app started without a schema snapshot."""
+        if self.schemaSnapshot.ready.is_set():
+            return
+        if not await asyncio.to_thread(self.schemaSnapshot.ready.wait, self._schemaWaitSeconds):
+            raise RuntimeError("The database schema is not available yet, please try again shortly.")
+
+    async def _callLlm(self, call: Callable[..., Awaitable[T]], *args: Any, **kwargs: Any) -> T:
+        """Runs an async agent call under the shared LLM concurrency limit."""
+        async with self._llmSlots:
+            return await call(*args, **kwargs)
+
+    async def _runSql(self, call: Callable[..., T], *args: Any) -> T:
+        """Runs a blocking SQL call on the dedicated SQL thread pool, in the caller's context (as `asyncio.to_thread` does) so its spans join the trace."""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._sqlExecutor, functools.partial(context.run, call, *args))
+
+    @traced("schema.prune")
+    def _schemaCandidates(self, userQuery: str, chatHistory: str) -> List[SchemaSelection]:
+        """The schemas to generate SQL from, in order: the pruned one (if any), then the full one."""
+        full: SchemaSelection = {'tables': self.schemaIndex.tables(), 'tableInfo': self.tableInfo, 'pruned': False}
         try:
-            sqlQuery = self.sqlCoderAgent.generateAndRefineQuery(
+            selection = self.schemaIndex.select(userQuery, chatHistory)
+        except Exception as e:
+            logger.warning(f"Schema pruning failed: {str(e)}")
+            return [full]
+        if not selection['pruned']:
+            return [full]
+        logger.info(f"Pruned schema to {len(selection['tables'])} tables: {selection['tables']}")
+        return [selection, full]
+
+    @traced("sqlExpert.generate")
+    async def _generateQuery(self, userQuery: str, chatHistory: str = '', tableInfo: Optional[str] = None, feedback: str = '') -> str:
+        try:
+            sqlQuery = await self._callLlm(
+                self.sqlCoderAgent.generateAndRefineQueryAsync,
                 userQuery=userQuery,
                 dialect=self.dialect,
-                tableInfo=self.tableInfo,
-                chatHistory=chatHistory
+                tableInfo=tableInfo or self.tableInfo,
+                chatHistory=chatHistory,
+                feedback=feedback
             )
             sqlQuery = cleanSqlQuery(sqlQuery)
             return sqlQuery
@@ -79,69 +248,407 @@ class ElecDataWorkflow:
             logger.exception(f"Error generating SQL query: {str(e)}")
             raise
 
-    def _executeSqlQuery(self, sqlQuery):
+    @traced("sql.execute")
+    async def _executeSqlQuery(self, sqlQuery: str, useCache: bool = True):
+        """Runs `sqlQuery` on the SQL thread pool; if the calling task is cancelled (e.g. the client went away) the query is cancelled on the server."""
+        if self.resultCache is not None and useCache:
+            await self._refreshDataVersion()
+        cancellation = QueryCancellation()
         try:
-            data = self.sqlQueryTool.executeQuery(sqlQuery)
-            return data
+            return await self._runSql(self.sqlQueryTool.executeQuery, sqlQuery, useCache, cancellation)
+        except asyncio.CancelledError:
+            cancellation.cancel()
+            raise
+        except QueryTooExpensiveException as e:
+            logger.warning(f"Query too expensive: {str(e)}")
+            raise
         except Exception as e:
             logger.exception(f"Error executing SQL query: {str(e)}")
             raise
 
-    def processUserQuery(self, userQuery: str, chatHistory: str = '') -> str:
+    @traced("result.render")
+    async def _renderResult(self, data) -> CompactResult:
+        """Renders the result for the summarizer within `RESULT_TOKEN_BUDGET`, compacting it when needed."""
+        try:
+            return await asyncio.to_thread(compactResult, data, self.resultTokenBudget, countTokens, self.resultCompactionEnabled)
+        except Exception as e:
+            logger.warning(f"Result compaction failed, passing the full result: {str(e)}")
+            text = data.to_string()
+            return {'text': text, 'compacted': False, 'rowCount': len(data), 'rowsShown': len(data), 'tokens': countTokens(text)}
+
+    @staticmethod
+    def _rowLimitNote(data) -> str:
+        """A note for the summarizer when the cost guard fetched only the first rows of the result."""
+        if not data.attrs.get('rowLimit') or len(data) < data.attrs['rowLimit']:
+            return ""
+        return (
+            f"NOTE: The result was estimated at about {data.attrs['estimatedRows']:.0f} rows; only the first "
+            f"{data.attrs['rowLimit']} were fetched. Say that the answer is based on part of the result.\n"
+        )
+
+    @traced("grounding.distinctValues")
+    async def _getDistinctValues(self, table: str, column: str) -> Optional[DistinctValues]:
+        """
+        Returns the DISTINCT values of `table`.`column`, from the cache when possible.
+
+        Only `maxValues + 1` rows are fetched so the cache can tell a capped column from a complete one.
+        Lookups that fail (e.g. a column the model invented) are logged and skipped rather than
+        failing the whole query.
+
+        Returns:
+            Optional[DistinctValues]: The values, or None if the column could not be looked up.
+        """
+        if not (identifierPattern.match(table) and identifierPattern.match(column)):
+            logger.warning(f"Skipping DISTINCT lookup for unsafe identifier: {table}.{column}")
+            return None
+        cached = self.distinctValueCache.get(table, column)
+        if cached is not None:
+            return cached
+
+        selectQuery = f"SELECT DISTINCT {column} FROM {table} LIMIT {self.distinctValueCache.maxValues + 1};"
+        try:
+            result = await self._runSql(self.sqlQueryTool.executeQuery, selectQuery)
+            values = result.iloc[:, 0].tolist()
+        except NoDataFoundException:
+            values = []
+        except Exception as e:
+            logger.warning(f"DISTINCT lookup failed for {table}.{column}: {str(e)}")
+            return None
+        return self.distinctValueCache.set(table, column, values)
+
+    async def _buildWhereContext(self, filteredColumns: List[ColumnReference]) -> str:
+        """Looks up the DISTINCT values of every WHERE column concurrently and formats them for the prompt."""
+        columns = list(dict.fromkeys((item['table'], item['column']) for item in filteredColumns if item.get('table') and item.get('column')))
+        results = await asyncio.gather(*(self._getDistinctValues(table, column) for table, column in columns))
+
+        context = ""
+        for (table, column), distinctValues in zip(columns, results):
+            if distinctValues is None:
+                continue
+            values = ", ".join(distinctValues['values'])
+            suffix = f" (first {len(distinctValues['values'])} values only)" if distinctValues['truncated'] else ""
+            context += f"Distinct values of {table}.{column}{suffix}: {values}\n"
+        return context
+
+    @traced("grounding")
+    async def _groundWhereConditions(self, sqlQuery: str, userQuery: str) -> str:
+        """
+        Snaps the WHERE literals of `sqlQuery` onto stored values.
+
+        The value index rewrites the literals deterministically. When some literal could not be
+        resolved, the filtered columns are found statically, their DISTINCT values looked up and
+        the LLM asked to update the conditions.
+        """
+        rewrite = self.valueIndex.rewrite(sqlQuery)
+        if rewrite['replaced']:
+            logger.info(f"Value index rewrote literals: {rewrite['replaced']}")
+        if not rewrite['unresolved']:
+            return rewrite['sql']
+
+        logger.info(f"Unresolved literals, grounding with the LLM: {rewrite['unresolved']}")
+        sqlQuery = rewrite['sql']
+        filteredColumns = whereColumns(sqlQuery, self.valueIndex.schemaNames() if self.valueIndex.ready else None)
+        logger.info(f"Extracted WHERE columns: {filteredColumns}")
+        context = await self._buildWhereContext(filteredColumns)
+        logger.info(f"Context: {context}")
+        with span("sqlExpert.updateWhere"):
+            updatedQuery = await self._callLlm(self.sqlCoderAgent.updateWhereConditionsAsync, sqlQuery, userQuery, context)
+        return cleanSqlQuery(updatedQuery)
+
+    def _readDataVersion(self) -> Tuple[str, int]:
+        """
+        Fingerprints the schema (column names and types) and the data (insert/update/delete counters
+        of the usable tables of the current schema) of the electoral database.
+
+        The counters are a best-effort signal: they are per server statistics, restart from zero on
+        `pg_stat_reset` or a failover and can lag behind a commit. Loads should change
+        ANSWER_CACHE_DATA_VERSION or call the `invalidate*` methods instead of relying on them.
+        """
+        with getPostgresEngine(self.dbName).connect() as connection:
+            schemaHash, changes = connection.execute(text(
+                f"SELECT ({schemaFingerprintSql}), ({usableTableChangesSql})"
+            )).one()
+            connection.rollback()
+        return schemaHash, changes
+
+    @traced("dataVersion.refresh")
+    async def _refreshDataVersion(self) -> None:
+        """
+        Re-reads the data version at most every `ANSWER_CACHE_VERSION_CHECK_SECONDS`. A data change
+        empties the answer and SQL result caches; a schema change also empties the plan cache and re-reflects the
+        schema snapshot.
+        """
+        if time.monotonic() - self._versionCheckedAt < self._versionCheckSeconds:
+            return
+        self._versionCheckedAt = time.monotonic()
+        try:
+            schemaHash, changes = await self._runSql(self._readDataVersion)
+        except Exception as e:
+            logger.warning(f"Could not read the data version: {str(e)}")
+            return
+        version = f"{os.getenv('ANSWER_CACHE_DATA_VERSION', '')}:{schemaHash}:{changes}"
+        if self.answerCache.setDataVersion(version):
+            logger.info(f"Data version changed to {version}, answer cache cleared")
+        if self.resultCache is not None and self.resultCache.setDataVersion(version):
+            logger.info("Data version changed, SQL result cache cleared")
+        if self.planCache.setSchemaVersion(schemaHash):
+            logger.info("Schema changed, plan cache cleared")
+        if self.schemaSnapshot.validated and schemaHash != self.schemaSnapshot.fingerprint:
+            self.schemaSnapshot.requestRevalidation()
+
+    @traced("answerCache.lookup")
+    async def _cachedAnswer(self, userQuery: str, chatHistory: str, useCache: bool) -> Optional[CachedAnswer]:
+        if not self.answerCacheEnabled:
+            return None
+        if not useCache:
+            self.answerCache.recordBypass()
+            return None
+        await self._refreshDataVersion()
+        try:
+            cached = await self.answerCache.get(userQuery, chatHistory)
+        except Exception as e:
+            logger.warning(f"Answer cache lookup failed: {str(e)}")
+            return None
+        if cached is None:
+            return None
+        logger.info(f"Answer cache hit ({cached['tier']}) for: {userQuery}")
+        return cached
+
+    @traced("answerCache.store")
+    async def _storeAnswer(self, userQuery: str, chatHistory: str, event: PipelineEvent) -> None:
+        if not self.answerCacheEnabled or event["data"].get("error"):
+            return
+        try:
+            await self.answerCache.set(userQuery, chatHistory, event["data"]["content"])
+        except Exception as e:
+            logger.warning(f"Answer cache store failed: {str(e)}")
+
+    @traced("planCache.lookup")
+    async def _cachedPlan(self, userQuery: str, useCache: bool) -> Optional[str]:
+        if not (self.planCacheEnabled and useCache):
+            return None
+        await self._refreshDataVersion()
+        try:
+            return self.planCache.lookup(userQuery)
+        except Exception as e:
+            logger.warning(f"Plan cache lookup failed: {str(e)}")
+            return None
+
+    def _storePlan(self, userQuery: str, sqlQuery: str, chatHistory: str) -> None:
+        if not self.planCacheEnabled:
+            return
+        try:
+            self.planCache.store(userQuery, sqlQuery, chatHistory)
+        except Exception as e:
+            logger.warning(f"Plan cache store failed: {str(e)}")
+
+    def invalidateAnswers(self) -> None:
+        """Drops every cached answer, e.g. after a data load that the version check has not seen yet."""
+        self.answerCache.clear()
+
+    def invalidateResults(self) -> None:
+        """Invalidates every cached SQL result by bumping the result cache's generation, e.g. straight after an ETL load."""
+        if self.resultCache is not None:
+            self.resultCache.bumpVersion()
+
+    def invalidateDistinctValues(self, table: Optional[str] = None, column: Optional[str] = None) -> int:
+        """Drops cached DISTINCT values, e.g. after a data load. Returns the number of entries removed."""
+        return self.distinctValueCache.invalidate(table, column)
+
+    def processUserQuery(self, userQuery: str, chatHistory: str = '', useCache: bool = True) -> str:
+        """
+        Blocking entry point for scripts and notebooks; runs `processUserQueryAsync` on a fresh event loop.
+        Must not be called from inside a running event loop (use `processUserQueryAsync` there).
+        """
+        return asyncio.run(self.processUserQueryAsync(userQuery, chatHistory, useCache))
+
+    async def processUserQueryAsync(self, userQuery: str, chatHistory: str = '', useCache: bool = True) -> str:
         """
         Process user's query --> generate a SQL query, execute it, and summarize the results.
 
+        Model calls use `ainvoke` and SQL runs on a thread pool, so the event loop stays free while a
+        pipeline waits. Cancelling the awaiting task (e.g. when the client disconnects) aborts any
+        in-flight model call.
+
         Args:
             userQuery (str): The user's query.
             chatHistory (str, optional): The chat history. Defaults to an empty string.
+            useCache (bool, optional): Set to False to bypass the answer cache and run the full pipeline.
 
         Returns:
-            str: The summary of the results.
+            str: The summary of the results, or a user-facing error message.
+        """
+        with span("pipeline", stream=False) as pipelineSpan:
+            cached = await self._cachedAnswer(userQuery, chatHistory, useCache)
+            if cached is not None:
+                pipelineSpan.setOutcome("cached")
+                return cached['content']
+            response = "An error occurred: No response generated, Please try again."
+            async with self._pipelineSlots:
+                async for event in self._runPipeline(userQuery, chatHistory, streamAnswer=False, useCache=useCache):
+                    if event["event"] == "answer":
+                        response = event["data"]["content"]
+                        if event["data"].get("error"):
+                            pipelineSpan.setOutcome("error")
+                        await self._storeAnswer(userQuery, chatHistory, event)
+            return response
+
+    async def streamUserQuery(self, userQuery: str, chatHistory: str = '', useCache: bool = True) -> AsyncIterator[PipelineEvent]:
+        """
+        Streaming variant of `processUserQueryAsync`.
+
+        Yields `{"event": <name>, "data": <dict>}` items as the pipeline progresses:
+            routed: {"queryType", "source"} once the router has decided; source is rules, model or llm.
+            sqlGenerated: {"sql"} for the initial query, then again with the grounded query; a query
+                reused from the plan cache is sent once with {"cached": true}.
+            rowsFetched: {"rowCount", "columns", "compacted"} after the final query ran; `compacted`
+                is true when the summarizer got a compact description instead of every row.
+            token: {"content"} for each piece of the answer as the model produces it.
+            answer: {"content"} the complete, cleaned answer (always the last event). Answers served
+                from the answer cache are the only event and carry {"cached": "exact" | "semantic"};
+                failed pipelines carry {"error": true}.
 
-        Raises:
-            InvalidUserQueryException: If the user's query is invalid.
-            NoDataFoundException: If no data is found for the user's query.
-            Exception: If an error occurs while processing the user's query.
+        Closing the generator early cancels the in-flight work.
         """
+        with span("pipeline", stream=True) as pipelineSpan:
+            cached = await self._cachedAnswer(userQuery, chatHistory, useCache)
+            if cached is not None:
+                pipelineSpan.setOutcome("cached")
+                yield _event("answer", content=cached['content'], cached=cached['tier'])
+                return
+            async with self._pipelineSlots:
+                async for event in self._runPipeline(userQuery, chatHistory, streamAnswer=True, useCache=useCache):
+                    if event["event"] == "answer":
+                        if event["data"].get("error"):
+                            pipelineSpan.setOutcome("error")
+                        await self._storeAnswer(userQuery, chatHistory, event)
+                    yield event
+
+    async def _streamLlm(self, stream: AsyncIterator[str]) -> AsyncIterator[str]:
+        """Iterates a token stream while holding an LLM concurrency slot."""
+        async with self._llmSlots:
+            async for token in stream:
+                yield token
+
+    @traced("route")
+    async def _routeQuery(self, userQuery: str, chatHistory: str) -> Tuple[str, str]:
+        """
+        Decides CHAT vs DATABASE with the local router when it is confident, otherwise with
+        `RouterAgent`. The LLM decisions are logged as training labels for the local router.
+
+        Returns:
+            Tuple[str, str]: The query type and what decided it (rules, model or llm).
+        """
+        indicators = None
+        if self.localRouterEnabled:
+            try:
+                decision, indicators = self.localRouter.route(userQuery, chatHistory)
+                if decision is not None:
+                    return decision['queryType'], decision['source']
+            except Exception as e:
+                logger.warning(f"Local routing failed: {str(e)}")
+
+        queryType = await self._callLlm(self.routerAgent.determineQueryTypeAsync, userQuery, chatHistory)
+        queryType = queryType.strip().upper()
+        if indicators is not None and queryType in ("DATABASE", "CHAT"):
+            self.localRouter.record(userQuery, indicators, {'queryType': queryType, 'source': 'llm', 'probability': float(queryType == "DATABASE")})
+        return queryType, "llm"
+
+    async def _runPipeline(self, userQuery: str, chatHistory: str, streamAnswer: bool, useCache: bool = True) -> AsyncIterator[PipelineEvent]:
         try:
-            queryType = self.routerAgent.determineQueryType(userQuery, chatHistory)
-            if queryType.strip().upper() == "DATABASE":
-                sqlQuery = self._generateQuery(userQuery, chatHistory)
-                logger.info(f"Generated SQL Query: {sqlQuery}")
-
-                whereColumns = self.sqlCoderAgent.extractWhereColumns(sqlQuery)
-                whereColumns = cleanWhereConditions(whereColumns)
-                logger.info(f"Extracted WHERE columns: {whereColumns}")
-                context = ""
-                for column in whereColumns:
-                    selectQuery = f"SELECT DISTINCT {column['column']} FROM {column['table']};"
-                    result = self.sqlQueryTool.executeQuery(selectQuery)
-                    result = result.to_string()
-                    context += f"{selectQuery}\n{result}\n\n"
-                
-                logger.info(f"Context: {context}")
-                updatedQuery = self.sqlCoderAgent.updateWhereConditions(sqlQuery, userQuery, context)
-                updatedQuery = cleanSqlQuery(updatedQuery)
-                logger.info(f"Updated SQL Query: {updatedQuery}")
-
-                data = self._executeSqlQuery(updatedQuery)
-                response = self.responseSummarizerAgent.generateSummaryWithReflection(response=data.to_string(), userQuery=userQuery)
-                response = cleanSummaryResponse(response)
-            elif queryType.strip().upper() == "CHAT":
-                response = self.chatAgent.generateResponse(userQuery, chatHistory)
-            else:
+            queryType, routedBy = await self._routeQuery(userQuery, chatHistory)
+            if queryType not in ("DATABASE", "CHAT"):
                 logger.exception(f"Invalid query type determined: {queryType}")
-                return f"Error determining query type: {queryType}, Please try again."
-            return response
+                yield _event("answer", content=f"Error determining query type: {queryType}, Please try again.", error=True)
+                return
+            yield _event("routed", queryType=queryType, source=routedBy)
+
+            if queryType == "DATABASE":
+                data = None
+                cachedSql = await self._cachedPlan(userQuery, useCache)
+                if cachedSql is not None:
+                    logger.info(f"Plan cache hit: {cachedSql}")
+                    yield _event("sqlGenerated", sql=cachedSql, cached=True)
+                    try:
+                        data = await self._executeSqlQuery(cachedSql, useCache)
+                    except Exception as e:
+                        ## Fall back to generating the query; the plan is dropped so it is relearnt
+                        logger.warning(f"Cached plan failed, regenerating: {str(e)}")
+                        self.planCache.invalidate(userQuery)
+
+                if data is None:
+                    await self._waitForSchema()
+                schemas = self._schemaCandidates(userQuery, chatHistory) if data is None else []
+                attempt, costRetries, feedback = 0, self.costRetries, ''
+                while attempt < len(schemas):
+                    schema = schemas[attempt]
+                    sqlQuery = await self._generateQuery(userQuery, chatHistory, schema['tableInfo'], feedback)
+                    logger.info(f"Generated SQL Query: {sqlQuery}")
+                    yield _event("sqlGenerated", sql=sqlQuery)
+
+                    updatedQuery = await self._groundWhereConditions(sqlQuery, userQuery)
+                    logger.info(f"Updated SQL Query: {updatedQuery}")
+                    yield _event("sqlGenerated", sql=updatedQuery)
+
+                    try:
+                        data = await self._executeSqlQuery(updatedQuery, useCache)
+                    except QueryTooExpensiveException as e:
+                        ## Regenerate from the same schema, telling SqlExpert why the query was rejected
+                        if costRetries <= 0:
+                            raise
+                        costRetries -= 1
+                        feedback = e.hint
+                        logger.warning(f"Regenerating SQL that was too expensive: {e.hint}")
+                        continue
+                    except InvalidUserQueryException as e:
+                        ## The pruned schema may have left out a table the query needed
+                        if attempt == len(schemas) - 1:
+                            raise
+                        logger.warning(f"SQL from the pruned schema failed, regenerating from the full schema: {str(e)}")
+                        attempt += 1
+                        continue
+                    self.schemaIndex.record(userQuery, updatedQuery, schema)
+                    self._storePlan(userQuery, updatedQuery, chatHistory)
+                    break
+                result = await self._renderResult(data)
+                result['text'] = self._rowLimitNote(data) + result['text']
+                if result['compacted']:
+                    logger.info(f"Compacted {result['rowCount']} rows to {result['tokens']} tokens showing {result['rowsShown']} rows")
+                yield _event("rowsFetched", rowCount=len(data), columns=[str(col) for col in data.columns], compacted=result['compacted'])
+
+                with span("summarize", stream=streamAnswer):
+                    if streamAnswer:
+                        tokens = []
+                        async for token in self._streamLlm(self.responseSummarizerAgent.streamSummaryWithReflection(response=result['text'], userQuery=userQuery)):
+                            tokens.append(token)
+                            yield _event("token", content=token)
+                        response = "".join(tokens).strip()
+                    else:
+                        response = await self._callLlm(self.responseSummarizerAgent.generateSummaryWithReflectionAsync, response=result['text'], userQuery=userQuery)
+                        response = cleanSummaryResponse(response)
+            else:
+                with span("chat", stream=streamAnswer):
+                    if streamAnswer:
+                        tokens = []
+                        async for token in self._streamLlm(self.chatAgent.streamResponse(userQuery, chatHistory)):
+                            tokens.append(token)
+                            yield _event("token", content=token)
+                        response = "".join(tokens).strip()
+                    else:
+                        response = await self._callLlm(self.chatAgent.generateResponseAsync, userQuery, chatHistory)
+            yield _event("answer", content=response)
         except InvalidUserQueryException as e:
             logger.exception(f"Invalid user query: {str(e)}")
-            return str(e)
+            yield _event("answer", content=str(e), error=True)
         except NoDataFoundException as e:
             logger.exception(f"No data found: {str(e)}")
-            return str(e)
+            yield _event("answer", content=str(e), error=True)
+        except QueryTooExpensiveException as e:
+            logger.warning(f"Query too expensive after retries: {e.hint}")
+            yield _event("answer", content=str(e), error=True)
         except Exception as e:
             logger.exception(f"An error occurred: {str(e)}")
-            return f"An error occurred: {str(e)}"
+            yield _event("answer", content=f"An error occurred: {str(e)}", error=True)
 
 ## Returns Layers in the format of [RegionID, DatasetID, Level]
 class DatasetRegionMatcher:
@@ -167,4 +674,21 @@ class DatasetRegionMatcher:
             )
         except Exception as e:
             logger.exception(f"An error occurred: {str(e)}")
-            return f"An error occurred: {str(e)}"
\ No newline at end of file
+            return f"An error occurred: {str(e)}"
+
+    async def matchAsync(self, userQuery):
+        relevent_docs = await asyncio.to_thread(get_relevant_documents, userQuery, 350)
+        relevent_docs = [str(doc.metadata['id']) for doc, score in relevent_docs]
+
+        relevent_datasets = {id_: self.datasetsMetadata[id_] for id_ in relevent_docs}
+        relevent_datasets = str(relevent_datasets)
+
+        try:
+            return await self.agent.matchAsync(
+                userQuery,
+                self.regionsMetadata,
+                relevent_datasets
+            )
+        except Exception as e:
+            logger.exception(f"An error occurred: {str(e)}")
+            return f"An error occurred: {str(e)}"
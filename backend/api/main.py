@@ -1,26 +1,102 @@
 ## main.py
 
-from fastapi import FastAPI, HTTPException, Path, Query, UploadFile, File
+from fastapi import FastAPI, HTTPException, Path, Query, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, Response
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
+from contextlib import asynccontextmanager
+import asyncio
+import json
 import logging
 import sys
 import os
-from typing import List, Optional
+import time
+from typing import Any, AsyncIterator, Awaitable, Dict, List, Optional
 
 ## Adding the parent directory to the sys path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from aiStuff.workflows import ElecDataWorkflow
-from aiStuff.agentHelpers import ChatHistory, ChatHistoryError
+from aiStuff.chatSearch import getChatSearchEngine, closeChatSearchEngine
+from aiStuff.cacheBackends import closeCacheBackend
+from aiStuff.health import checkDependencies, requiredDependencies, warmUp, closeHealthChecks
+from aiStuff import telemetry
+from aiStuff.agentHelpers import (
+    AsyncChatHistory
+    , ChatHistoryError
+    , InvalidCursorError
+    , ensureChatIndexes
+    , closeAsyncMongoClient
+    , closeMongoClient
+    , getMongoPoolStats
+    , getAsyncMongoPoolStats
+    , disposePostgresEngines
+    , getPostgresPoolStats
+)
 
 ## Setting up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+## The workflow is built in the lifespan hook rather than at import, so importing the app (tests, worker forks) stays cheap
+workflow: Optional[ElecDataWorkflow] = None
+## phase: starting -> warmingUp -> ready, or failed
+startupState: Dict[str, Any] = {"phase": "starting", "startedAt": time.time(), "durationSeconds": None, "errors": {}, "warmUp": None}
+lastDependencyCheck: Dict[str, Any] = {}
+
+async def initialiseWorkflow() -> None:
+    global workflow
+    workflow = await asyncio.to_thread(ElecDataWorkflow)
+
+async def startUp() -> None:
+    """
+    Builds the workflow, declares the chat indexes and opens the chat search engine in parallel,
+    then (with STARTUP_WARMUP=true) primes the pools and caches before reporting ready. If any of
+    the three fails the phase becomes `failed`: without the indexes the shared and bucketed chat
+    collections are scanned on every request, and without the search engine search fails.
+    """
+    startedAt = time.perf_counter()
+    components = {
+        "workflow": initialiseWorkflow(),
+        ## Also creates the shared motor client inside the running loop
+        "chatIndexes": ensureChatIndexes(),
+        "chatSearch": asyncio.to_thread(getChatSearchEngine),
+    }
+    results = await asyncio.gather(*components.values(), return_exceptions=True)
+    for name, result in zip(components, results):
+        if isinstance(result, Exception):
+            logger.error(f"Startup of {name} failed: {result}")
+            startupState["errors"][name] = str(result)
+    if workflow is None or startupState["errors"]:
+        startupState["phase"] = "failed"
+        return
+    if os.getenv("STARTUP_WARMUP", "false").lower() == "true":
+        startupState["phase"] = "warmingUp"
+        startupState["warmUp"] = await warmUp(workflow)
+    startupState["phase"] = "ready"
+    startupState["durationSeconds"] = round(time.perf_counter() - startedAt, 2)
+    logger.info(f"Startup finished in {startupState['durationSeconds']}s")
+
+## Shared connection pools live for the lifetime of the app; /healthz answers while startUp runs in the background
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    telemetry.configureTracing()
+    startupTask = asyncio.create_task(startUp())
+    yield
+    startupTask.cancel()
+    if workflow is not None:
+        workflow.valueIndex.stop()
+        workflow.schemaSnapshot.stop()
+    closeHealthChecks()
+    closeAsyncMongoClient()
+    closeMongoClient()
+    closeChatSearchEngine()
+    closeCacheBackend()
+    disposePostgresEngines()
+    telemetry.closeTelemetry()
+
 ## Initializing the FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 ## Adding CORS middleware
 origins = os.getenv("CORS_ORIGINS").split(',')
@@ -32,14 +108,17 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"], 
+    expose_headers=["X-Next-Cursor"],
 )
 
-## Initializing the workflow
-workflow = ElecDataWorkflow()
+## Per-route request histograms for /metrics; not installed at all when telemetry is disabled
+if telemetry.enabled:
+    app.add_middleware(telemetry.RequestMetricsMiddleware)
 
 class MessageRequest(BaseModel):
     chatId: Optional[str]
     content: str
+    bypassCache: bool = False
 
 class QueryRequest(BaseModel):
     userQuery: str
@@ -49,45 +128,152 @@ class GroupUpdateRequest(BaseModel):
     groupName: str
     groupColor: str
 
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", 0.5))
+
+def getWorkflow() -> ElecDataWorkflow:
+    """The workflow, or a 503 while it is still being built (or failed to build)."""
+    if workflow is None:
+        raise HTTPException(status_code=503, detail=f"Service is {startupState['phase']}", headers={"Retry-After": "5"})
+    return workflow
+
+async def runUntilDisconnected(request: Request, work: Awaitable[Any]) -> Any:
+    """
+    Awaits `work` while watching the client connection; if the client goes away the work is
+    cancelled (aborting in-flight model calls and cancelling the running SQL statement on the
+    server) and a 499 is raised instead of persisting a reply.
+    """
+    task = asyncio.ensure_future(work)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                logger.info(f"Client disconnected, cancelled processing for {request.url.path}")
+                raise HTTPException(status_code=499, detail="Client disconnected")
+    finally:
+        if not task.done():
+            task.cancel()
+
+def buildContext(fetchedContext: List[Dict[str, Any]]) -> str:
+    """Formats the recent messages (excluding the newest one) as chat history for the workflow."""
+    context = ''
+    for hist in fetchedContext[:-1]:
+        context += f"{hist['user']}: {hist['content']}\n"
+    return context
+
+def formatSse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
 @app.get("/api/chats/all")
-async def fetchChatHistory(userId: str = Query(...)):
+async def fetchChatHistory(
+    response: Response,
+    userId: str = Query(...),
+    limit: Optional[int] = Query(default=None, ge=1, le=500),
+    cursor: Optional[str] = Query(default=None),
+    fields: Optional[str] = Query(default=None)
+):
+    """
+    The user's chats. Without `limit`, `cursor` or `fields`, every chat is returned as before;
+    otherwise one page (pinned first, then most recently updated, 50 chats unless `limit` says
+    otherwise) is returned. `fields` is a comma-separated subset of the chat fields; the cursor for
+    the next page is returned in the `X-Next-Cursor` header, which is absent on the last page.
+    """
     try:
-        chatHistory = ChatHistory(userId=userId)
-        history = chatHistory.getAllChats()
-        return history
+        chatHistory = AsyncChatHistory(userId=userId)
+        if limit is None and not cursor and not fields:
+            return await chatHistory.getAllChats()
+        fieldList = [field.strip() for field in fields.split(',') if field.strip()] if fields else None
+        page = await chatHistory.getChatsPage(limit or 50, cursor, fieldList)
+        if page["nextCursor"]:
+            response.headers["X-Next-Cursor"] = page["nextCursor"]
+        return page["chats"]
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/chats/{chatId}/messages")
-async def fetchMessages(chatId: str = Path(...), userId: str = Query(...)):
+async def fetchMessages(
+    response: Response,
+    chatId: str = Path(...),
+    userId: str = Query(...),
+    limit: Optional[int] = Query(default=None, ge=1, le=1000),
+    cursor: Optional[str] = Query(default=None)
+):
+    """
+    The messages of a chat (oldest first). With `limit` or `cursor` set, only the newest `limit`
+    messages (100 by default) are returned; pass the `X-Next-Cursor` header value as `cursor` to
+    load the page of older messages. Without either, every message is returned.
+    """
     try:
-        chatHistory = ChatHistory(userId=userId)
-        messages = chatHistory.getMessages(chatId)
-        return messages
+        chatHistory = AsyncChatHistory(userId=userId)
+        if limit is None and not cursor:
+            return await chatHistory.getMessages(chatId)
+        page = await chatHistory.getMessagesPage(chatId, limit or 100, cursor)
+        if page["nextCursor"]:
+            response.headers["X-Next-Cursor"] = page["nextCursor"]
+        return page["messages"]
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/messages/send")
-async def handleSend(message: MessageRequest = ..., userId: str = Query(...)):
-    try:
-        chatHistory = ChatHistory(userId=userId)
-        chatId = chatHistory.addMessage(message.chatId, message.content)
-        fetchedContext = chatHistory.getRecentMessages(chatId)
-        context = ''
-        for hist in fetchedContext[:-1]:
-            context += f"{hist['user']}: {hist['content']}\n"
-        response = workflow.processUserQuery(message.content, context)
-        _ = chatHistory.addMessage(chatId, response, isUser=False)
+async def handleSend(request: Request, message: MessageRequest = ..., userId: str = Query(...)):
+    try:
+        chatHistory = AsyncChatHistory(userId=userId)
+        chatId = await chatHistory.addMessage(message.chatId, message.content)
+        fetchedContext = await chatHistory.getRecentMessages(chatId)
+        context = buildContext(fetchedContext)
+        response = await runUntilDisconnected(request, getWorkflow().processUserQueryAsync(message.content, context, useCache=not message.bypassCache))
+        _ = await chatHistory.addMessage(chatId, response, isUser=False)
         return {"status": "Message sent and processed", "chatId": chatId}
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/messages/send/stream")
+async def handleSendStream(message: MessageRequest = ..., userId: str = Query(...)):
+    """
+    Server-sent events version of /api/messages/send. Emits `chat` (with the chatId), the workflow's
+    stage events (`routed`, `sqlGenerated`, `rowsFetched`), `token` events for the answer, `answer`,
+    and finally `done` once the bot message has been stored. If the client disconnects the pipeline
+    is cancelled and nothing is stored.
+    """
+    pipeline = getWorkflow()
+    try:
+        chatHistory = AsyncChatHistory(userId=userId)
+        chatId = await chatHistory.addMessage(message.chatId, message.content)
+        fetchedContext = await chatHistory.getRecentMessages(chatId)
+        context = buildContext(fetchedContext)
+    except ChatHistoryError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def eventStream() -> AsyncIterator[str]:
+        yield formatSse("chat", {"chatId": chatId})
+        answer = None
+        async for event in pipeline.streamUserQuery(message.content, context, useCache=not message.bypassCache):
+            if event["event"] == "answer":
+                answer = event["data"]["content"]
+            yield formatSse(event["event"], event["data"])
+        try:
+            await chatHistory.addMessage(chatId, answer, isUser=False)
+            yield formatSse("done", {"chatId": chatId})
+        except ChatHistoryError as e:
+            yield formatSse("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        eventStream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
     
 @app.get("/api/chats/{chatId}/latest")
-async def getLatestMessages(chatId: str = Path(...), userId: str = Query(...), limit: int = Query(default=2)):
+async def getLatestMessages(chatId: str = Path(...), userId: str = Query(...), limit: int = Query(default=2, ge=1)):
     try:
-        chatHistory = ChatHistory(userId=userId)
-        messages = chatHistory.getRecentMessages(chatId)
-        messages = messages[-limit:]
+        chatHistory = AsyncChatHistory(userId=userId)
+        messages = await chatHistory.getLatestMessages(chatId, limit)
         return {"messages": messages}
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -95,8 +281,8 @@ async def getLatestMessages(chatId: str = Path(...), userId: str = Query(...), l
 @app.put("/api/chats/{chatId}/pin")
 async def handlePinChat(chatId: str = Path(...), userId: str = Query(...)):
     try:
-        chatHistory = ChatHistory(userId=userId)
-        chatHistory.pinChat(chatId)
+        chatHistory = AsyncChatHistory(userId=userId)
+        await chatHistory.pinChat(chatId)
         return {"status": "Chat pin status updated"}
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -104,8 +290,8 @@ async def handlePinChat(chatId: str = Path(...), userId: str = Query(...)):
 @app.put("/api/chats/{chatId}/unpin")
 async def handleUnpinChat(chatId: str = Path(...), userId: str = Query(...)):
     try:
-        chatHistory = ChatHistory(userId=userId)
-        chatHistory.unpinChat(chatId)
+        chatHistory = AsyncChatHistory(userId=userId)
+        await chatHistory.unpinChat(chatId)
         return {"status": "Chat pin status updated"}
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -113,8 +299,8 @@ async def handleUnpinChat(chatId: str = Path(...), userId: str = Query(...)):
 @app.delete("/api/chats/{chatId}/delete")
 async def handleDeleteChat(chatId: str = Path(...), userId: str = Query(...)):
     try:
-        chatHistory = ChatHistory(userId=userId)
-        chatHistory.deleteChat(chatId)
+        chatHistory = AsyncChatHistory(userId=userId)
+        await chatHistory.deleteChat(chatId)
         return {"status": "Chat deleted successfully"}
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -122,8 +308,8 @@ async def handleDeleteChat(chatId: str = Path(...), userId: str = Query(...)):
 @app.put("/api/chats/{chatId}/archive")
 async def handleArchiveChat(chatId: str = Path(...), userId: str = Query(...)):
     try:
-        chatHistory = ChatHistory(userId=userId)
-        chatHistory.archiveChat(chatId)
+        chatHistory = AsyncChatHistory(userId=userId)
+        await chatHistory.archiveChat(chatId)
         return {"status": "Chat archived successfully"}
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -131,17 +317,17 @@ async def handleArchiveChat(chatId: str = Path(...), userId: str = Query(...)):
 @app.put("/api/chats/{chatId}/unarchive")
 async def handleUnarchiveChat(chatId: str = Path(...), userId: str = Query(...)):
     try:
-        chatHistory = ChatHistory(userId=userId)
-        chatHistory.unarchiveChat(chatId)
+        chatHistory = AsyncChatHistory(userId=userId)
+        await chatHistory.unarchiveChat(chatId)
         return {"status": "Chat unarchived successfully"}
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/chats/search")
-async def handleSearch(term: str = Query(...), userId: str = Query(...)):
+async def handleSearch(term: str = Query(...), userId: str = Query(...), limit: int = Query(default=50, ge=1, le=200)):
     try:
-        chatHistory = ChatHistory(userId=userId)
-        searchResults = chatHistory.searchChats(term)
+        chatHistory = AsyncChatHistory(userId=userId)
+        searchResults = await chatHistory.searchChats(term, limit)
         return searchResults
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -149,8 +335,8 @@ async def handleSearch(term: str = Query(...), userId: str = Query(...)):
 @app.put("/api/chats/{chatId}/title")
 async def handleUpdateChatTitle(chatId: str = Path(...), userId: str = Query(...), newTitle: str = Query(...)):
     try:
-        chatHistory = ChatHistory(userId=userId)
-        chatHistory.updateChatTitle(chatId, newTitle)
+        chatHistory = AsyncChatHistory(userId=userId)
+        await chatHistory.updateChatTitle(chatId, newTitle)
         return {"status": "Chat title updated successfully"}
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -158,23 +344,21 @@ async def handleUpdateChatTitle(chatId: str = Path(...), userId: str = Query(...
 @app.get("/api/chats/{chatId}/messages/{messageId}")
 async def copyMessage(chatId: str = Path(...), messageId: str = Path(...), userId: str = Query(...)):
     try:
-        chatHistory = ChatHistory(userId=userId)
-        message = chatHistory.getMessage(chatId, messageId)
+        chatHistory = AsyncChatHistory(userId=userId)
+        message = await chatHistory.getMessage(chatId, messageId)
         return {"content": message["content"]}
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/api/chats/{chatId}/messages/{messageId}")
-async def handleUpdateMessage(chatId: str = Path(...), messageId: str = Path(...), newContent: str = Query(...), userId: str = Query(...)):
-    try:
-        chatHistory = ChatHistory(userId=userId)
-        chatHistory.updateMessage(chatId, messageId, newContent)
-        fetchedContext = chatHistory.getRecentMessages(chatId)
-        context = ''
-        for hist in fetchedContext[:-1]:
-            context += f"{hist['user']}: {hist['content']}\n"
-        response = workflow.processUserQuery(newContent, context)
-        chatHistory.addMessage(chatId, response, isUser=False)
+async def handleUpdateMessage(request: Request, chatId: str = Path(...), messageId: str = Path(...), newContent: str = Query(...), userId: str = Query(...), bypassCache: bool = Query(default=False)):
+    try:
+        chatHistory = AsyncChatHistory(userId=userId)
+        await chatHistory.updateMessage(chatId, messageId, newContent)
+        fetchedContext = await chatHistory.getRecentMessages(chatId)
+        context = buildContext(fetchedContext)
+        response = await runUntilDisconnected(request, getWorkflow().processUserQueryAsync(newContent, context, useCache=not bypassCache))
+        await chatHistory.addMessage(chatId, response, isUser=False)
         return {"status": "Message updated and new response generated"}
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -182,14 +366,14 @@ async def handleUpdateMessage(chatId: str = Path(...), messageId: str = Path(...
 @app.post("/api/{chatId}/upload")
 async def uploadFile(file: UploadFile = File(...), chatId: str = Path(...), userId: str = Query(...)):
     try:
-        chatHistory = ChatHistory(userId=userId)
+        chatHistory = AsyncChatHistory(userId=userId)
         content = await file.read()
         file_extension = os.path.splitext(file.filename)[1][1:].lower()
         
         if file_extension not in ["csv", "pdf", "txt"]:
             raise HTTPException(status_code=400, detail="Unsupported file type. Only CSV, PDF, and TXT are allowed.")
         
-        docId = chatHistory.uploadDoc(chatId, content, file.filename, file_extension)
+        docId = await chatHistory.uploadDoc(chatId, content, file.filename, file_extension)
         
         return {"status": "File uploaded successfully", "docId": docId}
     except ValueError as e:
@@ -200,8 +384,8 @@ async def uploadFile(file: UploadFile = File(...), chatId: str = Path(...), user
 @app.put("/api/chats/{chatId}/group")
 async def updateGroupStatus(chatId: str = Path(...), userId: str = Query(...), groupUpdate: GroupUpdateRequest = ...):
     try:
-        chatHistory = ChatHistory(userId=userId)
-        chatHistory.updateGroupStatus(chatId, groupUpdate.groupName, groupUpdate.groupColor)
+        chatHistory = AsyncChatHistory(userId=userId)
+        await chatHistory.updateGroupStatus(chatId, groupUpdate.groupName, groupUpdate.groupColor)
         return {"status": "Group status updated successfully"}
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -209,8 +393,8 @@ async def updateGroupStatus(chatId: str = Path(...), userId: str = Query(...), g
 @app.get("/api/chats/{chatId}/files")
 async def fetchUploadedFiles(chatId: str = Path(...), userId: str = Query(...)):
     try:
-        chatHistory = ChatHistory(userId=userId)
-        files = chatHistory.getUploadedFiles(chatId)
+        chatHistory = AsyncChatHistory(userId=userId)
+        files = await chatHistory.getUploadedFiles(chatId)
         return {"files": files}
     except ChatHistoryError as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -218,8 +402,8 @@ async def fetchUploadedFiles(chatId: str = Path(...), userId: str = Query(...)):
 @app.get("/api/files/{docId}/download")
 async def downloadFile(docId: str = Path(...), userId: str = Query(...)):
     try:
-        chatHistory = ChatHistory(userId=userId)
-        filename, content, content_type = chatHistory.getFileContent(docId)
+        chatHistory = AsyncChatHistory(userId=userId)
+        filename, content, content_type = await chatHistory.getFileContent(docId)
         if filename and content and content_type:
             headers = {
                 'Content-Disposition': f'attachment; filename="{filename}"'
@@ -233,8 +417,72 @@ async def downloadFile(docId: str = Path(...), userId: str = Query(...)):
 @app.delete("/api/chats/{chatId}/documents/{docId}")
 async def handleDeleteDocument(chatId: str = Path(...), docId: str = Path(...), userId: str = Query(...)):
     try:
-        chatHistory = ChatHistory(userId=userId)
-        chatHistory.deleteDocument(chatId, docId)
+        chatHistory = AsyncChatHistory(userId=userId)
+        await chatHistory.deleteDocument(chatId, docId)
         return {"status": "Document deleted successfully"}
     except ChatHistoryError as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/stats/pools")
+async def fetchPoolStats():
+    return {
+        "mongo": getMongoPoolStats(),
+        "mongoAsync": getAsyncMongoPoolStats(),
+        "postgres": getPostgresPoolStats()
+    }
+
+@app.get("/api/stats/caches")
+async def fetchCacheStats():
+    pipeline = getWorkflow()
+    return {
+        "answers": pipeline.answerCache.stats(),
+        "plans": pipeline.planCache.stats(),
+        "router": pipeline.localRouter.stats(),
+        "distinctValues": pipeline.distinctValueCache.stats(),
+        "sqlResults": pipeline.resultCache.stats() if pipeline.resultCache is not None else None
+    }
+
+@app.get("/metrics")
+async def fetchMetrics():
+    """
+    Prometheus scrape endpoint: stage and per-route request duration histograms of this worker
+    process. 404 when TELEMETRY_ENABLED is not set.
+    """
+    if not telemetry.enabled:
+        raise HTTPException(status_code=404, detail="Telemetry is disabled")
+    return PlainTextResponse(telemetry.renderMetrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/healthz")
+async def liveness():
+    """
+    Liveness: answers as long as the event loop does, whatever the state of the dependencies, with
+    the startup phase and the dependency statuses seen by the last /readyz call.
+    """
+    return {
+        "status": "ok",
+        "phase": startupState["phase"],
+        "uptimeSeconds": round(time.time() - startupState["startedAt"], 1),
+        "dependencies": lastDependencyCheck
+    }
+
+@app.get("/readyz")
+async def readiness():
+    """
+    Readiness: 200 once startup (and warm-up, if enabled) has finished and every dependency in
+    READINESS_REQUIRED_DEPENDENCIES answers; 503 otherwise. Reports each dependency's status.
+    """
+    dependencies = await checkDependencies(workflow, startupState["errors"].get("workflow"))
+    lastDependencyCheck.clear()
+    lastDependencyCheck.update(dependencies)
+    required = requiredDependencies()
+    ready = startupState["phase"] == "ready" and all(dependencies[name]["status"] == "ok" for name in required)
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else "notReady",
+            "phase": startupState["phase"],
+            "required": required,
+            "dependencies": dependencies,
+            "startup": {key: startupState[key] for key in ("durationSeconds", "errors", "warmUp")}
+        }
+    )
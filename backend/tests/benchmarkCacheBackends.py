@@ -0,0 +1,171 @@
+## Checks and benchmarks the cache backends: memory, a temporary SQLite file shared with a second
+## process, and RedisBackend against an in-process RESP stand-in (or a real server via CACHE_REDIS_URL).
+## Usage (from /backend): python tests/benchmarkCacheBackends.py [operations]
+
+import multiprocessing
+import os
+import re
+import socketserver
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from aiStuff.cacheBackends import CacheNamespace, MemoryBackend, RedisBackend, SqliteBackend
+
+## Minimal Redis stand-in: the commands RedisBackend sends, with PX expiry
+class RespStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RespHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def live(self, key):
+        entry = self.data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] < time.monotonic():
+            del self.data[key]
+            return None
+        return entry
+
+def globToRegex(pattern: bytes) -> re.Pattern:
+    parts, escaped = [], False
+    for char in pattern.decode('latin-1'):
+        if escaped:
+            parts.append(re.escape(char))
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '*':
+            parts.append('.*')
+        elif char == '?':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+    return re.compile(''.join(parts) + r'\Z', re.S)
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def readCommand(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    @staticmethod
+    def bulk(value):
+        return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def handle(self):
+        server = self.server
+        while True:
+            args = self.readCommand()
+            if args is None:
+                return
+            command = args[0].upper()
+            with server.lock:
+                if command in (b"PING", b"AUTH", b"SELECT"):
+                    reply = b"+OK\r\n"
+                elif command == b"GET":
+                    entry = server.live(args[1])
+                    reply = self.bulk(entry[0] if entry else None)
+                elif command == b"SET":
+                    expiresAt = time.monotonic() + int(args[4]) / 1000 if len(args) > 4 and args[3].upper() == b"PX" else None
+                    server.data[args[1]] = (args[2], expiresAt)
+                    reply = b"+OK\r\n"
+                elif command == b"DEL":
+                    reply = b":%d\r\n" % sum(server.data.pop(key, None) is not None for key in args[1:])
+                elif command == b"STRLEN":
+                    entry = server.live(args[1])
+                    reply = b":%d\r\n" % (len(entry[0]) if entry else 0)
+                elif command == b"SCAN":
+                    pattern = globToRegex(args[args.index(b"MATCH") + 1])
+                    keys = [key for key in list(server.data) if server.live(key) and pattern.match(key.decode('latin-1'))]
+                    reply = b"*2\r\n" + self.bulk(b"0") + b"*%d\r\n" % len(keys) + b"".join(self.bulk(key) for key in keys)
+                else:
+                    reply = b"-ERR unknown command\r\n"
+            self.wfile.write(reply)
+
+def check(backend) -> None:
+    cache = CacheNamespace("check", backend, ttlSeconds=60)
+    cache.clear()
+    cache.set("answer\x1fWentworth?", b"Allegra Spender")
+    assert cache.get("answer\x1fWentworth?") == b"Allegra Spender"
+    assert cache.keys("answer\x1f") == ["answer\x1fWentworth?"]
+    cache.set("short", b"x", ttlSeconds=0.05)
+    time.sleep(0.1)
+    assert cache.get("short") is None, "expired entry returned"
+    assert cache.deletePrefix("answer\x1f") == 1 and cache.get("answer\x1fWentworth?") is None
+    if backend.name == "redis":
+        ## The server evicts by its own maxmemory-policy
+        return
+
+    limited = CacheNamespace("checkLimits", backend, ttlSeconds=60, maxEntries=3)
+    limited.clear()
+    for i in range(5):
+        limited.set(f"k{i}", b"v")
+        time.sleep(0.002)
+    assert limited.get("k0") is None and limited.get("k4") == b"v", "maxEntries not enforced"
+
+    sized = CacheNamespace("checkBytes", backend, ttlSeconds=60, maxBytes=2500)
+    sized.clear()
+    for i in range(5):
+        sized.set(f"k{i}", b"x" * 1000)
+        time.sleep(0.002)
+    assert sized.stats()["bytes"] <= 2500 and sized.get("k4") is not None, "maxBytes not enforced"
+
+def sqliteWriter(path: str) -> None:
+    CacheNamespace("shared", SqliteBackend(path), ttlSeconds=60).set("fromChild", b"written by another process")
+
+def timeOperations(backend, operations: int, size: int) -> str:
+    cache = CacheNamespace("bench", backend, ttlSeconds=600, maxEntries=operations * 2)
+    value = os.urandom(size)
+    setTimes, getTimes = [], []
+    for i in range(operations):
+        startedAt = time.perf_counter()
+        cache.set(f"key{i}", value)
+        setTimes.append((time.perf_counter() - startedAt) * 1e6)
+    for i in range(operations):
+        startedAt = time.perf_counter()
+        cache.get(f"key{i}")
+        getTimes.append((time.perf_counter() - startedAt) * 1e6)
+    cache.clear()
+    return f"{size:>7} B: set median {statistics.median(setTimes):8.1f} us, get median {statistics.median(getTimes):8.1f} us"
+
+if __name__ == '__main__':
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    with tempfile.TemporaryDirectory() as directory:
+        sqlitePath = os.path.join(directory, 'cache.db')
+        standIn = None
+        redisUrl = os.getenv("CACHE_REDIS_URL")
+        if not redisUrl:
+            standIn = RespStandIn()
+            threading.Thread(target=standIn.serve_forever, daemon=True).start()
+            redisUrl = f"redis://127.0.0.1:{standIn.server_address[1]}/0"
+
+        backends = [MemoryBackend(), SqliteBackend(sqlitePath), RedisBackend(redisUrl, prefix="benchmark:")]
+        for backend in backends:
+            check(backend)
+            print(f"{backend.name}: checks passed")
+            for size in (1_000, 100_000):
+                print(f"  {timeOperations(backend, operations, size)}")
+
+        child = multiprocessing.Process(target=sqliteWriter, args=(sqlitePath,))
+        child.start()
+        child.join()
+        shared = CacheNamespace("shared", backends[1]).get("fromChild")
+        print(f"sqlite: value written by another process {'read back' if shared else 'MISSING'}")
+
+        for backend in backends:
+            backend.close()
+        if standIn is not None:
+            standIn.shutdown()
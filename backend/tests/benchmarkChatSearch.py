@@ -0,0 +1,58 @@
+## Benchmarks SqliteSearchEngine on a synthetic chat history: index build time and query latency.
+## Usage (from /backend): python tests/benchmarkChatSearch.py [messagesPerUser] [users]
+
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from aiStuff.chatSearch import SqliteSearchEngine
+
+divisions = ['Wentworth', 'Kooyong', 'Warringah', 'Sydney', 'Melbourne', 'Brisbane', 'Grayndler', 'Higgins', 'Indi', 'Mackellar']
+parties = ['ALP', 'Liberal', 'Greens', 'Nationals', 'Independent', 'One Nation']
+templates = [
+    "What was the two party preferred vote in {division} in {year}?",
+    "Show first preference votes for {party} candidates in {division}",
+    "How did the {party} swing compare across {division} and nearby seats in {year}?",
+    "In {year} the {party} won {division} with {votes} votes after preferences.",
+    "List polling places in {division} where {party} topped the primary vote",
+]
+
+def makeMessage(rng):
+    return rng.choice(templates).format(
+        division=rng.choice(divisions), party=rng.choice(parties),
+        year=rng.choice(range(2004, 2023, 3)), votes=rng.randint(1000, 60000)
+    )
+
+if __name__ == '__main__':
+    messagesPerUser = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rng = random.Random(7)
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = SqliteSearchEngine(os.path.join(directory, 'chatSearch.db'))
+        startedAt = time.perf_counter()
+        for user in range(users):
+            for chat in range(messagesPerUser // 100):
+                engine.replaceChatSync(f"user{user}", f"chat{chat}", [
+                    {"messageId": f"{chat}-{i}", "content": makeMessage(rng)} for i in range(100)
+                ])
+        print(f"indexed {messagesPerUser * users} messages in {time.perf_counter() - startedAt:.1f}s")
+
+        startedAt = time.perf_counter()
+        for i in range(200):
+            engine.addMessageSync("user0", "chatLive", f"live-{i}", makeMessage(rng))
+        print(f"incremental add: {(time.perf_counter() - startedAt) / 200 * 1000:.2f} ms/message")
+
+        for query in ['wentworth', 'went', '"two party preferred"', 'greens kooyong', 'liberal swing 2019']:
+            timings = []
+            for _ in range(50):
+                startedAt = time.perf_counter()
+                hits = engine.searchSync("user0", query, limit=50)
+                timings.append((time.perf_counter() - startedAt) * 1000)
+            print(f"{query!r:>26}: median {statistics.median(timings):.2f} ms, p95 {sorted(timings)[47]:.2f} ms, {len(hits)} hits")
+        engine.close()
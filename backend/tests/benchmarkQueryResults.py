@@ -0,0 +1,77 @@
+## Benchmarks the QuerySQLTool result path: the old repr-string parser vs the columnar cursor path.
+## Usage (from /backend): python tests/benchmarkQueryResults.py [rowCount ...] [--arrow]
+
+import ast
+import os
+import re
+import sys
+import time
+from datetime import datetime, date, timezone
+from decimal import Decimal
+
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from aiStuff.agentHelpers import rowsToDataFrame
+
+columns = ['division_name', 'party_ab', 'year', 'votes', 'percent', 'counted_at', 'election_date']
+
+def makeRows(rowCount):
+    return [
+        (
+            f"Division {i % 151}",
+            ('ALP', 'LP', 'GRN', 'NP', 'IND')[i % 5],
+            2004 + 3 * (i % 7),
+            Decimal(i * 7 % 100000),
+            Decimal(f"{(i % 10000) / 100:.2f}"),
+            datetime(2022, 5, 21, 18, i % 60, i % 60, tzinfo=timezone.utc),
+            date(2022, 5, 21),
+        )
+        for i in range(rowCount)
+    ]
+
+## The parser QuerySQLTool used before the cursor path (SQLDatabase.run returns str(rows))
+def _parseDecimal(match):
+    return f"'{Decimal(match.group(1))}'"
+
+def _parseDatetime(match):
+    dateArgs = list(map(int, match.group(1).split(',')))
+    if 'tzinfo' in (match.group(2) or ''):
+        dt = datetime(*dateArgs, tzinfo=timezone.utc)
+    else:
+        dt = datetime(*dateArgs)
+    return f"'{dt.isoformat()}'"
+
+def _parseDate(match):
+    dateArgs = list(map(int, match.group(1).split(',')))
+    return f"'{date(*dateArgs).isoformat()}'"
+
+def legacyPath(rows):
+    resStr = str(rows)
+    resStr = re.sub(r"Decimal\('([^']+)'\)", _parseDecimal, resStr)
+    resStr = re.sub(r"datetime\.datetime\(([\d, ]+)(, tzinfo=datetime\.timezone\.utc)?\)", _parseDatetime, resStr)
+    resStr = re.sub(r"datetime\.date\(([\d, ]+)\)", _parseDate, resStr)
+    res = ast.literal_eval(resStr)
+    return pd.DataFrame.from_records(data=res, columns=columns)
+
+def cursorPath(rows, batchSize=10000, useArrow=False):
+    batches = (rows[i:i + batchSize] for i in range(0, len(rows), batchSize))
+    return rowsToDataFrame(columns, batches, useArrow=useArrow)
+
+def timeIt(fn, *args, **kwargs):
+    startedAt = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - startedAt
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    useArrow = '--arrow' in sys.argv
+    rowCounts = [int(arg) for arg in args] or [10_000, 100_000, 1_000_000]
+
+    print(f"{'rows':>10} {'legacy (s)':>12} {'cursor (s)':>12} {'speedup':>9}")
+    for rowCount in rowCounts:
+        rows = makeRows(rowCount)
+        legacySeconds = timeIt(legacyPath, rows)
+        cursorSeconds = timeIt(cursorPath, rows, useArrow=useArrow)
+        print(f"{rowCount:>10} {legacySeconds:>12.3f} {cursorSeconds:>12.3f} {legacySeconds / cursorSeconds:>8.1f}x")
@@ -0,0 +1,71 @@
+## Checks ResultCache round trips: results come back from the Arrow format with their `attrs` (the
+## cost guard's row limit drives the summarizer's "only the first N rows" note), and pickled
+## payloads are never loaded. Also checks that `bumpVersion` invalidates results across caches
+## sharing a backend, including one stored by a query that was running across the bump.
+## Needs pyarrow.
+## Usage (from /backend): python tests/checkResultCache.py
+
+import os
+import pickle
+import sys
+
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from aiStuff.cacheBackends import MemoryBackend
+from aiStuff.caches import ResultCache, deserializeFrame, pa, serializeFrame
+
+def limitedFrame() -> pd.DataFrame:
+    data = pd.DataFrame({'division_name': ['Wentworth', 'Warringah'], 'votes': [51234, 48765]})
+    data.attrs.update({'rowLimit': 2, 'estimatedRows': 250000.0})
+    return data
+
+def checkFormats() -> None:
+    data = limitedFrame()
+    restored = deserializeFrame(serializeFrame(data))
+    assert restored.equals(data), "rows changed"
+    assert restored.attrs == data.attrs, f"attrs lost: {restored.attrs}"
+    assert serializeFrame(pd.DataFrame([[1, 2]], columns=['votes', 'votes'])) is None, "duplicate columns serialized"
+    print("arrow: attrs round trip passed")
+
+def checkCache() -> None:
+    cache = ResultCache(backend=MemoryBackend())
+    cache.setDataVersion("v1")
+    sqlQuery = "SELECT division_name, votes FROM results"
+    cache.set(sqlQuery, limitedFrame())
+    cached = cache.get("select  division_name, votes from RESULTS;")
+    assert cached is not None and cached.attrs == limitedFrame().attrs, "cached result lost its row limit"
+
+    ## A pickle planted in a shared backend (or left by an older version) is dropped unread
+    planted = cache.entryKey("SELECT 1")
+    cache._store.set(planted, b'P' + pickle.dumps(limitedFrame()))
+    assert cache.get("SELECT 1") is None and cache._store.get(planted) is None, "pickled result loaded"
+    print("ResultCache: cached result keeps its attrs, pickled payloads are never loaded")
+
+def checkBump() -> None:
+    backend = MemoryBackend()
+    worker, otherWorker = ResultCache(backend=backend), ResultCache(backend=backend)
+    for cache in (worker, otherWorker):
+        cache.setDataVersion("v1")
+    sqlQuery = "SELECT division_name, votes FROM results"
+    worker.set(sqlQuery, limitedFrame())
+    assert otherWorker.get(sqlQuery) is not None, "result not shared"
+
+    ## A query that started before the ETL load finishes after the bump
+    staleKey = worker.entryKey(sqlQuery)
+    usage = backend.usage("sqlResults")
+    assert otherWorker.bumpVersion() == 1
+    assert backend.usage("sqlResults") == usage, "bump rewrote the results"
+    worker.set(sqlQuery, limitedFrame(), staleKey)
+    assert worker.get(sqlQuery) is None and otherWorker.get(sqlQuery) is None, "result from before the bump served"
+    worker.set(sqlQuery, limitedFrame())
+    assert otherWorker.get(sqlQuery) is not None and otherWorker.stats()["generation"] == 1
+    print("bumpVersion: older results unreachable in every worker, no rewrite of the results")
+
+if __name__ == '__main__':
+    if pa is None:
+        sys.exit("pyarrow is not installed")
+    checkFormats()
+    checkCache()
+    checkBump()